@@ -0,0 +1,86 @@
+# Copyright 2020-2025 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This script benchmarks the conversion of the padded completion IDs of a GRPO generation step to the list of token IDs
+# passed to the reward functions: the per-token loop with `.item()` used previously, against
+# `trl.trainer.utils.masked_tolist`. It reports the time per generation step, and checks that both give the same output.
+
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+import torch
+from transformers import HfArgumentParser
+
+from trl.trainer.utils import masked_tolist
+
+
+@dataclass
+class ScriptArguments:
+    r"""
+    Arguments for the script.
+
+    Args:
+        num_completions (`list[int]`, *optional*, defaults to `[16, 64, 512]`):
+            Numbers of completions per generation step.
+        max_completion_length (`int`, *optional*, defaults to `1024`):
+            Maximum length of the completions. Each completion ends at a random position.
+        device (`str` or `None`, *optional*, defaults to `None`):
+            Device of the completions. If `None`, uses CUDA if available, otherwise CPU.
+    """
+
+    num_completions: list[int] = field(
+        default_factory=lambda: [16, 64, 512], metadata={"help": "Numbers of completions per generation step."}
+    )
+    max_completion_length: int = field(
+        default=1024,
+        metadata={"help": "Maximum length of the completions. Each completion ends at a random position."},
+    )
+    device: Optional[str] = field(
+        default=None,
+        metadata={"help": "Device of the completions. If `None`, uses CUDA if available, otherwise CPU."},
+    )
+
+
+def loop_tolist(completion_ids, completion_mask):
+    return [[id.item() for id, m in zip(row, mask_row) if m] for row, mask_row in zip(completion_ids, completion_mask)]
+
+
+def timeit(fn):
+    start = time.perf_counter()
+    output = fn()
+    return output, (time.perf_counter() - start) * 1000
+
+
+def main(num_completions, max_completion_length, device):
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    generator = torch.Generator().manual_seed(42)
+
+    print(f"{'completions':>11} {'tokens':>9} {'loop (ms)':>10} {'masked_tolist (ms)':>19} {'speedup':>8}")
+    for n in num_completions:
+        completion_ids = torch.randint(0, 32_000, (n, max_completion_length), generator=generator).to(device)
+        lengths = torch.randint(1, max_completion_length + 1, (n, 1), generator=generator).to(device)
+        completion_mask = (torch.arange(max_completion_length, device=device) < lengths).int()
+        masked_tolist(completion_ids, completion_mask)  # warmup
+        expected, loop_time = timeit(lambda ids=completion_ids, mask=completion_mask: loop_tolist(ids, mask))
+        output, fast_time = timeit(lambda ids=completion_ids, mask=completion_mask: masked_tolist(ids, mask))
+        assert output == expected, "Outputs differ"
+        num_tokens = completion_mask.sum().item()
+        print(f"{n:>11} {num_tokens:>9} {loop_time:>10.1f} {fast_time:>19.2f} {loop_time / fast_time:>7.0f}x")
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser(ScriptArguments)
+    script_args = parser.parse_args_into_dataclasses()[0]
+    main(script_args.num_completions, script_args.max_completion_length, script_args.device)
@@ -0,0 +1,140 @@
+# Copyright 2020-2025 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This script benchmarks the encoding of the completions returned by the `/generate/` endpoint of `trl vllm-serve`, on
+# synthetic completions: JSON lists of integers (and floats for the log-probabilities), against the binary format of
+# `trl.extras.vllm_client.encode_completions` (`VLLMClient(response_format="binary")`), with and without gzip
+# compression. It reports the size of the response, the time to encode it on the server, and the time to decode it on
+# the client and convert the completions to tensors, as done by the GRPO trainer. The JSON encoding time is a lower
+# bound, since FastAPI also validates the response against its model.
+
+import gzip
+import json
+import time
+from dataclasses import dataclass, field
+from functools import partial
+
+import numpy as np
+import torch
+from transformers import HfArgumentParser
+
+from trl.extras.vllm_client import decode_completions, encode_completions
+
+
+@dataclass
+class ScriptArguments:
+    r"""
+    Arguments for the script.
+
+    Args:
+        num_completions (`list[int]`, *optional*, defaults to `[64, 1024]`):
+            Numbers of completions per response.
+        max_completion_length (`int`, *optional*, defaults to `8192`):
+            Maximum length of the completions. The completion lengths are drawn uniformly between 1 and it.
+        vocab_size (`int`, *optional*, defaults to `151936`):
+            Size of the vocabulary the token IDs are drawn from.
+        return_logprobs (`bool`, *optional*, defaults to `False`):
+            Whether the responses include the log-probabilities of the tokens.
+    """
+
+    num_completions: list[int] = field(
+        default_factory=lambda: [64, 1024], metadata={"help": "Numbers of completions per response."}
+    )
+    max_completion_length: int = field(
+        default=8192,
+        metadata={
+            "help": "Maximum length of the completions. The completion lengths are drawn uniformly between 1 and it."
+        },
+    )
+    vocab_size: int = field(default=151936, metadata={"help": "Size of the vocabulary the token IDs are drawn from."})
+    return_logprobs: bool = field(
+        default=False, metadata={"help": "Whether the responses include the log-probabilities of the tokens."}
+    )
+
+
+def json_encode(completion_ids, logprobs):
+    output = {"completion_ids": completion_ids}
+    if logprobs is not None:
+        output["logprobs"] = logprobs
+    return json.dumps(output).encode()
+
+
+def json_decode(content):
+    output = json.loads(content)
+    return output["completion_ids"], output.get("logprobs")
+
+
+def binary_encode(completion_ids, logprobs, compress):
+    content = encode_completions(completion_ids, logprobs)
+    return gzip.compress(content, compresslevel=1) if compress else content
+
+
+def binary_decode(content, compress):
+    return decode_completions(gzip.decompress(content) if compress else content)
+
+
+def to_tensors(completion_ids, logprobs):
+    completion_ids = [torch.tensor(ids, dtype=torch.long) for ids in completion_ids]
+    if logprobs is not None:
+        logprobs = [torch.tensor(values) for values in logprobs]
+    return completion_ids, logprobs
+
+
+def timeit(fn):
+    start = time.perf_counter()
+    output = fn()
+    return output, (time.perf_counter() - start) * 1000
+
+
+def main(num_completions, max_completion_length, vocab_size, return_logprobs):
+    rng = np.random.default_rng(42)
+    formats = {
+        "json": (json_encode, json_decode),
+        "binary": (partial(binary_encode, compress=False), partial(binary_decode, compress=False)),
+        "binary+gzip": (partial(binary_encode, compress=True), partial(binary_decode, compress=True)),
+    }
+
+    print(f"{'completions':>11} {'format':>12} {'size (MB)':>10} {'encode (ms)':>12} {'decode (ms)':>12} {'speedup':>8}")  # fmt: skip
+    for n in num_completions:
+        # As on the server, the completions are lists of Python integers and floats
+        lengths = rng.integers(1, max_completion_length + 1, size=n)
+        completion_ids = [rng.integers(0, vocab_size, size=length).tolist() for length in lengths]
+        logprobs = [(-rng.exponential(size=length)).tolist() for length in lengths] if return_logprobs else None
+
+        baseline = None
+        for name, (encode, decode) in formats.items():
+            content, encode_time = timeit(
+                lambda encode=encode, ids=completion_ids, logprobs=logprobs: encode(ids, logprobs)
+            )
+            (decoded_ids, decoded_logprobs), decode_time = timeit(
+                lambda decode=decode, content=content: to_tensors(*decode(content))
+            )
+            assert all(ids.tolist() == expected for ids, expected in zip(decoded_ids, completion_ids))
+            total_time = encode_time + decode_time
+            baseline = baseline or total_time
+            print(
+                f"{n:>11} {name:>12} {len(content) / 1024**2:>10.1f} {encode_time:>12.0f} {decode_time:>12.0f} "
+                f"{baseline / total_time:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser(ScriptArguments)
+    script_args = parser.parse_args_into_dataclasses()[0]
+    main(
+        script_args.num_completions,
+        script_args.max_completion_length,
+        script_args.vocab_size,
+        script_args.return_logprobs,
+    )
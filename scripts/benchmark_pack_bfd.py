@@ -0,0 +1,139 @@
+# Copyright 2020-2025 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This script benchmarks the Best Fit Decreasing bin assignment used by `pack_dataset(..., strategy="bfd")` against
+# the previous pure-Python implementation (list-based segment tree and one loop iteration per sequence), and checks
+# that both produce the same packing.
+
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+
+import numpy as np
+from transformers import HfArgumentParser
+
+from trl.data_utils import _bfd_bin_assignment
+
+
+@dataclass
+class ScriptArguments:
+    r"""
+    Arguments for the script.
+
+    Args:
+        num_sequences (`list[int]`, *optional*, defaults to `[100_000, 1_000_000, 10_000_000]`):
+            Number of sequence lengths to pack.
+        seq_length (`int`, *optional*, defaults to `4096`):
+            Target sequence length to pack to.
+        mean_length (`int`, *optional*, defaults to `500`):
+            Mean of the (geometric) distribution of the sequence lengths.
+        max_legacy_sequences (`int`, *optional*, defaults to `1_000_000`):
+            The legacy implementation is skipped above this number of sequences, as it becomes very slow.
+    """
+
+    num_sequences: list[int] = field(
+        default_factory=lambda: [100_000, 1_000_000, 10_000_000],
+        metadata={"help": "Number of sequence lengths to pack."},
+    )
+    seq_length: int = field(default=4096, metadata={"help": "Target sequence length to pack to."})
+    mean_length: int = field(
+        default=500, metadata={"help": "Mean of the (geometric) distribution of the sequence lengths."}
+    )
+    max_legacy_sequences: int = field(
+        default=1_000_000,
+        metadata={"help": "The legacy implementation is skipped above this number of sequences."},
+    )
+
+
+class LegacySegmentTree:
+    def __init__(self, maxval: int):
+        self.maxval = maxval
+        self.tree = [0] * (2 * maxval)
+
+    def add(self, val):
+        i = self.maxval + val - 1
+        self.tree[i] = val
+        while i > 1:
+            i >>= 1
+            left, right = self.tree[i << 1], self.tree[(i << 1) + 1]
+            self.tree[i] = left if left >= right else right
+
+    def remove(self, val):
+        i = self.maxval + val - 1
+        self.tree[i] = 0
+        while i > 1:
+            i >>= 1
+            left, right = self.tree[i << 1], self.tree[(i << 1) + 1]
+            self.tree[i] = left if left >= right else right
+
+    def search(self, val):
+        i = 1
+        while i < self.maxval:
+            if self.tree[i << 1] >= val:
+                i = i << 1
+            else:
+                i = (i << 1) + 1
+        return self.tree[i]
+
+
+def legacy_bfd_bin_assignment(lengths: np.ndarray, seq_length: int) -> tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(-lengths, kind="stable")
+    segment_tree = LegacySegmentTree(seq_length)
+    segment_tree.add(seq_length)
+    space_to_bin = defaultdict(deque)
+    bins = []
+    for length, idx in zip(lengths[order], order):
+        space = segment_tree.search(length)
+        if space < seq_length:
+            bin = space_to_bin[space].popleft()
+        else:
+            bin = {"ids": [], "length": 0}
+            bins.append(bin)
+        bin["ids"].append(idx)
+        bin["length"] += length
+        if space < seq_length and not space_to_bin[space]:
+            segment_tree.remove(space)
+        space = space - length
+        space_to_bin[space].append(bin)
+        if space > 0:
+            segment_tree.add(space)
+    return np.array([id_ for bin in bins for id_ in bin["ids"]]), np.array([len(bin["ids"]) for bin in bins])
+
+
+def main(num_sequences, seq_length, mean_length, max_legacy_sequences):
+    rng = np.random.default_rng(42)
+    print(f"{'num_sequences':>14} {'legacy (s)':>11} {'numpy (s)':>10} {'speedup':>8} {'num_bins':>10}")
+    for num in num_sequences:
+        lengths = np.minimum(rng.geometric(1 / mean_length, size=num), seq_length)
+
+        start = time.perf_counter()
+        order, bin_sizes = _bfd_bin_assignment(lengths, seq_length)
+        new_time = time.perf_counter() - start
+
+        if num <= max_legacy_sequences:
+            start = time.perf_counter()
+            legacy_order, legacy_bin_sizes = legacy_bfd_bin_assignment(lengths, seq_length)
+            legacy_time = time.perf_counter() - start
+            assert np.array_equal(order, legacy_order) and np.array_equal(bin_sizes, legacy_bin_sizes)
+            print(
+                f"{num:>14} {legacy_time:>11.2f} {new_time:>10.2f} {legacy_time / new_time:>7.1f}x {len(bin_sizes):>10}"
+            )
+        else:
+            print(f"{num:>14} {'skipped':>11} {new_time:>10.2f} {'-':>8} {len(bin_sizes):>10}")
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser(ScriptArguments)
+    script_args = parser.parse_args_into_dataclasses()[0]
+    main(script_args.num_sequences, script_args.seq_length, script_args.mean_length, script_args.max_legacy_sequences)
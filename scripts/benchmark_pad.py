@@ -0,0 +1,100 @@
+# Copyright 2020-2025 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This script benchmarks `trl.trainer.utils.pad` on 1D sequences against a copy of each sequence into the output in a
+# Python loop (the implementation used for multi-dimensional tensors), reports the time per call, and checks that both
+# give the same output.
+
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+import torch
+from transformers import HfArgumentParser
+
+from trl.trainer.utils import pad
+
+
+@dataclass
+class ScriptArguments:
+    r"""
+    Arguments for the script.
+
+    Args:
+        num_sequences (`list[int]`, *optional*, defaults to `[8, 64, 512, 4096]`):
+            Numbers of sequences to pad.
+        mean_length (`int`, *optional*, defaults to `512`):
+            Mean length of the sequences.
+        num_repeats (`int`, *optional*, defaults to `20`):
+            Number of calls timed for each configuration.
+        device (`str` or `None`, *optional*, defaults to `None`):
+            Device of the sequences. If `None`, uses CUDA if available, otherwise CPU.
+    """
+
+    num_sequences: list[int] = field(
+        default_factory=lambda: [8, 64, 512, 4096], metadata={"help": "Numbers of sequences to pad."}
+    )
+    mean_length: int = field(default=512, metadata={"help": "Mean length of the sequences."})
+    num_repeats: int = field(default=20, metadata={"help": "Number of calls timed for each configuration."})
+    device: Optional[str] = field(
+        default=None,
+        metadata={"help": "Device of the sequences. If `None`, uses CUDA if available, otherwise CPU."},
+    )
+
+
+def pad_loop(tensors, padding_value=0, padding_side="right", pad_to_multiple_of=None):
+    max_length = max(len(t) for t in tensors)
+    if pad_to_multiple_of is not None and max_length % pad_to_multiple_of != 0:
+        max_length += pad_to_multiple_of - max_length % pad_to_multiple_of
+    output = torch.full((len(tensors), max_length), padding_value, dtype=tensors[0].dtype, device=tensors[0].device)
+    for i, t in enumerate(tensors):
+        if padding_side == "left":
+            output[i, max_length - len(t) :] = t
+        else:
+            output[i, : len(t)] = t
+    return output
+
+
+def timeit(fn, num_repeats, device):
+    fn()  # warmup
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_repeats):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_repeats * 1000
+
+
+def main(num_sequences, mean_length, num_repeats, device):
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    generator = torch.Generator().manual_seed(42)
+
+    print(f"{'sequences':>9} {'side':>5} {'loop (ms)':>10} {'pad (ms)':>9} {'speedup':>8}")
+    for n in num_sequences:
+        lengths = torch.randint(1, 2 * mean_length, (n,), generator=generator).tolist()
+        tensors = [torch.randint(0, 32_000, (length,), generator=generator).to(device) for length in lengths]
+        for padding_side in ["left", "right"]:
+            kwargs = {"padding_value": 0, "padding_side": padding_side, "pad_to_multiple_of": 8}
+            assert torch.equal(pad(tensors, **kwargs), pad_loop(tensors, **kwargs)), "Outputs differ"
+            loop_time = timeit(lambda tensors=tensors, kwargs=kwargs: pad_loop(tensors, **kwargs), num_repeats, device)
+            pad_time = timeit(lambda tensors=tensors, kwargs=kwargs: pad(tensors, **kwargs), num_repeats, device)
+            print(f"{n:>9} {padding_side:>5} {loop_time:>10.3f} {pad_time:>9.3f} {loop_time / pad_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser(ScriptArguments)
+    script_args = parser.parse_args_into_dataclasses()[0]
+    main(script_args.num_sequences, script_args.mean_length, script_args.num_repeats, script_args.device)
@@ -0,0 +1,157 @@
+# Copyright 2020-2025 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This script benchmarks the forward and backward passes of the GRPO policy on batches of left-padded prompts followed
+# by right-padded completions of variable lengths, with the regular (padded) forward pass against the padding-free one
+# (`GRPOConfig.padding_free`). It reports the number of (non-padding) tokens processed per second, and the maximum
+# difference between the per-token log-probabilities of the completions.
+
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+import torch
+from datasets import Dataset
+from transformers import HfArgumentParser
+
+from trl import GRPOConfig, GRPOTrainer
+
+
+@dataclass
+class ScriptArguments:
+    r"""
+    Arguments for the script.
+
+    Args:
+        model_name_or_path (`str`, *optional*, defaults to `"trl-internal-testing/tiny-Qwen2ForCausalLM-2.5"`):
+            Model to benchmark.
+        attn_implementation (`str` or `None`, *optional*, defaults to `None`):
+            Attention implementation of the model, e.g. `"flash_attention_2"`. If `None`, uses the default one.
+        batch_size (`int`, *optional*, defaults to `8`):
+            Number of prompt-completion pairs per batch.
+        prompt_length (`int`, *optional*, defaults to `256`):
+            Maximum length of the prompts. The prompt lengths are drawn uniformly between half and all of it.
+        max_completion_lengths (`list[int]`, *optional*, defaults to `[256, 1024]`):
+            Maximum lengths of the completions. The completion lengths are drawn from an exponential distribution with
+            a mean of a quarter of it, clipped to it.
+        num_repeats (`int`, *optional*, defaults to `5`):
+            Number of batches timed for each configuration.
+    """
+
+    model_name_or_path: str = field(
+        default="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5", metadata={"help": "Model to benchmark."}
+    )
+    attn_implementation: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Attention implementation of the model, e.g. `'flash_attention_2'`. If `None`, uses the default "
+            "one."
+        },
+    )
+    batch_size: int = field(default=8, metadata={"help": "Number of prompt-completion pairs per batch."})
+    prompt_length: int = field(
+        default=256,
+        metadata={
+            "help": "Maximum length of the prompts. The prompt lengths are drawn uniformly between half and all of it."
+        },
+    )
+    max_completion_lengths: list[int] = field(
+        default_factory=lambda: [256, 1024],
+        metadata={
+            "help": "Maximum lengths of the completions. The completion lengths are drawn from an exponential "
+            "distribution with a mean of a quarter of it, clipped to it."
+        },
+    )
+    num_repeats: int = field(default=5, metadata={"help": "Number of batches timed for each configuration."})
+
+
+def make_batch(batch_size, prompt_length, max_completion_length, vocab_size, generator, device):
+    prompt_lengths = torch.randint(prompt_length // 2, prompt_length + 1, (batch_size,), generator=generator)
+    completion_lengths = torch.empty(batch_size).exponential_(4 / max_completion_length, generator=generator)
+    completion_lengths = completion_lengths.long().clamp(1, max_completion_length)
+    positions = torch.arange(prompt_length)
+    prompt_mask = (positions >= prompt_length - prompt_lengths.unsqueeze(1)).long()
+    completion_mask = (torch.arange(max_completion_length) < completion_lengths.unsqueeze(1)).long()
+    attention_mask = torch.cat([prompt_mask, completion_mask], dim=1)
+    input_ids = torch.randint(0, vocab_size, attention_mask.shape, generator=generator) * attention_mask
+    return input_ids.to(device), attention_mask.to(device), completion_mask.bool().to(device)
+
+
+def main(model_name_or_path, attn_implementation, batch_size, prompt_length, max_completion_lengths, num_repeats):
+    model_init_kwargs = {"attn_implementation": attn_implementation} if attn_implementation is not None else None
+    args = GRPOConfig(
+        output_dir="/tmp/benchmark_padding_free",
+        bf16=torch.cuda.is_available(),
+        report_to="none",
+        model_init_kwargs=model_init_kwargs,
+    )
+    trainer = GRPOTrainer(
+        model=model_name_or_path,
+        reward_funcs=lambda completions, **kwargs: [0.0] * len(completions),
+        args=args,
+        train_dataset=Dataset.from_dict({"prompt": ["Hello"]}),
+    )
+    model = trainer.model
+    model.train()
+    device = model.device
+    generator = torch.Generator().manual_seed(42)
+
+    def forward_backward(input_ids, attention_mask, logits_to_keep, padding_free):
+        trainer.args.padding_free = padding_free
+        logps, _ = trainer._get_per_token_logps_and_entropies(model, input_ids, attention_mask, logits_to_keep)
+        logps.sum().backward()
+        model.zero_grad()
+        return logps.detach()
+
+    print(f"{'completion':>10} {'padding':>8} {'padded (tok/s)':>15} {'padding-free (tok/s)':>21} {'speedup':>8} {'max diff':>9}")  # fmt: skip
+    for max_completion_length in max_completion_lengths:
+        batches = [
+            make_batch(batch_size, prompt_length, max_completion_length, model.config.vocab_size, generator, device)
+            for _ in range(num_repeats + 1)
+        ]
+        num_tokens = sum(attention_mask.sum().item() for _, attention_mask, _ in batches[1:])
+        padding_ratio = 1 - num_tokens / sum(attention_mask.numel() for _, attention_mask, _ in batches[1:])
+        throughputs, max_diff = {}, 0.0
+        for padding_free in [False, True]:
+            forward_backward(*batches[0][:2], max_completion_length, padding_free)  # warmup
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for input_ids, attention_mask, _ in batches[1:]:
+                forward_backward(input_ids, attention_mask, max_completion_length, padding_free)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            throughputs[padding_free] = num_tokens / (time.perf_counter() - start)
+        for input_ids, attention_mask, completion_mask in batches[1:]:
+            logps = forward_backward(input_ids, attention_mask, max_completion_length, False)
+            padding_free_logps = forward_backward(input_ids, attention_mask, max_completion_length, True)
+            max_diff = max(max_diff, (logps - padding_free_logps)[completion_mask].abs().max().item())
+        speedup = throughputs[True] / throughputs[False]
+        print(
+            f"{max_completion_length:>10} {padding_ratio:>8.0%} {throughputs[False]:>15.0f} {throughputs[True]:>21.0f} "
+            f"{speedup:>7.2f}x {max_diff:>9.1e}"
+        )
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser(ScriptArguments)
+    script_args = parser.parse_args_into_dataclasses()[0]
+    main(
+        script_args.model_name_or_path,
+        script_args.attn_implementation,
+        script_args.batch_size,
+        script_args.prompt_length,
+        script_args.max_completion_lengths,
+        script_args.num_repeats,
+    )
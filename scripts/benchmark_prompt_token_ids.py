@@ -0,0 +1,95 @@
+# Copyright 2020-2025 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This script benchmarks how GRPO passes the truncated prompts of a generation step to vLLM, on long synthetic prompts:
+# decoding the truncated prompt IDs back into text, stripping the pad tokens, and re-tokenizing the text on the vLLM
+# side (used previously), against sending the prompt token IDs, extracted with `trl.trainer.utils.masked_tolist`. It
+# reports the time per generation step, and the number of prompts whose re-tokenized text doesn't give back the
+# truncated prompt IDs.
+
+import random
+import re
+import time
+from dataclasses import dataclass, field
+
+from transformers import AutoTokenizer, HfArgumentParser
+
+from trl.trainer.grpo_trainer import truncate_with_protected_tokens
+from trl.trainer.utils import masked_tolist
+
+
+@dataclass
+class ScriptArguments:
+    r"""
+    Arguments for the script.
+
+    Args:
+        model_name_or_path (`str`, *optional*, defaults to `"trl-internal-testing/tiny-Qwen2ForCausalLM-2.5"`):
+            Model whose tokenizer is used.
+        num_prompts (`list[int]`, *optional*, defaults to `[64, 256, 1024]`):
+            Numbers of prompts per generation step.
+        num_words (`int`, *optional*, defaults to `2048`):
+            Mean number of words of the prompts.
+        max_prompt_length (`int`, *optional*, defaults to `1024`):
+            Maximum length of the prompts, in tokens.
+    """
+
+    model_name_or_path: str = field(
+        default="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5", metadata={"help": "Model whose tokenizer is used."}
+    )
+    num_prompts: list[int] = field(
+        default_factory=lambda: [64, 256, 1024], metadata={"help": "Numbers of prompts per generation step."}
+    )
+    num_words: int = field(default=2048, metadata={"help": "Mean number of words of the prompts."})
+    max_prompt_length: int = field(default=1024, metadata={"help": "Maximum length of the prompts, in tokens."})
+
+
+WORDS = ["the", "sky", "is", "blue", "and", "water", "flows", "down", "to", "sea", "while", "birds", "sing", "42", "!"]
+
+
+def text_path(tokenizer, prompt_ids):
+    prompts_text = tokenizer.batch_decode(prompt_ids, skip_special_tokens=False, clean_up_tokenization_spaces=False)
+    prompts_text = [re.sub(rf"^({re.escape(tokenizer.pad_token)})+", "", text) for text in prompts_text]
+    # Tokenization on the vLLM side
+    return tokenizer(prompts_text, add_special_tokens=False)["input_ids"]
+
+
+def timeit(fn):
+    start = time.perf_counter()
+    output = fn()
+    return output, (time.perf_counter() - start) * 1000
+
+
+def main(model_name_or_path, num_prompts, num_words, max_prompt_length):
+    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, padding_side="left")
+    rng = random.Random(42)
+
+    print(f"{'prompts':>8} {'text (ms)':>10} {'token IDs (ms)':>15} {'speedup':>8} {'drifted prompts':>16}")
+    for n in num_prompts:
+        prompts = [" ".join(rng.choices(WORDS, k=rng.randint(1, 2 * num_words))) for _ in range(n)]
+        prompt_inputs = tokenizer(prompts, return_tensors="pt", padding=True, add_special_tokens=False)
+        prompt_ids, prompt_mask = truncate_with_protected_tokens(
+            prompt_inputs["input_ids"], prompt_inputs["attention_mask"], max_prompt_length, []
+        )
+        text_path(tokenizer, prompt_ids[:1])  # warmup
+        text_ids, text_time = timeit(lambda ids=prompt_ids: text_path(tokenizer, ids))
+        token_ids, token_time = timeit(lambda ids=prompt_ids, mask=prompt_mask: masked_tolist(ids, mask))
+        num_drifted = sum(a != b for a, b in zip(text_ids, token_ids))
+        print(f"{n:>8} {text_time:>10.1f} {token_time:>15.1f} {text_time / token_time:>7.0f}x {num_drifted:>16}")
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser(ScriptArguments)
+    script_args = parser.parse_args_into_dataclasses()[0]
+    main(script_args.model_name_or_path, script_args.num_prompts, script_args.num_words, script_args.max_prompt_length)
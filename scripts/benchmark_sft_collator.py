@@ -0,0 +1,94 @@
+# Copyright 2020-2025 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This script benchmarks the fetching and collation of SFT batches, as a list of examples (default) and as a single
+# Arrow table (`arrow_collation=True`), on a synthetic tokenized dataset, reports the throughput in batches/sec, and
+# checks that both give the same batches.
+
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+import torch
+from datasets import Dataset
+from transformers import HfArgumentParser
+
+from trl.trainer.sft_trainer import DataCollatorForLanguageModeling, _ArrowBatchDataset
+
+
+@dataclass
+class ScriptArguments:
+    r"""
+    Arguments for the script.
+
+    Args:
+        num_examples (`int`, *optional*, defaults to `100_000`):
+            Number of examples in the synthetic dataset.
+        mean_length (`int`, *optional*, defaults to `256`):
+            Mean number of tokens of the examples.
+        batch_sizes (`list[int]`, *optional*, defaults to `[8, 64, 512]`):
+            Batch sizes to benchmark.
+        num_batches (`int`, *optional*, defaults to `50`):
+            Number of batches collated for each configuration.
+    """
+
+    num_examples: int = field(default=100_000, metadata={"help": "Number of examples in the synthetic dataset."})
+    mean_length: int = field(default=256, metadata={"help": "Mean number of tokens of the examples."})
+    batch_sizes: list[int] = field(
+        default_factory=lambda: [8, 64, 512], metadata={"help": "Batch sizes to benchmark."}
+    )
+    num_batches: int = field(default=50, metadata={"help": "Number of batches collated for each configuration."})
+
+
+def make_dataset(num_examples: int, mean_length: int) -> Dataset:
+    rng = np.random.default_rng(42)
+    lengths = rng.integers(1, 2 * mean_length, size=num_examples)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    input_ids = rng.integers(0, 32_000, size=offsets[-1])
+    completion_mask = (np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)) >= np.repeat(lengths // 2, lengths)
+    return Dataset.from_dict(
+        {
+            "input_ids": np.split(input_ids, offsets[1:-1]),
+            "completion_mask": np.split(completion_mask.astype(np.int64), offsets[1:-1]),
+        }
+    )
+
+
+def main(num_examples, mean_length, batch_sizes, num_batches):
+    dataset = make_dataset(num_examples, mean_length)
+    arrow_dataset = _ArrowBatchDataset(dataset)
+    rng = np.random.default_rng(0)
+
+    print(f"{'padding free':>12} {'batch size':>10} {'examples (batch/s)':>19} {'arrow (batch/s)':>16} {'speedup':>8}")
+    for padding_free in [False, True]:
+        collator = DataCollatorForLanguageModeling(pad_token_id=0, padding_free=padding_free)
+        for batch_size in batch_sizes:
+            batches = [rng.choice(num_examples, size=batch_size, replace=False).tolist() for _ in range(num_batches)]
+            results = []
+            for source in [dataset, arrow_dataset]:
+                start = time.perf_counter()
+                outputs = [collator(source.__getitems__(indices)) for indices in batches]
+                results.append((num_batches / (time.perf_counter() - start), outputs))
+            (speed, outputs), (arrow_speed, arrow_outputs) = results
+            for output, arrow_output in zip(outputs, arrow_outputs):
+                assert all(torch.equal(output[key], arrow_output[key]) for key in output), "Batches differ"
+            print(
+                f"{padding_free!s:>12} {batch_size:>10} {speed:>19.1f} {arrow_speed:>16.1f} {arrow_speed / speed:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser(ScriptArguments)
+    script_args = parser.parse_args_into_dataclasses()[0]
+    main(script_args.num_examples, script_args.mean_length, script_args.batch_sizes, script_args.num_batches)
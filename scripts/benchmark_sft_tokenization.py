@@ -0,0 +1,118 @@
+# Copyright 2020-2025 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This script benchmarks the tokenization of the SFT dataset preprocessing, example by example (default) and by
+# batches (`batched_tokenization=True`), on synthetic data of each dataset type, reports the throughput in examples/sec,
+# and checks that both give the same input IDs and masks.
+
+import random
+import tempfile
+import time
+from dataclasses import dataclass, field
+
+from datasets import Dataset
+from transformers import HfArgumentParser
+
+from trl import SFTConfig, SFTTrainer
+
+
+@dataclass
+class ScriptArguments:
+    r"""
+    Arguments for the script.
+
+    Args:
+        model_name_or_path (`str`, *optional*, defaults to `"trl-internal-testing/tiny-Qwen2ForCausalLM-2.5"`):
+            Model whose tokenizer and chat template are used.
+        num_examples (`int`, *optional*, defaults to `20_000`):
+            Number of examples in the synthetic datasets.
+        num_words (`int`, *optional*, defaults to `100`):
+            Mean number of words of the prompts and completions.
+        dataset_types (`list[str]`, *optional*, defaults to `["standard_language_modeling", "standard_prompt_completion", "conversational_language_modeling", "conversational_prompt_completion"]`):
+            Dataset types to benchmark.
+    """
+
+    model_name_or_path: str = field(
+        default="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+        metadata={"help": "Model whose tokenizer and chat template are used."},
+    )
+    num_examples: int = field(default=20_000, metadata={"help": "Number of examples in the synthetic datasets."})
+    num_words: int = field(default=100, metadata={"help": "Mean number of words of the prompts and completions."})
+    dataset_types: list[str] = field(
+        default_factory=lambda: [
+            "standard_language_modeling",
+            "standard_prompt_completion",
+            "conversational_language_modeling",
+            "conversational_prompt_completion",
+        ],
+        metadata={"help": "Dataset types to benchmark."},
+    )
+
+
+WORDS = ["the", "sky", "is", "blue", "and", "water", "flows", "down", "to", "sea", "while", "birds", "sing", "42", "!"]
+
+
+def make_dataset(dataset_type: str, num_examples: int, num_words: int) -> Dataset:
+    rng = random.Random(42)
+
+    def sentence():
+        return " ".join(rng.choices(WORDS, k=rng.randint(1, 2 * num_words)))
+
+    prompts = [sentence() for _ in range(num_examples)]
+    completions = [" " + sentence() for _ in range(num_examples)]
+    if dataset_type == "standard_language_modeling":
+        return Dataset.from_dict({"text": [p + c for p, c in zip(prompts, completions)]})
+    elif dataset_type == "standard_prompt_completion":
+        return Dataset.from_dict({"prompt": prompts, "completion": completions})
+    elif dataset_type == "conversational_language_modeling":
+        messages = [
+            [{"role": "user", "content": p}, {"role": "assistant", "content": c}] for p, c in zip(prompts, completions)
+        ]
+        return Dataset.from_dict({"messages": messages})
+    elif dataset_type == "conversational_prompt_completion":
+        return Dataset.from_dict(
+            {
+                "prompt": [[{"role": "user", "content": p}] for p in prompts],
+                "completion": [[{"role": "assistant", "content": c}] for c in completions],
+            }
+        )
+    raise ValueError(f"Unknown dataset type: {dataset_type}")
+
+
+def main(model_name_or_path, num_examples, num_words, dataset_types):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        args = SFTConfig(output_dir=tmp_dir, max_length=None, bf16=False, report_to="none")
+        trainer = SFTTrainer(model=model_name_or_path, args=args, train_dataset=make_dataset(dataset_types[0], 1, 1))
+        tokenizer = trainer.processing_class
+
+        print(f"{'dataset type':>34} {'per example (ex/s)':>19} {'batched (ex/s)':>15} {'speedup':>8}")
+        for dataset_type in dataset_types:
+            dataset = make_dataset(dataset_type, num_examples, num_words)
+            results = []
+            for batched in [False, True]:
+                args = SFTConfig(
+                    output_dir=tmp_dir, max_length=None, batched_tokenization=batched, bf16=False, report_to="none"
+                )
+                start = time.perf_counter()
+                processed = trainer._prepare_dataset(dataset, tokenizer, args, False, None, "train")
+                results.append((num_examples / (time.perf_counter() - start), processed.to_dict()))
+            (speed, processed), (batched_speed, batched_processed) = results
+            assert processed == batched_processed, f"Batched tokenization differs for {dataset_type}"
+            print(f"{dataset_type:>34} {speed:>19.0f} {batched_speed:>15.0f} {batched_speed / speed:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser(ScriptArguments)
+    script_args = parser.parse_args_into_dataclasses()[0]
+    main(script_args.model_name_or_path, script_args.num_examples, script_args.num_words, script_args.dataset_types)
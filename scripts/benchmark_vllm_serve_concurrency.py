@@ -0,0 +1,175 @@
+# Copyright 2020-2025 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This script load-tests how `trl vllm-serve` handles concurrent generation requests, against stand-in data parallel
+# workers that don't need vLLM nor GPUs: each worker runs `serve_worker` on an engine whose `generate` sleeps for
+# `step_time` per decoding step, regardless of the number of prompts, like a memory-bound decoding. Several clients send
+# requests at the same time, either with blocking pipe calls on the event loop (used previously), or through
+# `WorkerDispatcher`, which keeps the event loop free and lets the workers batch the waiting requests. It reports the
+# number of requests per second, and the worst latency of health checks running on the same event loop.
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from multiprocessing import Pipe, Process
+
+from transformers import HfArgumentParser
+
+from trl.scripts.vllm_serve import WorkerDispatcher, serve_worker
+
+
+@dataclass
+class ScriptArguments:
+    r"""
+    Arguments for the script.
+
+    Args:
+        num_clients (`list[int]`, *optional*, defaults to `[1, 4, 16]`):
+            Numbers of concurrent clients.
+        num_requests_per_client (`int`, *optional*, defaults to `4`):
+            Number of requests sent by each client, one after the other.
+        num_prompts (`int`, *optional*, defaults to `8`):
+            Number of prompts per request.
+        max_tokens (`int`, *optional*, defaults to `32`):
+            Number of decoding steps of each request.
+        step_time (`float`, *optional*, defaults to `0.005`):
+            Time of a decoding step of the stand-in engine, in seconds.
+        data_parallel_size (`int`, *optional*, defaults to `2`):
+            Number of stand-in data parallel workers.
+    """
+
+    num_clients: list[int] = field(
+        default_factory=lambda: [1, 4, 16], metadata={"help": "Numbers of concurrent clients."}
+    )
+    num_requests_per_client: int = field(
+        default=4, metadata={"help": "Number of requests sent by each client, one after the other."}
+    )
+    num_prompts: int = field(default=8, metadata={"help": "Number of prompts per request."})
+    max_tokens: int = field(default=32, metadata={"help": "Number of decoding steps of each request."})
+    step_time: float = field(
+        default=0.005, metadata={"help": "Time of a decoding step of the stand-in engine, in seconds."}
+    )
+    data_parallel_size: int = field(default=2, metadata={"help": "Number of stand-in data parallel workers."})
+
+
+class StandInEngine:
+    def __init__(self, step_time):
+        self.step_time = step_time
+
+    def generate(self, prompts, sampling_params):
+        if not isinstance(sampling_params, list):
+            sampling_params = [sampling_params] * len(prompts)
+        # A batch takes as many decoding steps as its longest completion
+        time.sleep(self.step_time * max(sampling_params))
+        return [list(prompt) for prompt in prompts]
+
+
+def stand_in_worker(step_time, connection):
+    serve_worker(StandInEngine(step_time), connection)
+
+
+async def load_test(call_workers, num_clients, num_requests_per_client, num_prompts, max_tokens):
+    health_latencies = []
+    done = asyncio.Event()
+
+    async def health_check():
+        # A health check arrives every 5 ms, and is answered as soon as the event loop gets to it
+        while not done.is_set():
+            arrival = time.perf_counter() + 0.005
+            await asyncio.sleep(0.005)
+            health_latencies.append(max(time.perf_counter() - arrival, 0.0))
+
+    async def client(client_id):
+        for request_id in range(num_requests_per_client):
+            prompts = [[client_id, request_id, prompt_id] for prompt_id in range(num_prompts)]
+            outputs = await call_workers(prompts, max_tokens)
+            assert outputs == prompts
+
+    health_task = asyncio.create_task(health_check())
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    await asyncio.gather(*(client(client_id) for client_id in range(num_clients)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await health_task
+    return num_clients * num_requests_per_client / elapsed, max(health_latencies)
+
+
+def start_workers(step_time, data_parallel_size):
+    connections, processes = [], []
+    for _ in range(data_parallel_size):
+        connection, worker_connection = Pipe()
+        process = Process(target=stand_in_worker, args=(step_time, worker_connection), daemon=True)
+        process.start()
+        connections.append(connection)
+        processes.append(process)
+    return connections, processes
+
+
+def main(num_clients, num_requests_per_client, num_prompts, max_tokens, step_time, data_parallel_size):
+    def split(prompts):
+        size = -(-len(prompts) // data_parallel_size)
+        return [prompts[i : i + size] for i in range(0, len(prompts), size)]
+
+    # Each mode gets its own workers, since the dispatchers keep reading from their connections
+    connections, blocking_processes = start_workers(step_time, data_parallel_size)
+    dispatcher_connections, dispatcher_processes = start_workers(step_time, data_parallel_size)
+    dispatchers = [WorkerDispatcher(connection) for connection in dispatcher_connections]
+
+    async def call_blocking(prompts, max_tokens):
+        # Blocking sends and receives in the event loop, one request at a time
+        for request_id, (connection, chunk) in enumerate(zip(connections, split(prompts))):
+            kwargs = {"prompts": chunk, "sampling_params": max_tokens}
+            connection.send({"type": "call", "request_id": request_id, "method": "generate", "kwargs": kwargs})
+        return [output for connection in connections for output in connection.recv()["result"]]
+
+    async def call_dispatcher(prompts, max_tokens):
+        outputs = await asyncio.gather(
+            *(
+                dispatcher.call("generate", kwargs={"prompts": chunk, "sampling_params": max_tokens})
+                for dispatcher, chunk in zip(dispatchers, split(prompts))
+            )
+        )
+        return [output for chunk_outputs in outputs for output in chunk_outputs]
+
+    print(f"{'clients':>7} {'blocking (req/s)':>17} {'dispatcher (req/s)':>19} {'speedup':>8} {'blocking health (ms)':>21} {'dispatcher health (ms)':>23}")  # fmt: skip
+    for n in num_clients:
+        args = (n, num_requests_per_client, num_prompts, max_tokens)
+        blocking_throughput, blocking_latency = asyncio.run(load_test(call_blocking, *args))
+        dispatcher_throughput, dispatcher_latency = asyncio.run(load_test(call_dispatcher, *args))
+        print(
+            f"{n:>7} {blocking_throughput:>17.1f} {dispatcher_throughput:>19.1f} "
+            f"{dispatcher_throughput / blocking_throughput:>7.1f}x {blocking_latency * 1000:>21.0f} "
+            f"{dispatcher_latency * 1000:>23.1f}"
+        )
+
+    for connection in connections:
+        connection.send({"type": "shutdown"})
+    for dispatcher in dispatchers:
+        dispatcher.shutdown()
+    for process in blocking_processes + dispatcher_processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser(ScriptArguments)
+    script_args = parser.parse_args_into_dataclasses()[0]
+    main(
+        script_args.num_clients,
+        script_args.num_requests_per_client,
+        script_args.num_prompts,
+        script_args.max_tokens,
+        script_args.step_time,
+        script_args.data_parallel_size,
+    )
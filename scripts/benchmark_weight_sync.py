@@ -0,0 +1,137 @@
+# Copyright 2020-2025 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This script benchmarks full-model weight syncs with a vLLM server, as done by the GRPO trainer after each update:
+# one request and one broadcast per parameter (`VLLMClient.update_named_param`, used previously), against parameters
+# packed into contiguous buckets of several sizes (`VLLMClient.update_named_params`), for each weight transport: NCCL
+# broadcasts and shared memory files (`VLLMClient(weight_transport=...)`). It reports the time per sync and the number
+# of requests. Start the server first, on other GPUs of the same node:
+#
+#     CUDA_VISIBLE_DEVICES=1 trl vllm-serve --model Qwen/Qwen2.5-7B
+#
+# then run the script with the same model:
+#
+#     CUDA_VISIBLE_DEVICES=0 python scripts/benchmark_weight_sync.py --model_name_or_path Qwen/Qwen2.5-7B
+#
+# Without GPUs on the client side, the model is loaded on the CPU, and only the shared memory transport can be used:
+#
+#     python scripts/benchmark_weight_sync.py --model_name_or_path Qwen/Qwen2.5-7B --weight_transports shm
+
+import time
+from dataclasses import dataclass, field
+
+import torch
+from transformers import AutoModelForCausalLM, HfArgumentParser
+
+from trl.extras.vllm_client import VLLMClient
+
+
+@dataclass
+class ScriptArguments:
+    r"""
+    Arguments for the script.
+
+    Args:
+        model_name_or_path (`str`, *optional*, defaults to `"Qwen/Qwen2.5-7B"`):
+            Model served by the vLLM server.
+        bucket_sizes_mb (`list[float]`, *optional*, defaults to `[32, 128, 512, 2048]`):
+            Sizes of the buckets, in megabytes.
+        weight_transports (`list[str]`, *optional*, defaults to `["nccl", "shm"]`):
+            Weight transports to benchmark.
+        num_repeats (`int`, *optional*, defaults to `3`):
+            Number of syncs timed for each configuration.
+        server_port (`int`, *optional*, defaults to `8000`):
+            Port of the vLLM server.
+    """
+
+    model_name_or_path: str = field(default="Qwen/Qwen2.5-7B", metadata={"help": "Model served by the vLLM server."})
+    bucket_sizes_mb: list[float] = field(
+        default_factory=lambda: [32, 128, 512, 2048], metadata={"help": "Sizes of the buckets, in megabytes."}
+    )
+    weight_transports: list[str] = field(
+        default_factory=lambda: ["nccl", "shm"], metadata={"help": "Weight transports to benchmark."}
+    )
+    num_repeats: int = field(default=3, metadata={"help": "Number of syncs timed for each configuration."})
+    server_port: int = field(default=8000, metadata={"help": "Port of the vLLM server."})
+
+
+def timeit(fn, num_repeats):
+    fn()  # warmup
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_repeats):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_repeats
+
+
+def benchmark_transport(named_params, model_size, bucket_sizes_mb, weight_transport, num_repeats, server_port):
+    client = VLLMClient(server_port=server_port, connection_timeout=240, weight_transport=weight_transport)
+    client.init_communicator()
+
+    # Count the requests sent to the server
+    num_requests = 0
+    post = client.session.post
+
+    def counting_post(*args, **kwargs):
+        nonlocal num_requests
+        num_requests += 1
+        return post(*args, **kwargs)
+
+    client.session.post = counting_post
+
+    def per_param_sync():
+        for name, weights in named_params:
+            client.update_named_param(name, weights)
+
+    print(f"Transport: {weight_transport}")
+    print(f"{'bucket (MB)':>11} {'requests':>9} {'sync (s)':>9} {'GB/s':>6} {'speedup':>8}")
+    configs = [("per param", per_param_sync)] + [
+        (f"{size:g}", lambda size=size: client.update_named_params(named_params, bucket_size_mb=size))
+        for size in bucket_sizes_mb
+    ]
+    baseline = None
+    for label, sync in configs:
+        num_requests = 0
+        sync_time = timeit(sync, num_repeats)
+        requests_per_sync = num_requests // (num_repeats + 1)
+        baseline = baseline or sync_time
+        throughput = model_size / 1024**3 / sync_time
+        print(f"{label:>11} {requests_per_sync:>9} {sync_time:>9.3f} {throughput:>6.1f} {baseline / sync_time:>7.1f}x")
+
+    client.close_communicator()
+
+
+def main(model_name_or_path, bucket_sizes_mb, weight_transports, num_repeats, server_port):
+    device_map = "cuda" if torch.cuda.is_available() else "cpu"
+    model = AutoModelForCausalLM.from_pretrained(model_name_or_path, torch_dtype=torch.bfloat16, device_map=device_map)
+    named_params = [(name, param.data) for name, param in model.named_parameters()]
+    model_size = sum(param.numel() * param.element_size() for _, param in named_params)
+    print(f"Model size: {model_size / 1024**3:.2f} GB, {len(named_params)} parameters")
+    for weight_transport in weight_transports:
+        benchmark_transport(named_params, model_size, bucket_sizes_mb, weight_transport, num_repeats, server_port)
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser(ScriptArguments)
+    script_args = parser.parse_args_into_dataclasses()[0]
+    main(
+        script_args.model_name_or_path,
+        script_args.bucket_sizes_mb,
+        script_args.weight_transports,
+        script_args.num_repeats,
+        script_args.server_port,
+    )
@@ -13,25 +13,36 @@
 # limitations under the License.
 
 import itertools
+import pickle
+import tempfile
 import unittest
 
+import numpy as np
+import pyarrow as pa
 from datasets import Dataset, DatasetDict
 from parameterized import parameterized
 from transformers import AutoProcessor, AutoTokenizer
 
 from trl.data_utils import (
+    TokenShardDataset,
+    _bfd_bin_assignment,
     apply_chat_template,
     extract_prompt,
     is_conversational,
     is_conversational_from_value,
     maybe_apply_chat_template,
+    maybe_apply_chat_template_dataset,
     maybe_convert_to_chatml,
+    maybe_convert_to_chatml_dataset,
     maybe_extract_prompt,
+    maybe_extract_prompt_dataset,
     maybe_unpair_preference_dataset,
     pack_dataset,
+    save_token_shard,
     truncate_dataset,
     unpair_preference_dataset,
 )
+from trl.trainer.sft_trainer import remove_none_values
 
 
 class IsConversationalTester(unittest.TestCase):
@@ -227,6 +238,18 @@ class ApplyChatTemplateTester(unittest.TestCase):
             self.assertIsInstance(result["label"], bool)
             self.assertEqual(result["label"], example["label"])
 
+    @parameterized.expand(itertools.product(tokenizers, conversational_examples + non_conversational_examples))
+    def test_maybe_apply_chat_template_dataset(self, tokenizer_id, example):
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_id)
+        dataset = Dataset.from_list([example, example])
+        expected = dataset.map(maybe_apply_chat_template, fn_kwargs={"tokenizer": tokenizer})
+
+        result = maybe_apply_chat_template_dataset(dataset, tokenizer)
+
+        # The batched version should give the same dataset as the per-example version
+        self.assertEqual(result.column_names, expected.column_names)
+        self.assertEqual(result.to_dict(), expected.to_dict())
+
     def test_apply_chat_template_with_tools(self):
         tokenizer = AutoProcessor.from_pretrained("trl-internal-testing/tiny-LlamaForCausalLM-3.2")
 
@@ -413,6 +436,35 @@ class ExtractPromptTester(unittest.TestCase):
             "The prompt is not correctly extracted from the dataset.",
         )
 
+    @parameterized.expand(
+        [
+            ("example_implicit_prompt_conversational",),
+            ("example_explicit_prompt_conversational",),
+            ("example_implicit_prompt_standard",),
+            ("example_explicit_prompt_standard",),
+        ]
+    )
+    def test_maybe_extract_prompt_dataset(self, example_name):
+        example = getattr(self, example_name)
+        # Add an example without shared prompt and an example with a shared completion, to cover the edge cases
+        other_example = {key: value[:1] if isinstance(value, list) else value[::-1] for key, value in example.items()}
+        dataset = Dataset.from_list([example, other_example, example]).add_column("id", [0, 1, 2])
+        expected = dataset.map(maybe_extract_prompt)
+
+        result = maybe_extract_prompt_dataset(dataset)
+
+        # The batched version should give the same dataset as the per-example version
+        self.assertEqual(result.column_names, expected.column_names)
+        self.assertEqual(result.to_dict(), expected.to_dict())
+
+    def test_maybe_extract_prompt_dataset_iterable(self):
+        dataset = Dataset.from_list([self.example_implicit_prompt_conversational] * 3)
+        expected = dataset.map(maybe_extract_prompt)
+
+        result = maybe_extract_prompt_dataset(dataset.to_iterable_dataset())
+
+        self.assertEqual(list(result), expected.to_list())
+
     def test_maybe_extract_prompt_standard_already_explicit(self):
         # Test that the prompt remains unchanged with maybe_extract_prompt
         example_extracted_prompt = maybe_extract_prompt(self.example_explicit_prompt_standard)
@@ -453,6 +505,25 @@ class TestPackDatasetWrapped(unittest.TestCase):
         num_examples = len(examples[next(iter(examples))])
         self.assertEqual(next(iter(dataset.batch(batch_size=num_examples))), expected_output)
 
+    def test_with_iterable_dataset_carry_over(self):
+        # With a buffer of 1 sequence, the incomplete last chunk alone fills the buffer, and is carried over until the
+        # dataset is exhausted
+        examples = {"input_ids": [[1, 2, 3], [4, 5, 6, 7], [8, 9], [10]]}
+        dataset = Dataset.from_dict(examples).to_iterable_dataset()
+        expected_output = {"input_ids": [[1, 2, 3, 4, 5, 6, 7, 8, 9, 10]]}
+        dataset = pack_dataset(dataset, seq_length=16, strategy="wrapped", buffer_size=1)
+        self.assertEqual(next(iter(dataset.batch(batch_size=4))), expected_output)
+
+        dataset = Dataset.from_dict(examples).to_iterable_dataset()
+        expected_output = {"input_ids": [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]]}
+        dataset = pack_dataset(dataset, seq_length=4, strategy="wrapped", buffer_size=1)
+        self.assertEqual(next(iter(dataset.batch(batch_size=4))), expected_output)
+
+    def test_invalid_buffer_size(self):
+        dataset = Dataset.from_dict({"input_ids": [[1, 2, 3]]}).to_iterable_dataset()
+        with self.assertRaises(ValueError):
+            pack_dataset(dataset, seq_length=4, strategy="wrapped", buffer_size=0)
+
 
 class TestPackDatasetBfd(unittest.TestCase):
     def test_simple(self):
@@ -486,6 +557,17 @@ class TestPackDatasetBfd(unittest.TestCase):
         num_examples = len(examples[next(iter(examples))])
         self.assertEqual(next(iter(dataset.batch(batch_size=num_examples))), expected_output)
 
+    def test_with_iterable_dataset_carry_over(self):
+        # With a buffer of 3 sequences, [5, 6] can still receive data after the first buffer, so it's carried over
+        examples = {"input_ids": [[1, 2, 3, 4], [5, 6], [7, 8, 9, 10], [11, 12]]}
+        dataset = Dataset.from_dict(examples).to_iterable_dataset()
+        expected_output = {
+            "input_ids": [[1, 2, 3, 4], [7, 8, 9, 10], [5, 6, 11, 12]],
+            "seq_lengths": [[4], [4], [2, 2]],
+        }
+        dataset = pack_dataset(dataset, seq_length=4, strategy="bfd", buffer_size=3)
+        self.assertEqual(next(iter(dataset.batch(batch_size=3))), expected_output)
+
     def test_with_truncation(self):
         examples = {
             "input_ids": [[1, 2, 3, 4, 5], [6, 7], [8, 9, 10, 11], [12]],
@@ -502,6 +584,82 @@ class TestPackDatasetBfd(unittest.TestCase):
         self.assertEqual(dataset.to_dict(), expected_output)
 
 
+class TestPackDatasetGlobal(unittest.TestCase):
+    examples = {
+        "input_ids": [[1, 2, 3], [4, 5, 6, 7], [8]],
+        "attention_mask": [[0, 1, 1], [0, 0, 1, 1], [1]],
+    }
+
+    def test_per_batch_packing(self):
+        # Reference: without global packing, each map batch leaves its own partially filled sequence
+        dataset = Dataset.from_dict(self.examples)
+        expected_output = {
+            "input_ids": [[4, 5, 6, 7], [1, 2, 3], [8]],
+            "attention_mask": [[0, 0, 1, 1], [0, 1, 1], [1]],
+            "seq_lengths": [[4], [3], [1]],
+        }
+        dataset = pack_dataset(dataset, seq_length=4, strategy="bfd", map_kwargs={"batch_size": 2})
+        self.assertEqual(dataset.to_dict(), expected_output)
+
+    def test_global_packing(self):
+        dataset = Dataset.from_dict(self.examples)
+        expected_output = {
+            "input_ids": [[4, 5, 6, 7], [1, 2, 3, 8]],
+            "attention_mask": [[0, 0, 1, 1], [0, 1, 1, 1]],
+            "seq_lengths": [[4], [3, 1]],
+        }
+        dataset = pack_dataset(
+            dataset, seq_length=4, strategy="bfd", map_kwargs={"batch_size": 2}, global_packing=True
+        )
+        self.assertEqual(dataset.to_dict(), expected_output)
+
+    def test_global_packing_with_window(self):
+        dataset = Dataset.from_dict(self.examples)
+        expected_output = {
+            "input_ids": [[4, 5, 6, 7], [1, 2, 3, 8]],
+            "attention_mask": [[0, 0, 1, 1], [0, 1, 1, 1]],
+            "seq_lengths": [[4], [3, 1]],
+        }
+        dataset = pack_dataset(dataset, seq_length=4, strategy="bfd", global_packing=True, window_size=2)
+        self.assertEqual(dataset.to_dict(), expected_output)
+
+    def test_window_without_global_packing(self):
+        dataset = Dataset.from_dict(self.examples)
+        with self.assertRaises(ValueError):
+            pack_dataset(dataset, seq_length=4, strategy="bfd", window_size=2)
+        with self.assertRaises(ValueError):
+            pack_dataset(dataset, seq_length=4, strategy="wrapped", global_packing=True, window_size=2)
+
+    def test_global_packing_wrapped(self):
+        dataset = Dataset.from_dict(self.examples)
+        expected_output = {
+            "input_ids": [[1, 2, 3], [4, 5, 6], [7, 8]],
+            "attention_mask": [[0, 1, 1], [0, 0, 1], [1, 1]],
+        }
+        dataset = pack_dataset(
+            dataset, seq_length=3, strategy="wrapped", map_kwargs={"batch_size": 2}, global_packing=True
+        )
+        self.assertEqual(dataset.to_dict(), expected_output)
+
+
+class TestBfdBinAssignment(unittest.TestCase):
+    def test_runs_of_equal_lengths(self):
+        lengths = np.array([2, 2, 2, 2, 2, 3, 3])
+        order, bin_sizes = _bfd_bin_assignment(lengths, seq_length=8)
+        np.testing.assert_array_equal(order, [5, 6, 0, 1, 2, 3, 4])
+        np.testing.assert_array_equal(bin_sizes, [3, 4])
+
+    def test_valid_packing(self):
+        rng = np.random.default_rng(0)
+        for seq_length in [7, 64, 100]:
+            lengths = rng.integers(1, seq_length + 1, size=1000)
+            order, bin_sizes = _bfd_bin_assignment(lengths, seq_length)
+            np.testing.assert_array_equal(np.sort(order), np.arange(len(lengths)))
+            bin_lengths = np.add.reduceat(lengths[order], np.cumsum(bin_sizes) - bin_sizes)
+            self.assertTrue(np.all(bin_lengths <= seq_length))
+            self.assertEqual(len(bin_sizes), len(bin_lengths))
+
+
 class TestTruncateExamples(unittest.TestCase):
     def test_with_dataset(self):
         examples = {
@@ -549,6 +707,55 @@ class TestTruncateExamples(unittest.TestCase):
         self.assertEqual(dataset.to_dict(), expected_output)
 
 
+class TestTokenShard(unittest.TestCase):
+    def test_round_trip(self):
+        examples = {
+            "input_ids": [[1, 2, 3], [4, 5, 6, 7], [8]],
+            "completion_mask": [[0, 1, 1], [0, 0, 1, 1], [1]],
+            "my_column": ["a", "b", "c"],
+        }
+        dataset = Dataset.from_dict(examples)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            save_token_shard(dataset, tmp_dir, batch_size=2)
+            shard = TokenShardDataset(tmp_dir)
+            self.assertEqual(len(shard), 3)
+            self.assertEqual(shard.column_names, ["input_ids", "completion_mask"])
+            self.assertEqual(shard.lengths.tolist(), [3, 4, 1])
+            for idx in range(3):
+                self.assertEqual(shard[idx]["input_ids"].tolist(), examples["input_ids"][idx])
+                self.assertEqual(shard[idx]["completion_mask"].tolist(), examples["completion_mask"][idx])
+            self.assertEqual(shard[-1]["input_ids"].tolist(), [8])
+            with self.assertRaises(IndexError):
+                shard[3]
+
+    def test_packed(self):
+        examples = {
+            "input_ids": [[1, 2, 3, 4], [5, 6, 7, 8], [9]],
+            "seq_lengths": [[4], [1, 3], [1]],
+        }
+        dataset = Dataset.from_dict(examples).to_iterable_dataset()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            save_token_shard(dataset, tmp_dir, batch_size=2)
+            shard = TokenShardDataset(tmp_dir)
+            self.assertEqual(shard.column_names, ["input_ids", "seq_lengths"])
+            for idx in range(3):
+                self.assertEqual(shard[idx]["input_ids"].tolist(), examples["input_ids"][idx])
+                self.assertEqual(shard[idx]["seq_lengths"].tolist(), examples["seq_lengths"][idx])
+
+    def test_pickle(self):
+        dataset = Dataset.from_dict({"input_ids": [[1, 2, 3], [4, 5]]})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            save_token_shard(dataset, tmp_dir)
+            shard = pickle.loads(pickle.dumps(TokenShardDataset(tmp_dir)))
+            self.assertEqual(shard[1]["input_ids"].tolist(), [4, 5])
+
+    def test_token_id_overflow(self):
+        dataset = Dataset.from_dict({"input_ids": [[1, 2**32]]})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with self.assertRaises(pa.ArrowInvalid):
+                save_token_shard(dataset, tmp_dir)
+
+
 class TestMaybeConvertToChatML(unittest.TestCase):
     def test_with_conversations_key(self):
         # Particular case where the key is "conversations": we rename it to "messages"
@@ -593,6 +800,40 @@ class TestMaybeConvertToChatML(unittest.TestCase):
         }
         self.assertEqual(maybe_convert_to_chatml(example), example)
 
+    @parameterized.expand(
+        [
+            ("conversations", ["from", "value"]),
+            ("messages", ["from", "value"]),
+            ("messages", ["value", "weight", "from"]),
+            ("messages", ["role", "content"]),
+            ("prompt", ["from", "value"]),
+        ]
+    )
+    def test_maybe_convert_to_chatml_dataset(self, column, keys):
+        values = {"from": "user", "role": "user", "value": "What color is the sky?", "content": "Where is the sun?"}
+        messages = [[{key: values.get(key, 1.0) for key in keys}], [{key: values.get(key, 0.5) for key in keys}]]
+        dataset = Dataset.from_dict({"id": [0, 1], column: messages})
+        expected = dataset.map(maybe_convert_to_chatml)
+
+        result = maybe_convert_to_chatml_dataset(dataset)
+
+        # The batched version should give the same dataset as the per-example version
+        self.assertEqual(result.column_names, expected.column_names)
+        self.assertEqual(result.to_dict(), expected.to_dict())
+
+    def test_maybe_convert_to_chatml_dataset_keeps_transform(self):
+        # Arrow fills the keys missing from some messages with `None`, which the transform removes
+        messages = [
+            [{"from": "user", "value": "What color is the sky?", "weight": 1.0}],
+            [{"from": "user", "value": "Where is the sun?"}],
+        ]
+        dataset = Dataset.from_dict({"conversations": messages}).with_transform(remove_none_values)
+
+        result = maybe_convert_to_chatml_dataset(dataset)
+
+        self.assertEqual(result[0]["messages"], [{"role": "user", "content": "What color is the sky?", "weight": 1.0}])
+        self.assertEqual(result[1]["messages"], [{"role": "user", "content": "Where is the sun?"}])
+
 
 # Run the tests
 if __name__ == "__main__":
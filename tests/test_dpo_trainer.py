@@ -207,6 +207,44 @@ class DPOTrainerTester(unittest.TestCase):
                 if param.sum() != 0:  # ignore 0 biases
                     self.assertFalse(torch.allclose(param, new_param, rtol=1e-12, atol=1e-12))
 
+    def test_train_with_max_tokens_per_batch(self):
+        model_id = "trl-internal-testing/tiny-Qwen2ForCausalLM-2.5"
+        dataset = load_dataset("trl-internal-testing/zen", "standard_preference", split="train")
+        tokenizer = AutoTokenizer.from_pretrained(model_id)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = DPOConfig(
+                output_dir=tmp_dir,
+                max_tokens_per_batch=128,
+                length_bucket_size=8,
+                gradient_accumulation_steps=2,
+                learning_rate=9e-1,
+                logging_steps=1,
+                report_to="none",
+            )
+            trainer = DPOTrainer(
+                model=model_id,
+                args=training_args,
+                processing_class=tokenizer,
+                train_dataset=dataset,
+            )
+
+            # Check that the batches hold a variable number of examples
+            batches = list(trainer.get_train_dataloader())
+            self.assertGreater(len({len(batch["prompt_input_ids"]) for batch in batches}), 1)
+
+            previous_trainable_params = {n: param.clone() for n, param in trainer.model.named_parameters()}
+
+            trainer.train()
+
+            self.assertIsNotNone(trainer.state.log_history[-1]["train_loss"])
+            self.assertIn("tokens_per_step", trainer.state.log_history[0])
+
+            # Check that the parameters have changed
+            for n, param in previous_trainable_params.items():
+                new_param = trainer.model.get_parameter(n)
+                if param.sum() != 0:  # ignore 0 biases
+                    self.assertFalse(torch.allclose(param, new_param, rtol=1e-12, atol=1e-12))
+
     @parameterized.expand(
         [
             ("sigmoid",),
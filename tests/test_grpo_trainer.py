@@ -31,10 +31,12 @@ from transformers.utils import is_peft_available
 from trl import GRPOConfig, GRPOTrainer
 from trl.trainer.grpo_trainer import (
     RepeatSampler,
+    _LookaheadIterator,
     get_high_entropy_mask,
     shuffle_sequence_dict,
     split_pixel_values_by_grid,
     split_tensor_dict,
+    trim_padding_columns,
     truncate_with_protected_tokens,
     unsplit_pixel_values_by_grid,
 )
@@ -139,6 +141,42 @@ class ShuffleSequenceDictTester(unittest.TestCase):
                 self.fail("Unexpected x row in shuffled output.")
 
 
+class TrimPaddingColumnsTester(unittest.TestCase):
+    def test_trim_prompt_and_completion_padding(self):
+        batch = {
+            "prompt_ids": torch.tensor([[0, 0, 1], [0, 2, 3]]),
+            "prompt_mask": torch.tensor([[0, 0, 1], [0, 1, 1]]),
+            "completion_ids": torch.tensor([[4, 0, 0], [5, 6, 0]]),
+            "completion_mask": torch.tensor([[1, 0, 0], [1, 1, 0]]),
+            "old_per_token_logps": torch.tensor([[-1.0, 0.0, 0.0], [-2.0, -3.0, 0.0]]),
+            "advantages": torch.tensor([1.0, -1.0]),
+        }
+
+        result = trim_padding_columns(batch)
+
+        self.assertTrue(torch.equal(result["prompt_ids"], torch.tensor([[0, 1], [2, 3]])))
+        self.assertTrue(torch.equal(result["prompt_mask"], torch.tensor([[0, 1], [1, 1]])))
+        self.assertTrue(torch.equal(result["completion_ids"], torch.tensor([[4, 0], [5, 6]])))
+        self.assertTrue(torch.equal(result["completion_mask"], torch.tensor([[1, 0], [1, 1]])))
+        self.assertTrue(torch.equal(result["old_per_token_logps"], torch.tensor([[-1.0, 0.0], [-2.0, -3.0]])))
+        self.assertTrue(torch.equal(result["advantages"], batch["advantages"]))
+
+    def test_keeps_one_completion_column(self):
+        batch = {
+            "prompt_ids": torch.tensor([[1, 2]]),
+            "prompt_mask": torch.tensor([[1, 1]]),
+            "completion_ids": torch.tensor([[0, 0]]),
+            "completion_mask": torch.tensor([[0, 0]]),
+            "ref_per_token_logps": None,
+        }
+
+        result = trim_padding_columns(batch)
+
+        self.assertEqual(result["prompt_ids"].shape, (1, 2))
+        self.assertEqual(result["completion_ids"].shape, (1, 1))
+        self.assertIsNone(result["ref_per_token_logps"])
+
+
 class RepeatRandomSamplerTester(unittest.TestCase):
     def test_sampler(self):
         dataset = ["a", "b", "c", "d", "e", "f", "g"]
@@ -494,6 +532,32 @@ class UnsplitPixelValuesByGridTester(unittest.TestCase):
         self.assertTrue(torch.equal(result["pixel_values"], original))
 
 
+class LookaheadIteratorTester(unittest.TestCase):
+    def test_iterates_like_the_wrapped_iterator(self):
+        iterator = _LookaheadIterator(iter(range(5)))
+        self.assertEqual(iterator.peek(2), 2)
+        self.assertEqual(list(iterator), [0, 1, 2, 3, 4])
+
+    def test_peek_relative_to_next_item_to_use(self):
+        iterator = _LookaheadIterator(iter(range(10)))
+        taken = [next(iterator) for _ in range(3)]  # e.g., the batches of a gradient accumulation cycle
+        self.assertEqual(taken, [0, 1, 2])
+        self.assertEqual(iterator.peek(0), 0)
+        self.assertEqual(iterator.peek(2), 2)  # already taken
+        self.assertEqual(iterator.peek(4), 4)  # not taken yet
+        iterator.mark_used()
+        iterator.mark_used()
+        self.assertEqual(iterator.peek(0), 2)
+        self.assertEqual(iterator.peek(4), 6)
+        # Peeking doesn't change the iteration
+        self.assertEqual(next(iterator), 3)
+
+    def test_peek_past_the_end(self):
+        iterator = _LookaheadIterator(iter(range(3)))
+        self.assertIsNone(iterator.peek(3))
+        self.assertEqual(list(iterator), [0, 1, 2])
+
+
 class GRPOTrainerTester(unittest.TestCase):
     def test_init_minimal(self):
         # Test that GRPOTrainer can be instantiated with only model, reward_model and train_dataset
@@ -1086,6 +1150,287 @@ class GRPOTrainerTester(unittest.TestCase):
                 new_param = trainer.model.get_parameter(n)
                 self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
 
+    def test_training_dynamic_sampling(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        def reward_func(prompts, completions, **kwargs):
+            # Same reward for all completions of half of the prompts, to get groups with zero reward std
+            return [
+                0.0 if len(prompt) % 2 else float(len(completion)) for prompt, completion in zip(prompts, completions)
+            ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                dynamic_sampling=True,
+                learning_rate=0.1,  # increase the learning rate to speed up the test
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                max_completion_length=8,  # reduce the completion length to reduce memory usage
+                report_to="none",
+            )
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs=reward_func,
+                args=training_args,
+                train_dataset=dataset,
+            )
+
+            previous_trainable_params = {n: param.clone() for n, param in trainer.model.named_parameters()}
+
+            trainer.train()
+
+            self.assertIsNotNone(trainer.state.log_history[-1]["train_loss"])
+            self.assertIn("dynamic_sampling/effective_batch_size", trainer.state.log_history[0])
+            self.assertIn("dynamic_sampling/wasted_generations", trainer.state.log_history[0])
+
+            # Check that the params have changed
+            for n, param in previous_trainable_params.items():
+                new_param = trainer.model.get_parameter(n)
+                self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
+
+    def test_dynamic_sampling_requires_whole_groups_per_device(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with self.assertRaises(ValueError):
+                GRPOConfig(
+                    output_dir=tmp_dir,
+                    dynamic_sampling=True,
+                    per_device_train_batch_size=2,
+                    steps_per_generation=3,
+                    num_generations=4,
+                    report_to="none",
+                )
+
+    @parameterized.expand([("grpo",), ("bnpo",), ("dr_grpo",)])
+    def test_training_skip_zero_advantages(self, loss_type):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        def reward_func(prompts, completions, **kwargs):
+            # Same reward for all completions of half of the prompts, to get samples with zero advantage
+            return [
+                0.0 if len(prompt) % 2 else float(len(completion)) for prompt, completion in zip(prompts, completions)
+            ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                skip_zero_advantages=True,
+                loss_type=loss_type,
+                learning_rate=0.1,  # increase the learning rate to speed up the test
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                max_completion_length=8,  # reduce the completion length to reduce memory usage
+                gradient_accumulation_steps=2,
+                report_to="none",
+            )
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs=reward_func,
+                args=training_args,
+                train_dataset=dataset,
+            )
+
+            previous_trainable_params = {n: param.clone() for n, param in trainer.model.named_parameters()}
+
+            trainer.train()
+
+            self.assertIsNotNone(trainer.state.log_history[-1]["train_loss"])
+            self.assertIn("skip_zero_advantages/skipped_ratio", trainer.state.log_history[0])
+            self.assertIn("skip_zero_advantages/flops_saved", trainer.state.log_history[0])
+
+            # Check that the params have changed
+            for n, param in previous_trainable_params.items():
+                new_param = trainer.model.get_parameter(n)
+                self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
+
+    def test_skip_zero_advantages_requires_zero_beta(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with self.assertRaises(ValueError):
+                GRPOConfig(output_dir=tmp_dir, skip_zero_advantages=True, beta=0.1, report_to="none")
+
+    def test_training_bucket_by_length(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                bucket_by_length=True,
+                learning_rate=0.1,  # increase the learning rate to speed up the test
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                max_completion_length=8,  # reduce the completion length to reduce memory usage
+                gradient_accumulation_steps=2,
+                report_to="none",
+            )
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                args=training_args,
+                train_dataset=dataset,
+            )
+
+            previous_trainable_params = {n: param.clone() for n, param in trainer.model.named_parameters()}
+
+            trainer.train()
+
+            self.assertIsNotNone(trainer.state.log_history[-1]["train_loss"])
+            log = trainer.state.log_history[0]
+            self.assertLessEqual(
+                log["bucket_by_length/padding_ratio_after"], log["bucket_by_length/padding_ratio_before"]
+            )
+
+            # Check that the params have changed
+            for n, param in previous_trainable_params.items():
+                new_param = trainer.model.get_parameter(n)
+                self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
+
+    def test_training_shared_prompt_forward(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                beta=0.1,  # set beta to non-zero value to use the reference model
+                steps_per_generation=2,  # misalign generation and optimization steps to compute the old logps
+                shared_prompt_forward=True,
+                learning_rate=0.1,  # increase the learning rate to speed up the test
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                max_completion_length=8,  # reduce the completion length to reduce memory usage
+                report_to="none",
+            )
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                args=training_args,
+                train_dataset=dataset,
+            )
+
+            previous_trainable_params = {n: param.clone() for n, param in trainer.model.named_parameters()}
+
+            trainer.train()
+
+            self.assertIsNotNone(trainer.state.log_history[-1]["train_loss"])
+
+            # Check that the params have changed
+            for n, param in previous_trainable_params.items():
+                new_param = trainer.model.get_parameter(n)
+                self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
+
+    def test_shared_prompt_forward_parity(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(output_dir=tmp_dir, report_to="none")
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                args=training_args,
+                train_dataset=dataset,
+            )
+            tokenizer = trainer.processing_class
+            tokenizer.padding_side = "left"
+
+            # Left-padded prompts, each repeated several times, followed by right-padded completions
+            prompts = tokenizer(
+                ["The sky is", "Hi", "The sky is", "Hi", "Water flows", "The sky is"],
+                return_tensors="pt",
+                padding=True,
+            )
+            completion_ids = torch.randint(0, 100, (6, 5))
+            completion_mask = torch.ones(6, 5, dtype=torch.long)
+            completion_mask[1, 3:] = 0
+            completion_mask[4, 1:] = 0
+            input_ids = torch.cat([prompts["input_ids"], completion_ids], dim=1).to(trainer.model.device)
+            attention_mask = torch.cat([prompts["attention_mask"], completion_mask], dim=1).to(trainer.model.device)
+
+            for training in [False, True]:
+                trainer.model.train(training)
+                outputs = []
+                for shared_prompt_forward in [False, True]:
+                    trainer.args.shared_prompt_forward = shared_prompt_forward
+                    outputs.append(
+                        trainer._get_per_token_logps_and_entropies(
+                            trainer.model, input_ids, attention_mask, 5, batch_size=4, compute_entropy=True
+                        )
+                    )
+                (logps, entropies), (shared_logps, shared_entropies) = outputs
+                torch.testing.assert_close(shared_logps, logps)
+                torch.testing.assert_close(shared_entropies, entropies)
+
+    def test_training_padding_free(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                padding_free=True,
+                beta=0.1,  # set beta to non-zero value to test the case where the reference model is used
+                learning_rate=0.1,  # increase the learning rate to speed up the test
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                max_completion_length=8,  # reduce the completion length to reduce memory usage
+                steps_per_generation=2,  # compute the old log-probabilities too
+                report_to="none",
+            )
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                args=training_args,
+                train_dataset=dataset,
+            )
+
+            previous_trainable_params = {n: param.clone() for n, param in trainer.model.named_parameters()}
+
+            trainer.train()
+
+            self.assertIsNotNone(trainer.state.log_history[-1]["train_loss"])
+
+            # Check that the params have changed
+            for n, param in previous_trainable_params.items():
+                new_param = trainer.model.get_parameter(n)
+                self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
+
+    def test_padding_free_parity(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(output_dir=tmp_dir, report_to="none")
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                args=training_args,
+                train_dataset=dataset,
+            )
+            tokenizer = trainer.processing_class
+            tokenizer.padding_side = "left"
+
+            # Left-padded prompts followed by right-padded completions of variable lengths
+            prompts = tokenizer(
+                ["The sky is", "Hi", "The sky is", "Hi", "Water flows", "The sky is"],
+                return_tensors="pt",
+                padding=True,
+            )
+            completion_ids = torch.randint(0, 100, (6, 5))
+            completion_mask = torch.ones(6, 5, dtype=torch.long)
+            completion_mask[1, 3:] = 0
+            completion_mask[4, 1:] = 0
+            input_ids = torch.cat([prompts["input_ids"], completion_ids], dim=1).to(trainer.model.device)
+            attention_mask = torch.cat([prompts["attention_mask"], completion_mask], dim=1).to(trainer.model.device)
+            completion_mask = completion_mask.bool().to(trainer.model.device)
+
+            for training in [False, True]:
+                trainer.model.train(training)
+                outputs = []
+                for padding_free in [False, True]:
+                    trainer.args.padding_free = padding_free
+                    outputs.append(
+                        trainer._get_per_token_logps_and_entropies(
+                            trainer.model, input_ids, attention_mask, 5, batch_size=4, compute_entropy=True
+                        )
+                    )
+                (logps, entropies), (padding_free_logps, padding_free_entropies) = outputs
+                # Only the completion tokens are compared, the padding positions differ
+                torch.testing.assert_close(padding_free_logps[completion_mask], logps[completion_mask])
+                torch.testing.assert_close(padding_free_entropies[completion_mask], entropies[completion_mask])
+
     def test_training_with_entropy_filter(self):
         dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
         with tempfile.TemporaryDirectory() as tmp_dir:
@@ -1164,6 +1509,55 @@ class GRPOTrainerTester(unittest.TestCase):
                     # We expect the peft params to be different (except for the base layer)
                     self.assertFalse(torch.allclose(param, new_param), f"Parameter {n} has not changed.")
 
+    @require_vllm
+    @unittest.skip("We should add a mock for the vLLM server.")
+    def test_training_vllm_async_generation(self):
+        """Test that training works with vLLM generating the next generation batch while training."""
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                learning_rate=0.1,  # increase the learning rate to speed up the test
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                max_completion_length=8,  # reduce the completion length to reduce memory usage
+                logging_steps=1,
+                report_to="none",
+                use_vllm=True,
+                async_generation=True,
+            )
+            trainer = GRPOTrainer(
+                model="Qwen/Qwen2.5-0.5B-Instruct",  # tiny model is too small for vLLM
+                reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                args=training_args,
+                train_dataset=dataset,
+            )
+
+            previous_trainable_params = {n: param.clone() for n, param in trainer.model.named_parameters()}
+
+            trainer.train()
+
+            self.assertIsNotNone(trainer.state.log_history[-1]["train_loss"])
+            self.assertIn("async/overlap", trainer.state.log_history[-2])
+
+            # Check that the params have changed
+            for n, param in previous_trainable_params.items():
+                new_param = trainer.model.get_parameter(n)
+                self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
+
+    def test_async_generation_requires_vllm_server(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with self.assertRaises(ValueError):
+                GRPOConfig(output_dir=tmp_dir, async_generation=True, report_to="none")
+
+    def test_vllm_logprobs_requires_unit_temperature(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with self.assertRaises(ValueError):
+                GRPOConfig(
+                    output_dir=tmp_dir, use_vllm=True, use_vllm_logprobs=True, temperature=0.7, report_to="none"
+                )
+
     @require_vllm
     @unittest.skip("We should add a mock for the vLLM server.")
     def test_training_vllm_guided_decoding(self):
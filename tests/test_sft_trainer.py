@@ -233,6 +233,34 @@ class TestDataCollatorForLanguageModeling(unittest.TestCase):
         torch.testing.assert_close(result["position_ids"], torch.tensor([[0, 1, 2], [0, 1, 0]]))
         torch.testing.assert_close(result["labels"], torch.tensor([[-100, 2, 3], [-100, 5, -100]]))
 
+    @parameterized.expand(
+        [
+            ({},),
+            ({"padding_free": True},),
+            ({"pad_to_multiple_of": 4},),
+            ({"completion_only_loss": False},),
+            ({"return_position_ids": False},),
+        ]
+    )
+    def test_arrow_batch(self, collator_kwargs):
+        """Test that a batch given as an Arrow table is collated like the list of its examples."""
+        collator = DataCollatorForLanguageModeling(pad_token_id=0, **collator_kwargs)
+        examples = {
+            "input_ids": [[1, 2, 3], [4, 5], [6, 7, 8, 9]],
+            "completion_mask": [[0, 1, 1], [0, 1], [0, 0, 1, 1]],
+            "assistant_masks": [[1, 1, 1], [0, 1], [1, 1, 1, 0]],
+            "seq_lengths": [[1, 2], [2], [4]],
+        }
+        for columns in [["input_ids"], ["input_ids", "completion_mask", "assistant_masks"], list(examples)]:
+            dataset = Dataset.from_dict({column: examples[column] for column in columns})
+            expected = collator(dataset.__getitems__([2, 0, 1]))
+
+            result = collator(dataset.with_format("arrow")[[2, 0, 1]])
+
+            self.assertEqual(result.keys(), expected.keys())
+            for key in expected:
+                torch.testing.assert_close(result[key], expected[key])
+
 
 class SFTTrainerTester(unittest.TestCase):
     r""" """
@@ -946,6 +974,144 @@ class SFTTrainerTester2(unittest.TestCase):
                 new_param = trainer.model.get_parameter(n)
                 self.assertFalse(torch.allclose(param, new_param), f"Parameter {n} has not changed")
 
+    def test_train_arrow_collation(self):
+        # Get the dataset
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_completion", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Initialize the trainer
+            training_args = SFTConfig(output_dir=tmp_dir, arrow_collation=True, report_to="none")
+            trainer = SFTTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5", args=training_args, train_dataset=dataset
+            )
+
+            # Save the initial parameters to compare them later
+            previous_trainable_params = {n: param.clone() for n, param in trainer.model.named_parameters()}
+
+            # Train the model
+            trainer.train()
+
+            # Check that the training loss is not None
+            self.assertIsNotNone(trainer.state.log_history[-1]["train_loss"])
+
+            # Check the params have changed
+            for n, param in previous_trainable_params.items():
+                new_param = trainer.model.get_parameter(n)
+                self.assertFalse(torch.allclose(param, new_param), f"Parameter {n} has not changed")
+
+    def test_train_with_max_tokens_per_batch(self):
+        # Get the dataset
+        dataset = load_dataset("trl-internal-testing/zen", "standard_language_modeling", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Initialize the trainer
+            training_args = SFTConfig(
+                output_dir=tmp_dir,
+                max_tokens_per_batch=64,
+                length_bucket_size=8,
+                gradient_accumulation_steps=2,
+                logging_steps=1,
+                report_to="none",
+            )
+            trainer = SFTTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5", args=training_args, train_dataset=dataset
+            )
+
+            # Check that the batches hold a variable number of examples within the token budget
+            batches = list(trainer.get_train_dataloader())
+            self.assertGreater(len({len(batch["input_ids"]) for batch in batches}), 1)
+            for batch in batches:
+                self.assertLessEqual(batch["input_ids"].numel(), 64)
+
+            # Save the initial parameters to compare them later
+            previous_trainable_params = {n: param.clone() for n, param in trainer.model.named_parameters()}
+
+            # Train the model
+            trainer.train()
+
+            # Check that the training loss is not None and the tokens per step are logged
+            self.assertIsNotNone(trainer.state.log_history[-1]["train_loss"])
+            self.assertIn("tokens_per_step", trainer.state.log_history[0])
+
+            # Check the params have changed
+            for n, param in previous_trainable_params.items():
+                new_param = trainer.model.get_parameter(n)
+                self.assertFalse(torch.allclose(param, new_param), f"Parameter {n} has not changed")
+
+    def test_max_tokens_per_batch_with_iterable_dataset(self):
+        # Get the dataset
+        dataset = load_dataset("trl-internal-testing/zen", "standard_language_modeling", split="train", streaming=True)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Initialize the trainer
+            training_args = SFTConfig(output_dir=tmp_dir, max_steps=3, max_tokens_per_batch=64, report_to="none")
+            trainer = SFTTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5", args=training_args, train_dataset=dataset
+            )
+
+            # Check that the token budget is rejected before the dataset is iterated
+            with self.assertRaisesRegex(ValueError, "iterable dataset"):
+                trainer.get_train_dataloader()
+
+    def test_dataset_cache(self):
+        # Get the dataset
+        dataset = load_dataset("trl-internal-testing/zen", "standard_language_modeling", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_dir = pathlib.Path(tmp_dir) / "dataset_cache"
+            training_args = SFTConfig(
+                output_dir=tmp_dir, dataset_cache_dir=str(cache_dir), packing=True, max_length=10, report_to="none"
+            )
+
+            # First run: the dataset is preprocessed and saved to the cache
+            trainer = SFTTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5", args=training_args, train_dataset=dataset
+            )
+            self.assertEqual(len(list(cache_dir.iterdir())), 1)
+
+            # Second run: the dataset is loaded from the cache
+            cached_trainer = SFTTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5", args=training_args, train_dataset=dataset
+            )
+            self.assertEqual(len(list(cache_dir.iterdir())), 1)
+            self.assertEqual(cached_trainer.train_dataset.to_dict(), trainer.train_dataset.to_dict())
+
+            # Changing a preprocessing parameter results in a new cache entry
+            training_args.max_length = 12
+            SFTTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5", args=training_args, train_dataset=dataset
+            )
+            self.assertEqual(len(list(cache_dir.iterdir())), 2)
+
+    @parameterized.expand(
+        [
+            ("standard_language_modeling", "trl-internal-testing/tiny-Qwen2ForCausalLM-2.5", False),
+            ("standard_prompt_completion", "trl-internal-testing/tiny-Qwen2ForCausalLM-2.5", False),
+            ("conversational_language_modeling", "trl-internal-testing/tiny-Qwen2ForCausalLM-2.5", False),
+            ("conversational_prompt_completion", "trl-internal-testing/tiny-Qwen2ForCausalLM-2.5", False),
+            ("conversational_language_modeling", "trl-internal-testing/tiny-Qwen3ForCausalLM", True),
+            ("conversational_prompt_completion", "trl-internal-testing/tiny-Qwen3ForCausalLM", True),
+        ]
+    )
+    def test_batched_tokenization(self, config_name, model_id, assistant_only_loss):
+        # Get the dataset
+        dataset = load_dataset("trl-internal-testing/zen", config_name, split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = SFTConfig(output_dir=tmp_dir, assistant_only_loss=assistant_only_loss, report_to="none")
+            trainer = SFTTrainer(model=model_id, args=training_args, train_dataset=dataset)
+
+            training_args = SFTConfig(
+                output_dir=tmp_dir,
+                assistant_only_loss=assistant_only_loss,
+                batched_tokenization=True,
+                report_to="none",
+            )
+            batched_trainer = SFTTrainer(model=model_id, args=training_args, train_dataset=dataset)
+
+            # Check that the batched tokenization gives the same input IDs and masks
+            self.assertEqual(batched_trainer.train_dataset.to_dict(), trainer.train_dataset.to_dict())
+
     def test_train_with_chat_template_kwargs(self):
         # Get the dataset
         dataset = load_dataset("trl-internal-testing/zen", "standard_language_modeling", split="train")
@@ -12,7 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import tempfile
 import textwrap
+import time
 import unittest
 from io import StringIO
 from unittest.mock import patch
@@ -29,13 +32,18 @@ from trl import ModelConfig
 from trl.trainer import compute_accuracy
 from trl.trainer.utils import (
     DataCollatorForChatML,
+    MetricsAccumulator,
+    TokenBudgetBatchSampler,
     batch_generation,
     decode_and_strip_padding,
     entropy_from_logits,
+    evict_dataset_cache,
     flush_left,
     flush_right,
     generate_model_card,
     get_peft_config,
+    hash_processing_class,
+    masked_tolist,
     pad,
     print_prompt_completions_sample,
     selective_log_softmax,
@@ -131,6 +139,52 @@ class TestPad(unittest.TestCase):
         expected = torch.tensor([[1, 2, 3, 4], [5, 6, 7, 8]])
         self.assertTrue(torch.equal(output, expected))
 
+    def test_pad_1_dim_empty_sequence(self):
+        x = torch.tensor([1, 2])
+        y = torch.tensor([], dtype=torch.long)
+        output = pad((x, y), padding_value=0, padding_side="left")
+        expected = torch.tensor([[1, 2], [0, 0]])
+        self.assertTrue(torch.equal(output, expected))
+
+    def test_pad_1_dim_dtype(self):
+        x = torch.tensor([True, False])
+        y = torch.tensor([True])
+        output = pad((x, y), padding_value=False, padding_side="right")
+        expected = torch.tensor([[True, False], [True, False]])
+        self.assertTrue(torch.equal(output, expected))
+
+    def test_pad_1_dim_gradient(self):
+        x = torch.tensor([1.0, 2.0, 3.0], requires_grad=True)
+        output = pad((x, x[:1]), padding_value=0.0, padding_side="left")
+        output.sum().backward()
+        self.assertTrue(torch.equal(x.grad, torch.tensor([2.0, 1.0, 1.0])))
+
+    @parameterized.expand(
+        [
+            ("left", None),
+            ("right", None),
+            ("left", 8),
+            ("right", 8),
+        ]
+    )
+    def test_pad_1_dim_matches_multidim(self, padding_side, pad_to_multiple_of):
+        # 1D tensors are padded with a single scatter, 2D tensors with a copy per tensor: both must agree
+        generator = torch.Generator().manual_seed(42)
+        lengths = torch.randint(0, 20, (64,), generator=generator).tolist()
+        tensors = [torch.randint(1, 100, (length,), generator=generator) for length in lengths]
+        output = pad(tensors, padding_value=-1, padding_side=padding_side, pad_to_multiple_of=pad_to_multiple_of)
+        expected = pad(
+            [t.unsqueeze(1) for t in tensors],
+            padding_value=-1,
+            padding_side=padding_side,
+            pad_to_multiple_of=pad_to_multiple_of,
+        ).squeeze(2)
+        self.assertTrue(torch.equal(output, expected))
+
+    def test_pad_invalid_padding_side(self):
+        with self.assertRaises(ValueError):
+            pad((torch.tensor([1, 2]),), padding_side="middle")
+
 
 @require_peft
 class TestGetPEFTConfig(unittest.TestCase):
@@ -493,6 +547,108 @@ class TestFlushLeft(unittest.TestCase):
         self.assertTrue(torch.equal(new_mask, expected_mask))
 
 
+class TestEvictDatasetCache(unittest.TestCase):
+    def _make_entry(self, cache_dir, name, size, mtime):
+        path = os.path.join(cache_dir, name)
+        os.makedirs(path)
+        with open(os.path.join(path, "data.arrow"), "wb") as f:
+            f.write(b"0" * size)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_evicts_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            now = time.time()
+            oldest = self._make_entry(cache_dir, "a", 100, now - 30)
+            middle = self._make_entry(cache_dir, "b", 100, now - 20)
+            newest = self._make_entry(cache_dir, "c", 100, now - 10)
+            removed = evict_dataset_cache(cache_dir, max_size=250)
+            self.assertEqual(removed, [oldest])
+            self.assertFalse(os.path.exists(oldest))
+            self.assertTrue(os.path.exists(middle))
+            self.assertTrue(os.path.exists(newest))
+
+    def test_no_eviction_under_limit(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self._make_entry(cache_dir, "a", 100, time.time())
+            self.assertEqual(evict_dataset_cache(cache_dir, max_size=100), [])
+
+
+class TestTokenBudgetBatchSampler(unittest.TestCase):
+    def test_padded_budget(self):
+        sampler = TokenBudgetBatchSampler([5, 1, 3, 8, 2, 2], max_tokens=8, shuffle=False)
+        self.assertEqual(list(sampler), [[0], [1, 2], [3], [4, 5]])
+        self.assertEqual(len(sampler), 4)
+
+    def test_padding_free_budget(self):
+        sampler = TokenBudgetBatchSampler([5, 1, 3, 8, 2, 2], max_tokens=8, shuffle=False, padding_free=True)
+        self.assertEqual(list(sampler), [[0, 1], [2], [3], [4, 5]])
+
+    def test_multiple_components(self):
+        # Components are padded separately: 2 * (max(2, 1) + max(3, 1)) = 10
+        sampler = TokenBudgetBatchSampler([[2, 3], [1, 1], [4, 0]], max_tokens=10, shuffle=False)
+        self.assertEqual(list(sampler), [[0, 1], [2]])
+
+    def test_budget_and_coverage(self):
+        lengths = np.random.default_rng(0).integers(1, 100, size=1000)
+        sampler = TokenBudgetBatchSampler(lengths, max_tokens=512, bucket_size=100, seed=0)
+        batches = list(sampler)
+        self.assertEqual(sorted(idx for batch in batches for idx in batch), list(range(1000)))
+        for batch in batches:
+            self.assertLessEqual(len(batch) * lengths[batch].max(), 512)
+
+    def test_bucketing_reduces_padding(self):
+        lengths = np.random.default_rng(0).integers(1, 100, size=1000)
+
+        def num_padded_tokens(sampler):
+            return sum(len(batch) * lengths[batch].max() for batch in sampler)
+
+        unbucketed = TokenBudgetBatchSampler(lengths, max_tokens=512, seed=0)
+        bucketed = TokenBudgetBatchSampler(lengths, max_tokens=512, bucket_size=100, seed=0)
+        self.assertLess(num_padded_tokens(bucketed), num_padded_tokens(unbucketed))
+
+    def test_epochs_and_replicas(self):
+        sampler = TokenBudgetBatchSampler(list(range(1, 50)), max_tokens=100, num_replicas=4, seed=0)
+        sampler.set_epoch(0)
+        first_epoch = list(sampler)
+        sampler.set_epoch(0)
+        self.assertEqual(list(sampler), first_epoch)  # same epoch, same batches
+        sampler.set_epoch(1)
+        self.assertNotEqual(list(sampler), first_epoch)
+        self.assertEqual(len(first_epoch) % 4, 0)
+
+    def test_len_matches_epoch(self):
+        # With shuffling, the number of batches varies from epoch to epoch
+        lengths = np.random.default_rng(0).integers(1, 100, size=200)
+        sampler = TokenBudgetBatchSampler(lengths, max_tokens=512, bucket_size=50, seed=0)
+        num_batches = []
+        for _ in range(2):
+            expected_len = len(sampler)
+            batches = iter(sampler)
+            first_batch = next(batches)
+            self.assertEqual(len(sampler), expected_len)  # mid-epoch
+            num_batches.append(len([first_batch, *batches]))
+            self.assertEqual(num_batches[-1], expected_len)
+        self.assertNotEqual(num_batches[0], num_batches[1])
+
+    def test_example_longer_than_budget(self):
+        sampler = TokenBudgetBatchSampler([20, 3, 3], max_tokens=8, shuffle=False)
+        self.assertEqual(list(sampler), [[0], [1, 2]])
+
+
+class TestHashProcessingClass(unittest.TestCase):
+    def test_stable_across_loads(self):
+        tokenizer_1 = AutoTokenizer.from_pretrained("trl-internal-testing/tiny-Qwen2ForCausalLM-2.5")
+        tokenizer_2 = AutoTokenizer.from_pretrained("trl-internal-testing/tiny-Qwen2ForCausalLM-2.5")
+        self.assertEqual(hash_processing_class(tokenizer_1), hash_processing_class(tokenizer_2))
+
+    def test_chat_template_changes_hash(self):
+        tokenizer = AutoTokenizer.from_pretrained("trl-internal-testing/tiny-Qwen2ForCausalLM-2.5")
+        original_hash = hash_processing_class(tokenizer)
+        tokenizer.chat_template = "{{ messages[0]['content'] }}"
+        self.assertNotEqual(hash_processing_class(tokenizer), original_hash)
+
+
 class TestFlushRight(unittest.TestCase):
     def test_basic_case(self):
         mask = torch.tensor([[1, 1, 1, 0, 0], [0, 0, 1, 1, 0]])
@@ -537,6 +693,98 @@ class TestFlushRight(unittest.TestCase):
         self.assertTrue(torch.equal(new_mask, expected_mask))
 
 
+class TestMaskedTolist(unittest.TestCase):
+    def test_basic_case(self):
+        tensor = torch.tensor([[1, 2, 3, 0], [4, 5, 6, 7], [8, 0, 0, 0]])
+        mask = torch.tensor([[1, 1, 1, 0], [1, 1, 1, 1], [1, 0, 0, 0]])
+        self.assertEqual(masked_tolist(tensor, mask), [[1, 2, 3], [4, 5, 6, 7], [8]])
+
+    def test_empty_rows(self):
+        tensor = torch.tensor([[1, 2], [3, 4], [5, 6]])
+        mask = torch.tensor([[0, 0], [1, 1], [0, 0]])
+        self.assertEqual(masked_tolist(tensor, mask), [[], [3, 4], []])
+
+    def test_non_contiguous_mask(self):
+        tensor = torch.tensor([[1, 2, 3, 4], [5, 6, 7, 8]])
+        mask = torch.tensor([[0, 1, 0, 1], [1, 0, 1, 0]])
+        self.assertEqual(masked_tolist(tensor, mask), [[2, 4], [5, 7]])
+
+    def test_matches_per_element_loop(self):
+        tensor = torch.randint(0, 1000, (8, 16))
+        mask = torch.randint(0, 2, (8, 16))
+        expected = [[x.item() for x, m in zip(row, mask_row) if m] for row, mask_row in zip(tensor, mask)]
+        self.assertEqual(masked_tolist(tensor, mask), expected)
+
+
+class TestMetricsAccumulator(unittest.TestCase):
+    def test_average_over_steps(self):
+        metrics = MetricsAccumulator()
+        for value in [1.0, 2.0, 4.5]:
+            metrics.add("loss", torch.tensor(value))
+        metrics.add("accuracy", 0.5)
+        self.assertEqual(metrics.compute(), {"loss": 2.5, "accuracy": 0.5})
+
+    def test_matches_list_average(self):
+        values = torch.rand(10, dtype=torch.float32)
+        metrics = MetricsAccumulator()
+        for value in values:
+            metrics.add("value", value)
+        expected = sum(value.item() for value in values) / len(values)
+        self.assertEqual(metrics.compute()["value"], expected)
+
+    def test_set(self):
+        metrics = MetricsAccumulator()
+        metrics.set("num_tokens", 10)
+        metrics.add("loss", torch.tensor(1.0))
+        metrics.set("num_tokens", 20)
+        self.assertEqual(metrics.compute(), {"num_tokens": 20, "loss": 1.0})
+
+    @parameterized.expand(["mean", "nanmean", "min", "max", "nanmin", "nanmax", "sum", "none"])
+    def test_reductions_single_process(self, reduction):
+        # With a single process, reducing across processes is the identity
+        metrics = MetricsAccumulator()
+        metrics.add("value", torch.tensor(3, dtype=torch.int64), reduction=reduction)
+        metrics.add("value", torch.tensor(2.0, dtype=torch.bfloat16), reduction=reduction)
+        self.assertEqual(metrics.compute(), {"value": 2.5})
+
+    def test_reductions_across_processes(self):
+        # Values of 2 steps on 3 processes, as gathered
+        values = torch.tensor([[1.0, float("nan")], [2.0, 4.0], [6.0, float("nan")]])
+        expected = {
+            "mean": float("nan"),
+            "nanmean": (3.0 + 4.0) / 2,
+            "min": float("nan"),
+            "nanmin": (1.0 + 4.0) / 2,
+            "nanmax": (6.0 + 4.0) / 2,
+            "sum": float("nan"),
+            "none": float("nan"),
+        }
+        for reduction, expected_value in expected.items():
+            reduced = MetricsAccumulator._REDUCTIONS[reduction](values.double()).mean().item()
+            torch.testing.assert_close(reduced, expected_value, equal_nan=True, msg=reduction)
+
+    def test_nan_reductions_all_nan(self):
+        values = torch.full((2, 1), float("nan"))
+        for reduction in ["nanmean", "nanmin", "nanmax"]:
+            self.assertTrue(MetricsAccumulator._REDUCTIONS[reduction](values).isnan().all())
+
+    def test_clear(self):
+        metrics = MetricsAccumulator()
+        metrics.add("loss", torch.tensor(1.0))
+        self.assertEqual(len(metrics), 1)
+        metrics.clear()
+        self.assertEqual(len(metrics), 0)
+        self.assertEqual(metrics.compute(), {})
+
+    def test_invalid_reduction(self):
+        metrics = MetricsAccumulator()
+        with self.assertRaises(ValueError):
+            metrics.add("loss", torch.tensor(1.0), reduction="median")
+        metrics.add("loss", torch.tensor(1.0))
+        with self.assertRaises(ValueError):
+            metrics.add("loss", torch.tensor(1.0), reduction="max")
+
+
 class TestSelectiveLogSoftmax(unittest.TestCase):
     @parameterized.expand([(torch.float64,), (torch.float32,), (torch.float16,), (torch.bfloat16,)])
     def test_selective_log_softmax(self, dtype):
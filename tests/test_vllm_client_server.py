@@ -12,18 +12,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import os
 import signal
 import subprocess
+import threading
 import unittest
+from multiprocessing import Pipe
+from types import SimpleNamespace
 
+import numpy as np
 import psutil
 import pytest
+import torch
 from transformers import AutoModelForCausalLM
-from transformers.testing_utils import require_torch_multi_accelerator, torch_device
-
-from trl.extras.vllm_client import VLLMClient
-from trl.scripts.vllm_serve import chunk_list
+from transformers.testing_utils import require_torch_accelerator, require_torch_multi_accelerator, torch_device
+
+from trl.extras.vllm_client import VLLMClient, decode_completions, encode_completions
+from trl.extras.weight_transport import SharedMemoryWeightTransport
+from trl.scripts.vllm_serve import (
+    WeightSyncWorkerExtension,
+    WorkerDispatcher,
+    balance_by_cost,
+    chunk_list,
+    serve_worker,
+)
 
 from .testing_utils import require_3_accelerators
 
@@ -54,6 +67,214 @@ class TestChunkList(unittest.TestCase):
         )
 
 
+class TestBalanceByCost(unittest.TestCase):
+    def test_one_costly_item(self):
+        self.assertEqual(balance_by_cost([5, 1, 1, 1, 1, 1], 2), [[0], [1, 2, 3, 4, 5]])
+
+    def test_even_costs(self):
+        self.assertEqual(balance_by_cost([1, 1, 1, 1, 1, 1], 2), [[0, 2, 4], [1, 3, 5]])
+
+    def test_sorted_costs(self):
+        # Splitting sorted costs in consecutive chunks would give total costs of 6 and 15
+        chunks = balance_by_cost([1, 2, 3, 4, 5, 6], 2)
+        self.assertEqual(sorted(sum(i + 1 for i in chunk) for chunk in chunks), [10, 11])
+
+    def test_more_chunks_than_elements(self):
+        self.assertEqual(balance_by_cost([1, 2], 3), [[1], [0], []])
+
+    def test_empty(self):
+        self.assertEqual(balance_by_cost([], 2), [[], []])
+
+    def test_all_indices_assigned_once(self):
+        costs = [7, 3, 9, 1, 4, 4, 8, 2, 6]
+        chunks = balance_by_cost(costs, 4)
+        self.assertEqual(sorted(index for chunk in chunks for index in chunk), list(range(len(costs))))
+        for chunk in chunks:
+            self.assertEqual(chunk, sorted(chunk))
+
+
+class StandInEngine:
+    # Stand-in for `vllm.LLM`, recording the calls
+    def __init__(self):
+        self.calls = []
+
+    def generate(self, prompts, sampling_params):
+        self.calls.append(("generate", list(prompts)))
+        if not isinstance(sampling_params, list):
+            sampling_params = [sampling_params] * len(prompts)
+        return [f"{prompt}-{params}" for prompt, params in zip(prompts, sampling_params)]
+
+    def collective_rpc(self, method, args=()):
+        self.calls.append((method, args))
+        return [None]
+
+    def fail(self):
+        raise ValueError("Stand-in failure")
+
+
+class TestServeWorker(unittest.TestCase):
+    def run_worker(self, commands):
+        # Queue the commands before the worker starts, so that it finds them all waiting
+        engine = StandInEngine()
+        connection, worker_connection = Pipe()
+        for command in commands + [{"type": "shutdown"}]:
+            connection.send(command)
+        serve_worker(engine, worker_connection)
+        replies = []
+        while connection.poll():
+            replies.append(connection.recv())
+        return engine, replies
+
+    def test_batches_waiting_generate_requests(self):
+        engine, replies = self.run_worker(
+            [
+                {"type": "call", "request_id": 0, "method": "generate", "kwargs": {"prompts": ["a", "b"], "sampling_params": 1}},
+                {"type": "call", "request_id": 1, "method": "generate", "kwargs": {"prompts": ["c"], "sampling_params": 2}},
+            ]
+        )  # fmt: skip
+        self.assertEqual(engine.calls, [("generate", ["a", "b", "c"])])
+        self.assertEqual(replies, [{"request_id": 0, "result": ["a-1", "b-1"]}, {"request_id": 1, "result": ["c-2"]}])
+
+    def test_keeps_command_order(self):
+        # The weight update must run between the two generations
+        engine, replies = self.run_worker(
+            [
+                {"type": "call", "request_id": 0, "method": "generate", "kwargs": {"prompts": ["a"], "sampling_params": 1}},
+                {"type": "fire_and_forget", "request_id": 1, "method": "collective_rpc", "kwargs": {"method": "update"}},
+                {"type": "call", "request_id": 2, "method": "generate", "kwargs": {"prompts": ["b"], "sampling_params": 1}},
+            ]
+        )  # fmt: skip
+        self.assertEqual(engine.calls, [("generate", ["a"]), ("update", ()), ("generate", ["b"])])
+        self.assertEqual([reply["request_id"] for reply in replies], [0, 2])
+
+    def test_reports_errors(self):
+        _, replies = self.run_worker([{"type": "call", "request_id": 0, "method": "fail"}])
+        self.assertEqual(replies, [{"request_id": 0, "error": "ValueError: Stand-in failure"}])
+
+
+class TestWorkerDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.engine = StandInEngine()
+        connection, worker_connection = Pipe()
+        self.worker = threading.Thread(target=serve_worker, args=(self.engine, worker_connection))
+        self.worker.start()
+        self.dispatcher = WorkerDispatcher(connection)
+
+    def tearDown(self):
+        self.dispatcher.shutdown()
+        self.worker.join(timeout=10)
+
+    def test_concurrent_calls(self):
+        async def generate_all():
+            return await asyncio.gather(
+                *(
+                    self.dispatcher.call("generate", kwargs={"prompts": [f"p{i}"], "sampling_params": i})
+                    for i in range(8)
+                )
+            )
+
+        results = asyncio.run(generate_all())
+        self.assertEqual(results, [[f"p{i}-{i}"] for i in range(8)])
+        # All the prompts were generated, possibly in batches
+        self.assertEqual(sorted(p for _, prompts in self.engine.calls for p in prompts), [f"p{i}" for i in range(8)])
+
+    def test_error(self):
+        with self.assertRaisesRegex(RuntimeError, "Stand-in failure"):
+            asyncio.run(self.dispatcher.call("fail"))
+
+    def test_send(self):
+        self.dispatcher.send("collective_rpc", kwargs={"method": "update"})
+        asyncio.run(self.dispatcher.call("collective_rpc", kwargs={"method": "sync"}))
+        self.assertEqual(self.engine.calls, [("update", ()), ("sync", ())])
+
+
+class TestEncodeCompletions(unittest.TestCase):
+    def test_round_trip(self):
+        completion_ids = [[1, 2, 3], [151643], [], [4, 5]]
+        decoded_ids, decoded_logprobs = decode_completions(encode_completions(completion_ids))
+        self.assertEqual([ids.tolist() for ids in decoded_ids], completion_ids)
+        self.assertTrue(all(ids.dtype == np.int32 for ids in decoded_ids))
+        self.assertIsNone(decoded_logprobs)
+
+    def test_round_trip_with_logprobs(self):
+        completion_ids = [[1, 2, 3], [], [4, 5]]
+        logprobs = [[-0.5, -1.25, -0.0], [], [-2.0, -0.125]]
+        decoded_ids, decoded_logprobs = decode_completions(encode_completions(completion_ids, logprobs))
+        self.assertEqual([ids.tolist() for ids in decoded_ids], completion_ids)
+        self.assertEqual([values.tolist() for values in decoded_logprobs], logprobs)
+        self.assertTrue(all(values.dtype == np.float32 for values in decoded_logprobs))
+
+    def test_no_completions(self):
+        self.assertEqual(decode_completions(encode_completions([])), ([], None))
+
+
+class TestSharedMemoryWeightTransport(unittest.TestCase):
+    def setUp(self):
+        self.client_transport = SharedMemoryWeightTransport()
+        self.worker_transport = SharedMemoryWeightTransport()
+        worker_kwargs = self.client_transport.get_worker_kwargs()
+        self.worker_transport.init_worker("0.0.0.0", 51216, 0, 2, torch.device("cpu"), **worker_kwargs)
+
+    def tearDown(self):
+        self.worker_transport.close_worker()
+        self.client_transport.close_client()
+
+    def test_send_receive(self):
+        # The second buffer grows the shared file, the third one is smaller than the file
+        for size in [100, 1000, 10]:
+            buffer = torch.randint(0, 256, (size,), dtype=torch.uint8)
+            received = []
+            self.client_transport.send(
+                buffer,
+                lambda received=received, size=size: received.append(self.worker_transport.receive(size).clone()),
+            )
+            self.assertEqual(len(received), 1)
+            torch.testing.assert_close(received[0], buffer)
+
+    def test_close_client_removes_file(self):
+        path = self.client_transport.path
+        self.assertTrue(os.path.exists(path))
+        self.client_transport.close_client()
+        self.assertFalse(os.path.exists(path))
+
+    def test_missing_file(self):
+        with self.assertRaises(FileNotFoundError):
+            SharedMemoryWeightTransport().init_worker("0.0.0.0", 51216, 0, 2, torch.device("cpu"), path="/nonexistent")
+
+    def test_worker_extension(self):
+        loaded_weights = []
+
+        def load_weights(weights):
+            # The received weights are views of the shared file, which is overwritten by the next update
+            loaded_weights.extend((name, weight.clone()) for name, weight in weights)
+
+        worker = WeightSyncWorkerExtension()
+        worker.model_runner = SimpleNamespace(model=SimpleNamespace(load_weights=load_weights))
+        worker.transport = self.worker_transport
+
+        # A single parameter
+        weight = torch.randn(3, 4, dtype=torch.bfloat16)
+        self.client_transport.send(
+            weight.view(-1).view(torch.uint8),
+            lambda: worker.update_named_param("weight", str(weight.dtype), tuple(weight.shape)),
+        )
+        # A bucket of two parameters, the second one at an aligned offset
+        bias, scale = torch.randn(5), torch.randn(2, dtype=torch.float16)
+        bucket = torch.zeros(36, dtype=torch.uint8)
+        bucket[:20] = bias.view(torch.uint8)
+        bucket[32:36] = scale.view(torch.uint8)
+        self.client_transport.send(
+            bucket,
+            lambda: worker.update_named_params(
+                ["bias", "scale"], ["torch.float32", "torch.float16"], [[5], [2]], [0, 32], 36
+            ),
+        )
+
+        self.assertEqual([name for name, _ in loaded_weights], ["weight", "bias", "scale"])
+        for (_, loaded), expected in zip(loaded_weights, [weight, bias, scale]):
+            torch.testing.assert_close(loaded, expected)
+
+
 @pytest.mark.slow
 @require_torch_multi_accelerator
 class TestVLLMClientServer(unittest.TestCase):
@@ -107,10 +328,53 @@ class TestVLLMClientServer(unittest.TestCase):
         for seq in outputs:
             self.assertLessEqual(len(seq), 32)
 
+    def test_generate_with_token_ids(self):
+        prompt_token_ids = [[9707, 11, 15235, 0], [40451, 752, 264, 21646]]
+        outputs = self.client.generate(prompt_token_ids=prompt_token_ids)
+
+        # Check that the number of generated sequences is equal to the number of prompts
+        self.assertEqual(len(outputs), len(prompt_token_ids))
+
+        # Check that the generated sequences are lists of integers
+        for seq in outputs:
+            self.assertTrue(all(isinstance(tok, int) for tok in seq))
+
+    def test_generate_with_logprobs(self):
+        prompts = ["Hello, AI!", "Tell me a joke"]
+        outputs, logprobs = self.client.generate(prompts, n=2, return_logprobs=True)
+
+        # Check that there is one log-probability per generated token
+        self.assertEqual(len(logprobs), 2 * len(prompts))
+        for seq, seq_logprobs in zip(outputs, logprobs):
+            self.assertEqual(len(seq_logprobs), len(seq))
+            self.assertTrue(all(isinstance(logprob, float) and logprob <= 0.0 for logprob in seq_logprobs))
+
+    def test_generate_binary_response(self):
+        prompts = ["Hello, AI!", "Tell me a joke"]
+        outputs, logprobs = self.client.generate(prompts, temperature=0.0, return_logprobs=True)
+        for compress_response in [False, True]:
+            client = VLLMClient(response_format="binary", compress_response=compress_response)
+            binary_outputs, binary_logprobs = client.generate(prompts, temperature=0.0, return_logprobs=True)
+
+            # Check that the completions are the same as in JSON, as NumPy arrays
+            self.assertEqual([seq.tolist() for seq in binary_outputs], outputs)
+            for seq_logprobs, binary_seq_logprobs in zip(logprobs, binary_logprobs):
+                np.testing.assert_allclose(binary_seq_logprobs, seq_logprobs, rtol=1e-6)
+
     def test_update_model_params(self):
         model = AutoModelForCausalLM.from_pretrained(self.model_id, device_map=torch_device)
         self.client.update_model_params(model)
 
+    def test_update_model_params_small_buckets(self):
+        # Buckets smaller than the largest parameters, to have several parameters per bucket and oversized ones
+        model = AutoModelForCausalLM.from_pretrained(self.model_id, device_map=torch_device)
+        self.client.update_model_params(model, bucket_size_mb=0.1)
+
+    def test_update_named_param(self):
+        model = AutoModelForCausalLM.from_pretrained(self.model_id, device_map=torch_device)
+        for name, param in model.named_parameters():
+            self.client.update_named_param(name, param.data)
+
     def test_reset_prefix_cache(self):
         # Test resetting the prefix cache
         self.client.reset_prefix_cache()
@@ -311,6 +575,23 @@ class TestVLLMClientServerDP(unittest.TestCase):
         for seq in outputs:
             self.assertTrue(all(isinstance(tok, int) for tok in seq))
 
+    def test_generate_keeps_prompt_order(self):
+        # Prompts of very different lengths, which are not split in consecutive chunks across the workers
+        prompt_token_ids = [[9707] * length for length in [200, 1, 1, 1, 1, 1]]
+        outputs = self.client.generate(prompt_token_ids=prompt_token_ids, n=2, temperature=0.0, max_tokens=8)
+        for i, token_ids in enumerate(prompt_token_ids):
+            expected = self.client.generate(prompt_token_ids=[token_ids], n=2, temperature=0.0, max_tokens=8)
+            self.assertEqual(outputs[2 * i : 2 * i + 2], expected)
+
+    def test_get_worker_metrics(self):
+        self.client.generate(["Hello, AI!", "Tell me a joke"])
+        metrics = self.client.get_worker_metrics()
+
+        # Check that there is one value per data parallel worker
+        for name in ["busy_time", "idle_time", "num_prompts", "num_completion_tokens"]:
+            self.assertEqual(len(metrics[name]), 2)
+        self.assertGreater(sum(metrics["num_prompts"]), 0)
+
     def test_update_model_params(self):
         model = AutoModelForCausalLM.from_pretrained(self.model_id, device_map=torch_device)
         self.client.update_model_params(model)
@@ -334,3 +615,62 @@ class TestVLLMClientServerDP(unittest.TestCase):
             child.send_signal(signal.SIGTERM)
         cls.server_process.terminate()
         cls.server_process.wait()
+
+
+# Same as above but with the shared memory weight transport. The client runs on the CPU, on the same node as the server.
+@pytest.mark.slow
+@require_torch_accelerator
+class TestVLLMClientServerSharedMemory(unittest.TestCase):
+    model_id = "Qwen/Qwen2.5-1.5B"
+
+    @classmethod
+    def setUpClass(cls):
+        # We want the server to run on accelerator 0, so we set VISIBLE_DEVICES to "0"
+        env = os.environ.copy()
+        VISIBLE_DEVICES = "ZE_AFFINITY_MASK" if torch_device == "xpu" else "CUDA_VISIBLE_DEVICES"
+        env[VISIBLE_DEVICES] = "0"  # Restrict to accelerator 0
+
+        # Start the server process
+        cls.server_process = subprocess.Popen(
+            ["trl", "vllm-serve", "--model", cls.model_id], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env
+        )
+
+        # Initialize the client
+        cls.client = VLLMClient(connection_timeout=240, weight_transport="shm")
+        cls.client.init_communicator()
+
+    def test_generate(self):
+        prompts = ["Hello, AI!", "Tell me a joke"]
+        outputs = self.client.generate(prompts)
+
+        # Check that the number of generated sequences is equal to the number of prompts
+        self.assertEqual(len(outputs), len(prompts))
+
+    def test_update_model_params(self):
+        model = AutoModelForCausalLM.from_pretrained(self.model_id)
+        self.client.update_model_params(model)
+
+    def test_update_model_params_small_buckets(self):
+        model = AutoModelForCausalLM.from_pretrained(self.model_id)
+        self.client.update_model_params(model, bucket_size_mb=0.1)
+
+    def test_update_named_param(self):
+        model = AutoModelForCausalLM.from_pretrained(self.model_id)
+        for name, param in model.named_parameters():
+            self.client.update_named_param(name, param.data)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+
+        # Close the client
+        cls.client.close_communicator()
+
+        # vLLM x pytest (or Popen) seems not to handle process termination well. To avoid zombie processes, we need to
+        # kill the server process and its children explicitly.
+        parent = psutil.Process(cls.server_process.pid)
+        children = parent.children(recursive=True)
+        for child in children:
+            child.send_signal(signal.SIGTERM)
+        cls.server_process.terminate()
+        cls.server_process.wait()
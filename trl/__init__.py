@@ -22,14 +22,19 @@ from .import_utils import OptionalDependencyNotAvailable, _LazyModule, is_diffus
 _import_structure = {
     "scripts": ["init_zero_verbose", "ScriptArguments", "TrlParser"],
     "data_utils": [
+        "TokenShardDataset",
         "apply_chat_template",
         "extract_prompt",
         "is_conversational",
         "maybe_apply_chat_template",
+        "maybe_apply_chat_template_dataset",
         "maybe_convert_to_chatml",
+        "maybe_convert_to_chatml_dataset",
         "maybe_extract_prompt",
+        "maybe_extract_prompt_dataset",
         "maybe_unpair_preference_dataset",
         "pack_dataset",
+        "save_token_shard",
         "truncate_dataset",
         "unpair_preference_dataset",
     ],
@@ -116,14 +121,19 @@ else:
 
 if TYPE_CHECKING:
     from .data_utils import (
+        TokenShardDataset,
         apply_chat_template,
         extract_prompt,
         is_conversational,
         maybe_apply_chat_template,
+        maybe_apply_chat_template_dataset,
         maybe_convert_to_chatml,
+        maybe_convert_to_chatml_dataset,
         maybe_extract_prompt,
+        maybe_extract_prompt_dataset,
         maybe_unpair_preference_dataset,
         pack_dataset,
+        save_token_shard,
         truncate_dataset,
         unpair_preference_dataset,
     )
@@ -12,8 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
 from collections import defaultdict, deque
-from collections.abc import Sequence
+from collections.abc import Iterator, Sequence
 from itertools import takewhile
 from typing import Any, Callable, Optional, TypeVar, Union
 
@@ -21,12 +23,16 @@ import numpy as np
 import pyarrow as pa
 import pyarrow.compute as pc
 import pyarrow.types
-from datasets import Dataset, DatasetDict
+import torch
+from datasets import Dataset, DatasetDict, IterableDataset, IterableDatasetDict
 from transformers import PreTrainedTokenizerBase
+from transformers.utils import logging
 
 
 DatasetType = TypeVar("DatasetType", Dataset, DatasetDict)
 
+logger = logging.get_logger(__name__)
+
 
 def is_conversational(example: dict[str, Any]) -> bool:
     r"""
@@ -69,6 +75,67 @@ def is_conversational(example: dict[str, Any]) -> bool:
     return False
 
 
+_CHAT_TEMPLATE_KEYS = ["prompt", "chosen", "rejected", "completion", "messages", "label"]
+_CHAT_TEMPLATE_KEY_SETS = [
+    {"messages"},  # language modeling
+    {"prompt"},  # prompt-only
+    {"prompt", "completion"},  # prompt-completion
+    {"prompt", "chosen", "rejected"},  # preference
+    {"chosen", "rejected"},  # preference with implicit prompt
+    {"prompt", "completion", "label"},  # unpaired preference
+]
+
+
+def _is_messages_type(type: pa.DataType, keys: tuple[str, ...] = ("role", "content")) -> bool:
+    """Whether an Arrow type is a list of messages, i.e. a list of structs with the given keys."""
+    return (
+        (pa.types.is_list(type) or pa.types.is_large_list(type))
+        and pa.types.is_struct(type.value_type)
+        and all(type.value_type.get_field_index(key) != -1 for key in keys)
+    )
+
+
+def _is_conversational_schema(schema: pa.Schema) -> bool:
+    """Dataset-level equivalent of [`is_conversational`], from the Arrow schema of the dataset."""
+    for key in ["prompt", "chosen", "rejected", "completion", "messages"]:
+        if key in schema.names:
+            return _is_messages_type(schema.field(key).type)
+    return False
+
+
+def _get_schema(dataset: Union[Dataset, IterableDataset]) -> Optional[pa.Schema]:
+    """Arrow schema of a dataset, or `None` if its features are unknown (e.g. for some `IterableDataset`)."""
+    return dataset.features.arrow_schema if dataset.features is not None else None
+
+
+def _map_arrow_batches(
+    dataset: Union[Dataset, IterableDataset], function: Callable, **map_kwargs
+) -> Union[Dataset, IterableDataset]:
+    """
+    Map a batched function over the Arrow tables of a dataset. Like a regular `map`, the output keeps the format of the
+    dataset (e.g., a transform set with `with_transform`), applied to all the columns since they may have changed.
+    """
+    original_format = dataset.format if isinstance(dataset, Dataset) else None
+    dataset = dataset.with_format("arrow").map(function, batched=True, **map_kwargs)
+    if original_format is None or original_format["type"] is None:
+        return dataset.with_format(None)
+    if original_format["type"] == "custom":
+        return dataset.with_transform(
+            original_format["format_kwargs"]["transform"], output_all_columns=original_format["output_all_columns"]
+        )
+    return dataset.with_format(
+        original_format["type"],
+        output_all_columns=original_format["output_all_columns"],
+        **original_format["format_kwargs"],
+    )
+
+
+def _common_prefix(a: str, b: str) -> str:
+    if b.startswith(a):  # most common case
+        return a
+    return "".join(x for x, _ in takewhile(lambda x: x[0] == x[1], zip(a, b)))
+
+
 def apply_chat_template(
     example: dict[str, list[dict[str, str]]],
     tokenizer: PreTrainedTokenizerBase,
@@ -80,16 +147,8 @@ def apply_chat_template(
     For more details, see [`maybe_apply_chat_template`].
     """
     # Check that the example has the correct keys
-    supported_keys = ["prompt", "chosen", "rejected", "completion", "messages", "label"]
-    example_keys = {key for key in example.keys() if key in supported_keys}
-    if example_keys not in [
-        {"messages"},  # language modeling
-        {"prompt"},  # prompt-only
-        {"prompt", "completion"},  # prompt-completion
-        {"prompt", "chosen", "rejected"},  # preference
-        {"chosen", "rejected"},  # preference with implicit prompt
-        {"prompt", "completion", "label"},  # unpaired preference
-    ]:
+    example_keys = {key for key in example.keys() if key in _CHAT_TEMPLATE_KEYS}
+    if example_keys not in _CHAT_TEMPLATE_KEY_SETS:
         raise KeyError(f"Invalid keys in the example: {example_keys}")
 
     # Apply the chat template to the whole conversation
@@ -224,15 +283,119 @@ def maybe_apply_chat_template(
         return example
 
 
-def _unpair_row(examples: list[dict[str, list[dict[str, str]]]]) -> list[dict[str, list[dict[str, str]]]]:
-    batch_size = len(examples["chosen"])
-    new_rows = {
-        "completion": examples["chosen"] + examples["rejected"],
-        "label": [True] * batch_size + [False] * batch_size,
-    }
+def _apply_chat_template_batch(
+    examples: dict[str, list],
+    tokenizer: PreTrainedTokenizerBase,
+    tools: Optional[list[Union[dict, Callable]]] = None,
+) -> dict[str, list]:
+    """Batched version of [`maybe_apply_chat_template`], rendering the conversations of a batch together."""
+    num_examples = len(next(iter(examples.values()), []))
+    if num_examples == 0 or not is_conversational({key: column[0] for key, column in examples.items()}):
+        return examples
+    example_keys = {key for key in examples.keys() if key in _CHAT_TEMPLATE_KEYS}
+    if example_keys not in _CHAT_TEMPLATE_KEY_SETS:
+        raise KeyError(f"Invalid keys in the example: {example_keys}")
+
+    def render(conversations, **kwargs):
+        return tokenizer.apply_chat_template(conversations, tools=tools, tokenize=False, **kwargs)
+
+    output = {}
+    if "messages" in examples:
+        output["text"] = render(examples["messages"])
+
     if "prompt" in examples:
-        new_rows["prompt"] = examples["prompt"] + examples["prompt"]
-    return new_rows
+        # Add the generation prompt to the prompts ending with a user message, continue the ones ending with an
+        # assistant message
+        last_roles = [prompt[-1]["role"] for prompt in examples["prompt"]]
+        for last_role in last_roles:
+            if last_role not in ("user", "assistant"):
+                raise ValueError(f"Invalid role in the last message: {last_role}")
+        prompts = [None] * num_examples
+        for last_role in ("user", "assistant"):
+            indices = [idx for idx, role in enumerate(last_roles) if role == last_role]
+            if indices:
+                rendered = render(
+                    [examples["prompt"][idx] for idx in indices],
+                    continue_final_message=last_role == "assistant",
+                    add_generation_prompt=last_role == "user",
+                )
+                for idx, prompt in zip(indices, rendered):
+                    prompts[idx] = prompt
+
+        for key in ["chosen", "rejected", "completion"]:
+            if key in examples:
+                prompt_completions = render(
+                    [prompt + completion for prompt, completion in zip(examples["prompt"], examples[key])]
+                )
+                # Handle DeepSeek-R1 <think> token, see `apply_chat_template` for details
+                prompts = [_common_prefix(prompt, text) for prompt, text in zip(prompts, prompt_completions)]
+                output[key] = [text[len(prompt) :] for prompt, text in zip(prompts, prompt_completions)]
+        output["prompt"] = prompts
+    else:  # implicit prompt case
+        for key in ["chosen", "rejected"]:
+            if key in examples:
+                output[key] = render(examples[key])
+
+    if "label" in examples:
+        output["label"] = examples["label"]
+    return output
+
+
+def maybe_apply_chat_template_dataset(
+    dataset: DatasetType,
+    tokenizer: PreTrainedTokenizerBase,
+    tools: Optional[list[Union[dict, Callable]]] = None,
+    map_kwargs: Optional[dict[str, Any]] = None,
+) -> DatasetType:
+    r"""
+    If the dataset is in a conversational format, apply a chat template to it.
+
+    Batched equivalent of mapping [`maybe_apply_chat_template`] over the dataset: the output is the same, but the format
+    of the dataset is detected once, from its features, and the conversations of each batch are rendered together.
+
+    Args:
+        dataset (`Dataset`, `DatasetDict`, `IterableDataset` or `IterableDatasetDict`):
+            Dataset to apply the chat template to. See [`maybe_apply_chat_template`] for the supported dataset types.
+        tokenizer (`PreTrainedTokenizerBase`):
+            Tokenizer to apply the chat template with.
+        tools (`list[Union[dict, Callable]]` or `None`, *optional*, defaults to `None`):
+            A list of tools (callable functions) that will be accessible to the model. If the template does not support
+            function calling, this argument will have no effect
+        map_kwargs (`dict` or `None`, *optional*, defaults to `None`):
+            Additional keyword arguments to pass to the dataset's map method.
+
+    Returns:
+        `Dataset`, `DatasetDict`, `IterableDataset` or `IterableDatasetDict`: The dataset with the chat template
+        applied, or the original dataset if it is not conversational.
+    """
+    if map_kwargs is None:
+        map_kwargs = {}
+    if isinstance(dataset, (DatasetDict, IterableDatasetDict)):
+        return type(dataset)(
+            {
+                name: maybe_apply_chat_template_dataset(split, tokenizer, tools, map_kwargs)
+                for name, split in dataset.items()
+            }
+        )
+    schema = _get_schema(dataset)
+    if schema is not None and not _is_conversational_schema(schema):
+        return dataset
+    return dataset.map(
+        _apply_chat_template_batch, batched=True, fn_kwargs={"tokenizer": tokenizer, "tools": tools}, **map_kwargs
+    )
+
+
+def _unpair_batch(examples: pa.Table) -> pa.Table:
+    """Unpair a batch of a preference dataset, with the chosen completions first, then the rejected ones."""
+    chosen = examples["chosen"].combine_chunks()
+    rejected = examples["rejected"].combine_chunks()
+    columns = {}
+    if "prompt" in examples.column_names:
+        prompt = examples["prompt"].combine_chunks()
+        columns["prompt"] = pa.concat_arrays([prompt, prompt])
+    columns["completion"] = pa.concat_arrays([chosen, rejected.cast(chosen.type)])
+    columns["label"] = pa.array(np.repeat([True, False], len(examples)))
+    return pa.table(columns)
 
 
 def unpair_preference_dataset(
@@ -275,7 +438,9 @@ def unpair_preference_dataset(
     {'prompt': 'The sky is', 'completion': ' blue.', 'label': True}
     ```
     """
-    return dataset.map(_unpair_row, batched=True, remove_columns=["chosen", "rejected"], num_proc=num_proc, desc=desc)
+    return _map_arrow_batches(
+        dataset, _unpair_batch, remove_columns=["chosen", "rejected"], num_proc=num_proc, desc=desc
+    )
 
 
 def maybe_unpair_preference_dataset(
@@ -440,51 +605,313 @@ def maybe_extract_prompt(example: dict[str, list]) -> dict[str, list]:
     return extract_prompt({"chosen": example["chosen"], "rejected": example["rejected"]})
 
 
+def _needs_prompt_extraction(schema: pa.Schema) -> bool:
+    """Dataset-level equivalent of the checks of [`maybe_extract_prompt`]."""
+    if "chosen" not in schema.names or "rejected" not in schema.names:  # not a preference dataset
+        return False
+    if "prompt" in schema.names:
+        # Both conversational or both non-conversational
+        return _is_messages_type(schema.field("chosen").type) != _is_messages_type(schema.field("prompt").type)
+    return True
+
+
+def _prompt_length(chosen: Sequence, rejected: Sequence) -> int:
+    """Index at which [`extract_prompt`] splits the shared prompt from the chosen and rejected completions."""
+    min_length = min(len(chosen), len(rejected))
+    if min_length == 0:
+        raise ValueError("Cannot extract the prompt of an example with an empty chosen or rejected completion.")
+    if isinstance(chosen, str) and isinstance(rejected, str):
+        # Binary search of the longest common prefix, comparing slices rather than characters
+        low, high = 0, min_length
+        while low < high:
+            mid = (low + high + 1) // 2
+            if chosen[:mid] == rejected[:mid]:
+                low = mid
+            else:
+                high = mid - 1
+        idx = low
+    else:
+        idx = next((idx for idx in range(min_length) if chosen[idx] != rejected[idx]), min_length)
+    if idx == min_length:  # no difference, the prompt ends before the last element of the shortest sequence
+        return min_length - 1
+    if chosen[idx - 1] == " ":  # remove space before the prompt
+        idx -= 1
+    return idx
+
+
+def _take_list_slices(array: pa.Array, starts: np.ndarray, lengths: np.ndarray) -> pa.Array:
+    """Build a list array whose i-th list holds `lengths[i]` values of `array.values` from index `starts[i]`."""
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    indices = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)
+    offset_type = np.int64 if pa.types.is_large_list(array.type) else np.int32
+    return type(array).from_arrays(offsets.astype(offset_type), pc.take(array.values, indices))
+
+
+def _message_prompt_lengths(chosen: pa.Array, rejected: pa.Array) -> Optional[np.ndarray]:
+    """
+    Vectorized [`_prompt_length`] for list arrays of messages, comparing the messages field by field. Returns `None`
+    if the messages can't be compared in Arrow (nested fields, different types).
+    """
+    message_type = chosen.type.value_type
+    if rejected.type != chosen.type or any(pa.types.is_nested(field.type) for field in message_type):
+        return None
+    chosen_offsets = chosen.offsets.to_numpy()
+    rejected_offsets = rejected.offsets.to_numpy()
+    min_lengths = np.minimum(np.diff(chosen_offsets), np.diff(rejected_offsets))
+    if (min_lengths == 0).any():
+        raise ValueError("Cannot extract the prompt of an example with an empty chosen or rejected completion.")
+
+    # Compare the i-th messages of the chosen and rejected completions, for i < min_length
+    rows = np.repeat(np.arange(len(chosen)), min_lengths)
+    positions = np.arange(len(rows)) - np.repeat(np.cumsum(min_lengths) - min_lengths, min_lengths)
+    chosen_messages = pc.take(chosen.values, chosen_offsets[:-1][rows] + positions).flatten()
+    rejected_messages = pc.take(rejected.values, rejected_offsets[:-1][rows] + positions).flatten()
+    equal = np.ones(len(rows), dtype=bool)
+    for chosen_field, rejected_field in zip(chosen_messages, rejected_messages):
+        both_null = pc.and_(chosen_field.is_null(), rejected_field.is_null())
+        equal &= pc.or_(pc.fill_null(pc.equal(chosen_field, rejected_field), False), both_null).to_numpy(
+            zero_copy_only=False
+        )
+
+    # Index of the first different message, or `min_length - 1` if there is none (see `_prompt_length`)
+    lengths = min_lengths.copy()
+    np.minimum.at(lengths, rows[~equal], positions[~equal])
+    return np.where(lengths == min_lengths, min_lengths - 1, lengths)
+
+
+def _extract_prompt_batch(examples: pa.Table) -> pa.Table:
+    """Batched version of [`maybe_extract_prompt`] for Arrow tables."""
+    if not _needs_prompt_extraction(examples.schema):
+        return examples
+    chosen = examples["chosen"].combine_chunks()
+    rejected = examples["rejected"].combine_chunks()
+    prompt_lengths = None
+    if _is_messages_type(chosen.type):
+        prompt_lengths = _message_prompt_lengths(chosen, rejected)
+
+    columns = dict(zip(examples.column_names, examples.columns))
+    if prompt_lengths is not None:
+        chosen_offsets = chosen.offsets.to_numpy()
+        rejected_offsets = rejected.offsets.to_numpy()
+        columns["prompt"] = _take_list_slices(chosen, chosen_offsets[:-1], prompt_lengths)
+        columns["chosen"] = _take_list_slices(
+            chosen, chosen_offsets[:-1] + prompt_lengths, np.diff(chosen_offsets) - prompt_lengths
+        )
+        columns["rejected"] = _take_list_slices(
+            rejected, rejected_offsets[:-1] + prompt_lengths, np.diff(rejected_offsets) - prompt_lengths
+        )
+    else:
+        chosen, rejected = chosen.to_pylist(), rejected.to_pylist()
+        prompt_lengths = [_prompt_length(c, r) for c, r in zip(chosen, rejected)]
+        columns["prompt"] = pa.array([c[:idx] for c, idx in zip(chosen, prompt_lengths)])
+        columns["chosen"] = pa.array([c[idx:] for c, idx in zip(chosen, prompt_lengths)])
+        columns["rejected"] = pa.array([r[idx:] for r, idx in zip(rejected, prompt_lengths)])
+    return pa.table(columns)
+
+
+def maybe_extract_prompt_dataset(dataset: DatasetType, map_kwargs: Optional[dict[str, Any]] = None) -> DatasetType:
+    r"""
+    Extracts the shared prompt from the examples of a preference dataset, where the prompt is implicit within both the
+    chosen and rejected completions.
+
+    Batched equivalent of mapping [`maybe_extract_prompt`] over the dataset: the output is the same, but whether the
+    prompt must be extracted is decided once, from the features of the dataset, and the prompts of conversational
+    datasets are extracted by comparing the messages of whole batches in Arrow.
+
+    Args:
+        dataset (`Dataset`, `DatasetDict`, `IterableDataset` or `IterableDatasetDict`):
+            Preference dataset with columns `"chosen"` and `"rejected"`, either conversational or standard (`str`).
+        map_kwargs (`dict` or `None`, *optional*, defaults to `None`):
+            Additional keyword arguments to pass to the dataset's map method.
+
+    Returns:
+        `Dataset`, `DatasetDict`, `IterableDataset` or `IterableDatasetDict`: The dataset with the extracted
+        `"prompt"` column, or the original dataset if there is no prompt to extract.
+
+    Example:
+
+    ```python
+    >>> from datasets import Dataset
+    >>> from trl import maybe_extract_prompt_dataset
+
+    >>> dataset = Dataset.from_dict({"chosen": ["The sky is blue."], "rejected": ["The sky is green."]})
+    >>> dataset = maybe_extract_prompt_dataset(dataset)
+    >>> dataset[0]
+    {'chosen': ' blue.', 'rejected': ' green.', 'prompt': 'The sky is'}
+    ```
+    """
+    if map_kwargs is None:
+        map_kwargs = {}
+    if isinstance(dataset, (DatasetDict, IterableDatasetDict)):
+        return type(dataset)(
+            {name: maybe_extract_prompt_dataset(split, map_kwargs) for name, split in dataset.items()}
+        )
+    schema = _get_schema(dataset)
+    if schema is not None and not _needs_prompt_extraction(schema):
+        return dataset
+    return _map_arrow_batches(dataset, _extract_prompt_batch, **map_kwargs)
+
+
 class _SegmentTree:
     """
     A segment tree data structure that, when initialized as `_SegmentTree(maxval)`, efficiently finds the next larger
     value for a given input within the range [1, maxval].
 
+    The tree is stored as a flat `int32` NumPy array with a power-of-two number of leaves, so that `search` always
+    returns the smallest stored value that is greater than or equal to the query.
+
     See [Fewer Truncations Improve Language Modeling](https://arxiv.org/abs/2404.10830) for more details.
     """
 
     def __init__(self, maxval: int):
         self.maxval = maxval
-        self.tree = [0] * (2 * maxval)
+        self.num_leaves = 1 << max(maxval - 1, 0).bit_length()
+        self.tree = np.zeros(2 * self.num_leaves, dtype=np.int32)
 
-    def add(self, val):
-        assert 0 < val <= self.maxval
-        i = self.maxval + val - 1
-        self.tree[i] = val
+    def _update(self, i: int):
+        tree = self.tree
         while i > 1:
             i >>= 1
-            left, right = self.tree[i << 1], self.tree[(i << 1) + 1]
-            # Compare the values using if-else otherwise repeated calls to `builtins.max` become the bottleneck
-            self.tree[i] = left if left >= right else right
+            left, right = tree[i << 1], tree[(i << 1) + 1]
+            tree[i] = left if left >= right else right
 
-    def remove(self, val):
+    def add(self, val: int):
         assert 0 < val <= self.maxval
-        i = self.maxval + val - 1
+        i = self.num_leaves + val - 1
+        self.tree[i] = val
+        self._update(i)
+
+    def remove(self, val: int):
+        assert 0 < val <= self.maxval
+        i = self.num_leaves + val - 1
         self.tree[i] = 0
-        while i > 1:
-            i >>= 1
-            left, right = self.tree[i << 1], self.tree[(i << 1) + 1]
-            # Compare the values using if-else otherwise repeated calls to `builtins.max` become the bottleneck
-            self.tree[i] = left if left >= right else right
+        self._update(i)
 
-    def search(self, val):
+    def search(self, val: int) -> int:
         assert 0 < val <= self.maxval
+        tree = self.tree
         i = 1
-        while i < self.maxval:
-            if self.tree[i << 1] >= val:
-                i = i << 1
+        while i < self.num_leaves:
+            i <<= 1
+            if tree[i] < val:
+                i += 1
+        return int(tree[i])
+
+
+def _bfd_bin_assignment(
+    lengths: np.ndarray, seq_length: int, window_size: Optional[int] = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Assign sequences to bins of size `seq_length` using the Best Fit Decreasing strategy.
+
+    Instead of placing sequences one by one, runs of sequences with the same length are placed in batches: every bin
+    taken from the best-fitting free space receives as many sequences of the run as it can hold before another bin
+    becomes the best fit. The state is kept in flat NumPy arrays (a segment tree over free spaces, a count of bins per
+    free space and FIFO queues of bin indices), so the Python loop runs once per (length, free space) pair instead of
+    once per sequence.
+
+    Args:
+        lengths (`np.ndarray`):
+            1D array with the length of each sequence. Every length must be in `[1, seq_length]`.
+        seq_length (`int`):
+            Size of the bins.
+        window_size (`int` or `None`, *optional*, defaults to `None`):
+            If set, sequences are assigned window by window, each window containing `window_size` consecutive
+            sequences. A final merge pass then packs the bins of all windows together, so that the partially filled
+            bins at the end of each window are combined. If `None`, all sequences are assigned at once.
+
+    Returns:
+        `tuple[np.ndarray, np.ndarray]`:
+            - Indices of the sequences in packed order: the sequences of the first bin, then the sequences of the
+              second bin, and so on.
+            - Number of sequences in each bin.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if window_size is not None and window_size < len(lengths):
+        orders, bin_sizes = [], []
+        for start in range(0, len(lengths), window_size):
+            window_order, window_bin_sizes = _bfd_bin_assignment(lengths[start : start + window_size], seq_length)
+            orders.append(window_order + start)
+            bin_sizes.append(window_bin_sizes)
+        order, bin_sizes = np.concatenate(orders), np.concatenate(bin_sizes)
+
+        # Merge pass: bins are themselves packed as sequences of length equal to their fill
+        bin_starts = np.cumsum(bin_sizes) - bin_sizes
+        bin_order, merged_sizes = _bfd_bin_assignment(np.add.reduceat(lengths[order], bin_starts), seq_length)
+        sizes = bin_sizes[bin_order]
+        positions = np.arange(len(order)) + np.repeat(bin_starts[bin_order] - (np.cumsum(sizes) - sizes), sizes)
+        return order[positions], np.add.reduceat(sizes, np.cumsum(merged_sizes) - merged_sizes)
+
+    order = np.argsort(-lengths, kind="stable")
+    sorted_lengths = lengths[order]
+    num_examples = len(sorted_lengths)
+
+    # The original list-based segment tree had `seq_length` leaves. When `seq_length` isn't a power of two, its
+    # shallowest leaves (free spaces below `min_space`) could never be reached by `search`, so these spaces were never
+    # reused. We keep this behaviour so that the packing output is unchanged.
+    min_space = (1 << max(seq_length - 1, 0).bit_length()) - seq_length + 1
+
+    segment_tree = _SegmentTree(seq_length)
+    segment_tree.add(seq_length)  # the max, `seq_length` bin is always available
+    space_counts = np.zeros(seq_length + 1, dtype=np.int64)
+    space_to_bins = defaultdict(deque)  # free space -> FIFO of arrays of bin indices
+    bin_of_example = np.empty(num_examples, dtype=np.int64)
+    num_bins = 0
+
+    def push(space, bins):
+        if space >= min_space and len(bins) > 0:
+            space_to_bins[space].append(bins)
+            space_counts[space] += len(bins)
+            segment_tree.add(space)
+
+    def pop(space, count):
+        queue, popped = space_to_bins[space], []
+        while count > 0:
+            bins = queue[0]
+            if len(bins) <= count:
+                popped.append(queue.popleft())
+                count -= len(bins)
             else:
-                i = (i << 1) + 1
-        return self.tree[i]
+                popped.append(bins[:count])
+                queue[0] = bins[count:]
+                count = 0
+        return np.concatenate(popped)
+
+    run_starts = np.flatnonzero(np.diff(sorted_lengths, prepend=-1))
+    run_ends = np.append(run_starts[1:], num_examples)
+    for start, end in zip(run_starts.tolist(), run_ends.tolist()):
+        length = int(sorted_lengths[start])
+        threshold = max(length, min_space)
+        while start < end:
+            space = segment_tree.search(threshold)
+            per_bin = 1 + (space - threshold) // length  # sequences of the run a bin receives before it stops fitting
+            num_needed = -(-(end - start) // per_bin)
+            if space < seq_length:
+                bins = pop(space, min(num_needed, int(space_counts[space])))
+                space_counts[space] -= len(bins)
+                if space_counts[space] == 0:
+                    segment_tree.remove(space)
+            else:
+                bins = np.arange(num_bins, num_bins + num_needed)
+                num_bins += num_needed
+            num_placed = min(end - start, len(bins) * per_bin)
+            bin_of_example[start : start + num_placed] = np.repeat(bins, per_bin)[:num_placed]
+            start += num_placed
+
+            # All bins are full except maybe the last one, which may receive fewer sequences
+            num_last = num_placed - (len(bins) - 1) * per_bin
+            if num_last == per_bin:
+                push(space - per_bin * length, bins)
+            else:
+                push(space - per_bin * length, bins[:-1])
+                push(space - num_last * length, bins[-1:])
 
+    packed_order = np.argsort(bin_of_example, kind="stable")
+    return order[packed_order], np.bincount(bin_of_example, minlength=num_bins)
 
-def _pack_bfd(examples: pa.Table, seq_length: int) -> pa.Table:
-    """Pack sequences in a pyarrow Table using Best Fit Decreasing strategy."""
+
+def _truncate_and_get_lengths(examples: pa.Table, seq_length: int) -> tuple[pa.Table, pa.Array]:
+    """Truncate the list columns of a pyarrow Table to `seq_length` and add a `"seq_lengths"` column."""
     columns = []
     list_column_idx = None
     for idx, column in enumerate(examples.columns):
@@ -495,53 +922,24 @@ def _pack_bfd(examples: pa.Table, seq_length: int) -> pa.Table:
         columns.append(column)
     examples = pa.Table.from_arrays(columns, names=examples.column_names)
 
-    ids = np.arange(len(examples))
     assert list_column_idx is not None
     lengths = pc.list_value_length(examples[list_column_idx]).combine_chunks()
     examples = examples.append_column("seq_lengths", lengths)  # Allows us to later construct `position_ids`
-    lengths = pc.make_struct(lengths, ids)
-    lengths = lengths.sort("descending", by=0)
-
-    segment_tree = _SegmentTree(seq_length)
-    segment_tree.add(seq_length)  # the max, `seq_length` bin is always available
-    space_to_bin = defaultdict(deque)
-
-    # Bin is represented as a dict (of example ids and sum of their lengths) to allow in-place updates
-    bins: list[dict] = []
-    for length, idx in zip(lengths.field(0).to_numpy(), lengths.field(1).to_numpy()):
-        space = segment_tree.search(length)
-
-        if space < seq_length:
-            bin = space_to_bin[space].popleft()
-        else:
-            bin = {"ids": [], "length": 0}
-            bins.append(bin)
+    return examples, lengths
 
-        bin["ids"].append(idx)
-        bin["length"] += length
-        if space < seq_length and not space_to_bin[space]:
-            segment_tree.remove(space)
 
-        space = space - length
-        space_to_bin[space].append(bin)
-        if space > 0:
-            segment_tree.add(space)
-
-    examples = pc.take(examples, [id_ for bin in bins for id_ in bin["ids"]])
-    offsets = np.array([0] + [bin["length"] for bin in bins])
-    offsets = np.cumsum(offsets)
-
-    assert all(
-        column.num_chunks == 1 for column in examples.columns
-    )  # `pc.take` returns a ChunkedArray with a single chunk
-
-    lengths = examples["seq_lengths"].chunks[0]
+def _take_bins(examples: pa.Table, packed_order: np.ndarray, bin_sizes: np.ndarray) -> pa.Table:
+    """Build the packed Table from a Table with a `"seq_lengths"` column and a bin assignment."""
+    examples = pc.take(examples, packed_order)
+    bin_starts = np.concatenate(([0], np.cumsum(bin_sizes)))
+    lengths = examples["seq_lengths"].combine_chunks()
+    offsets = np.concatenate(([0], np.cumsum(lengths.to_numpy())))[bin_starts]
     examples = examples.drop_columns("seq_lengths")
-    lengths = pa.ListArray.from_arrays(np.cumsum([0] + [len(bin["ids"]) for bin in bins], dtype=np.int32), lengths)
+    lengths = pa.ListArray.from_arrays(bin_starts.astype(np.int32), lengths)
 
     columns = []
     for column in examples.columns:
-        column = column.chunks[0]
+        column = column.combine_chunks()
         if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
             dtype = column.offsets.type.to_pandas_dtype()
             column = type(column).from_arrays(offsets.astype(dtype), column.values)
@@ -549,6 +947,13 @@ def _pack_bfd(examples: pa.Table, seq_length: int) -> pa.Table:
     return pa.Table.from_arrays(columns + [lengths], names=examples.column_names + ["seq_lengths"])
 
 
+def _pack_bfd(examples: pa.Table, seq_length: int, window_size: Optional[int] = None) -> pa.Table:
+    """Pack sequences in a pyarrow Table using Best Fit Decreasing strategy."""
+    examples, lengths = _truncate_and_get_lengths(examples, seq_length)
+    packed_order, bin_sizes = _bfd_bin_assignment(lengths.to_numpy(), seq_length, window_size)
+    return _take_bins(examples, packed_order, bin_sizes)
+
+
 def _pack_wrapped(examples: pa.Table, seq_length: int) -> pa.Table:
     """Pack sequences in a pyarrow Table using a wrapped strategy."""
     columns = []
@@ -567,8 +972,84 @@ def _pack_wrapped(examples: pa.Table, seq_length: int) -> pa.Table:
     return pa.Table.from_arrays(columns, names=examples.column_names)
 
 
+def _pack_stream(
+    dataset: IterableDataset, seq_length: int, strategy: str, buffer_size: int
+) -> Iterator[dict[str, Any]]:
+    """
+    Pack an `IterableDataset` on the fly, keeping at most `buffer_size` sequences in memory.
+
+    Sequences are read into a buffer, which is packed once full. Packed sequences that can still receive data are not
+    emitted: with the `"bfd"` strategy, bins whose free space is at least the length of the shortest buffered sequence
+    are carried over to the next buffer (as long as they hold no more than half of it), and with the `"wrapped"`
+    strategy, the last, incomplete chunk is carried over. Everything left is emitted once the dataset is exhausted.
+    """
+    buffer, num_buffered = [], 0
+    batches = iter(dataset.with_format("arrow").iter(batch_size=buffer_size))
+    exhausted = False
+    while not exhausted:
+        # Read at least one batch, even when the carried over sequences fill the buffer, so that they are packed with
+        # new data and the loop moves forward
+        while True:
+            batch = next(batches, None)
+            if batch is None:
+                exhausted = True
+                break
+            buffer.append(batch)
+            num_buffered += len(batch)
+            if num_buffered >= buffer_size:
+                break
+        if num_buffered == 0:
+            break
+        examples = pa.concat_tables(buffer)
+
+        if strategy == "bfd":
+            examples, lengths = _truncate_and_get_lengths(examples, seq_length)
+            lengths = lengths.to_numpy()
+            packed_order, bin_sizes = _bfd_bin_assignment(lengths, seq_length)
+            bin_ids = np.repeat(np.arange(len(bin_sizes)), bin_sizes)
+            free_space = seq_length - np.bincount(bin_ids, weights=lengths[packed_order], minlength=len(bin_sizes))
+            is_open = free_space >= lengths.min()
+            if exhausted or bin_sizes[is_open].sum() > buffer_size // 2:
+                is_open[:] = False
+            is_carried = is_open[bin_ids]
+            packed = _take_bins(examples, packed_order[~is_carried], bin_sizes[~is_open])
+            buffer = [pc.take(examples.drop_columns("seq_lengths"), packed_order[is_carried])]
+        else:
+            packed = _pack_wrapped(examples, seq_length)
+            if not exhausted and len(packed) > 0:
+                buffer = [packed.slice(len(packed) - 1)]
+                packed = packed.slice(0, len(packed) - 1)
+            else:
+                buffer = []
+        num_buffered = sum(len(table) for table in buffer)
+        yield from packed.to_pylist()
+
+
+def _log_packing_efficiency(dataset: Dataset, seq_length: int) -> None:
+    """Log the number of bins and the fill ratio of a packed arrow-formatted dataset."""
+    for field in dataset.data.schema:
+        if field.name != "seq_lengths" and (
+            pyarrow.types.is_list(field.type) or pyarrow.types.is_large_list(field.type)
+        ):
+            break
+    else:
+        return
+    num_bins = len(dataset)
+    num_tokens = pc.sum(pc.list_value_length(dataset[field.name])).as_py() or 0
+    fill_ratio = num_tokens / (num_bins * seq_length) if num_bins > 0 else 0.0
+    logger.info(
+        f"Packed {num_tokens} tokens into {num_bins} sequences of length {seq_length} (fill ratio: {fill_ratio:.2%})."
+    )
+
+
 def pack_dataset(
-    dataset: DatasetType, seq_length: int, strategy: str = "bfd", map_kwargs: Optional[dict[str, Any]] = None
+    dataset: DatasetType,
+    seq_length: int,
+    strategy: str = "bfd",
+    map_kwargs: Optional[dict[str, Any]] = None,
+    global_packing: bool = False,
+    window_size: Optional[int] = None,
+    buffer_size: int = 1000,
 ) -> DatasetType:
     r"""
     Pack sequences in a dataset into chunks of size `seq_length`.
@@ -587,6 +1068,21 @@ def pack_dataset(
                 to completely fill each packed sequence with data.
         map_kwargs (`dict` or `None`, *optional*, defaults to `None`):
             Additional keyword arguments to pass to the dataset's map method when packing examples.
+        global_packing (`bool`, *optional*, defaults to `False`):
+            By default, sequences are packed independently within each batch of the dataset's map method, which leaves
+            partially filled packed sequences at the end of every batch. If `True`, the whole dataset is packed at
+            once: the bin assignment is computed from the lengths of all sequences, and the packed rows are then
+            materialized with a single `take`. Only supported for `Dataset` (not `IterableDataset`). `num_proc` and
+            `batch_size` in `map_kwargs` are ignored in this mode.
+        window_size (`int` or `None`, *optional*, defaults to `None`):
+            Only supported with `global_packing=True` and the `"bfd"` strategy. If set, the bin assignment is
+            computed over windows of `window_size` consecutive sequences, followed by a merge pass that combines the
+            partially filled bins of all windows. If `None`, the assignment is computed over the whole dataset.
+        buffer_size (`int`, *optional*, defaults to `1000`):
+            Only used for `IterableDataset`, which is packed on the fly. Maximum number of sequences held in memory
+            while packing. Packed sequences that can still receive data are carried over to the next buffer instead of
+            being emitted, so a larger buffer gives a better packing at the cost of memory. `map_kwargs` is ignored in
+            this case.
 
     Returns:
         `Dataset` or `DatasetDict`: The dataset with packed sequences. The number of examples may decrease as sequences
@@ -608,16 +1104,52 @@ def pack_dataset(
      'attention_mask': [[1, 1, 0, 1], [1, 0, 0, 1, 0]]}
     ```
     """
+    if strategy not in ("bfd", "wrapped"):
+        raise ValueError(f"Invalid packing strategy: {strategy}. Use 'bfd' or 'wrapped'.")
+    if buffer_size < 1:
+        raise ValueError(f"buffer_size must be a positive integer, got {buffer_size}.")
+    if window_size is not None and not (global_packing and strategy == "bfd"):
+        raise ValueError("`window_size` is only supported with `global_packing=True` and the 'bfd' strategy.")
+    if isinstance(dataset, IterableDatasetDict):
+        return IterableDatasetDict(
+            {
+                split: pack_dataset(split_dataset, seq_length, strategy, buffer_size=buffer_size)
+                for split, split_dataset in dataset.items()
+            }
+        )
+    if isinstance(dataset, IterableDataset):
+        if global_packing:
+            raise ValueError("Global packing is only supported for `Dataset` and `DatasetDict`.")
+        return IterableDataset.from_generator(
+            _pack_stream,
+            gen_kwargs={
+                "dataset": dataset,
+                "seq_length": seq_length,
+                "strategy": strategy,
+                "buffer_size": buffer_size,
+            },
+        )
+
     if map_kwargs is None:
         map_kwargs = {}
+    if global_packing:
+        # The whole dataset is passed as a single batch
+        map_kwargs = {key: value for key, value in map_kwargs.items() if key not in ("num_proc", "batch_size")}
+        map_kwargs["batch_size"] = None
     # Fast packing with pyarrow
     dataset = dataset.with_format("arrow")
     if strategy == "bfd":
-        dataset = dataset.map(_pack_bfd, batched=True, fn_kwargs={"seq_length": seq_length}, **map_kwargs)
-    elif strategy == "wrapped":
-        dataset = dataset.map(_pack_wrapped, batched=True, fn_kwargs={"seq_length": seq_length}, **map_kwargs)
+        fn_kwargs = {"seq_length": seq_length}
+        if global_packing:
+            fn_kwargs["window_size"] = window_size
+        dataset = dataset.map(_pack_bfd, batched=True, fn_kwargs=fn_kwargs, **map_kwargs)
     else:
-        raise ValueError(f"Invalid packing strategy: {strategy}. Use 'bfd' or 'wrapped'.")
+        dataset = dataset.map(_pack_wrapped, batched=True, fn_kwargs={"seq_length": seq_length}, **map_kwargs)
+    if isinstance(dataset, Dataset):
+        _log_packing_efficiency(dataset, seq_length)
+    elif isinstance(dataset, DatasetDict):
+        for split in dataset.values():
+            _log_packing_efficiency(split, seq_length)
     dataset = dataset.with_format(None)
     return dataset
 
@@ -656,7 +1188,7 @@ def truncate_dataset(
     """
     if map_kwargs is None:
         map_kwargs = {}
-    if isinstance(dataset, Dataset):
+    if isinstance(dataset, (Dataset, IterableDataset)):
         # Fast truncation with pyarrow
         def truncate(examples):
             truncated_columns = []
@@ -687,6 +1219,155 @@ def truncate_dataset(
     return dataset
 
 
+_TOKEN_SHARD_MASK_COLUMNS = ("completion_mask", "assistant_masks")
+
+
+def save_token_shard(dataset: Union[Dataset, IterableDataset], path: str, batch_size: int = 10_000) -> None:
+    r"""
+    Write a tokenized dataset to a directory of flat binary buffers, to be memory-mapped by [`TokenShardDataset`].
+
+    The token IDs of all the rows are concatenated in a single `uint32` buffer, indexed by an `int64` buffer of row
+    offsets. The `"completion_mask"` and `"assistant_masks"` columns, when present, are stored as `uint8` buffers with
+    the same offsets, and the `"seq_lengths"` column of packed datasets as an `int32` buffer with its own offsets. The
+    other columns are dropped. The dataset is read by batches, so the memory use does not depend on its size.
+
+    Args:
+        dataset (`Dataset` or `IterableDataset`):
+            Tokenized dataset with an `"input_ids"` column, such as the training dataset of [`SFTTrainer`] once
+            processed.
+        path (`str`):
+            Directory to write the shard to. It is created if it does not exist.
+        batch_size (`int`, *optional*, defaults to `10_000`):
+            Number of rows read and written at a time.
+
+    Example:
+    ```python
+    >>> from datasets import Dataset
+    >>> from trl import TokenShardDataset, save_token_shard
+
+    >>> dataset = Dataset.from_dict({"input_ids": [[1, 2, 3], [4, 5]], "completion_mask": [[0, 1, 1], [0, 1]]})
+    >>> save_token_shard(dataset, "shard")
+    >>> TokenShardDataset("shard")[1]
+    {'input_ids': array([4, 5]), 'completion_mask': array([0, 1])}
+    ```
+    """
+    column_names = None
+    num_rows = num_tokens = num_seq_lengths = 0
+    os.makedirs(path, exist_ok=True)
+    files = {}
+    try:
+        for batch in dataset.with_format("arrow").iter(batch_size=batch_size):
+            if column_names is None:
+                column_names = ["input_ids"] + [
+                    name for name in (*_TOKEN_SHARD_MASK_COLUMNS, "seq_lengths") if name in batch.column_names
+                ]
+                for name in ["offsets"] + column_names + (["seq_offsets"] if "seq_lengths" in column_names else []):
+                    files[name] = open(os.path.join(path, f"{name}.bin"), "wb")
+                np.zeros(1, dtype=np.int64).tofile(files["offsets"])
+                if "seq_lengths" in column_names:
+                    np.zeros(1, dtype=np.int64).tofile(files["seq_offsets"])
+
+            input_ids = batch["input_ids"].combine_chunks()
+            lengths = pc.list_value_length(input_ids).to_numpy(zero_copy_only=False).astype(np.int64)
+            (num_tokens + np.cumsum(lengths)).tofile(files["offsets"])
+            # The cast is checked, so it fails if a token ID does not fit in 32 bits
+            pc.list_flatten(input_ids).cast(pa.uint32()).to_numpy(zero_copy_only=False).tofile(files["input_ids"])
+            for name in _TOKEN_SHARD_MASK_COLUMNS:
+                if name in column_names:
+                    column = pc.list_flatten(batch[name].combine_chunks()).cast(pa.uint8())
+                    column.to_numpy(zero_copy_only=False).tofile(files[name])
+            if "seq_lengths" in column_names:
+                seq_lengths = batch["seq_lengths"].combine_chunks()
+                counts = pc.list_value_length(seq_lengths).to_numpy(zero_copy_only=False).astype(np.int64)
+                (num_seq_lengths + np.cumsum(counts)).tofile(files["seq_offsets"])
+                pc.list_flatten(seq_lengths).cast(pa.int32()).to_numpy(zero_copy_only=False).tofile(
+                    files["seq_lengths"]
+                )
+                num_seq_lengths += int(counts.sum())
+            num_rows += len(lengths)
+            num_tokens += int(lengths.sum())
+    finally:
+        for file in files.values():
+            file.close()
+    if column_names is None:
+        raise ValueError("The dataset is empty, there is nothing to write.")
+
+    metadata = {"num_rows": num_rows, "num_tokens": num_tokens, "columns": column_names}
+    with open(os.path.join(path, "metadata.json"), "w") as f:
+        json.dump(metadata, f)
+
+
+class TokenShardDataset(torch.utils.data.Dataset):
+    r"""
+    Map-style dataset reading a shard written by [`save_token_shard`] through memory maps.
+
+    Opening the shard only maps its buffers, so it is instantaneous and does not load the data in memory, whatever its
+    size. Each row is sliced from the flat buffers by its offsets, in constant time, and returned as a dictionary of
+    NumPy arrays, that can be collated by [`~trainer.sft_trainer.DataCollatorForLanguageModeling`]. The dataset can be
+    passed to [`SFTTrainer`] as is: since it is already tokenized (and possibly truncated and packed), it is not
+    processed again.
+
+    Args:
+        path (`str`):
+            Directory the shard was written to.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "metadata.json")) as f:
+            metadata = json.load(f)
+        self.num_rows = metadata["num_rows"]
+        self.num_tokens = metadata["num_tokens"]
+        self.column_names = metadata["columns"]
+        self._buffers = {
+            "offsets": self._memmap("offsets", np.int64),
+            "input_ids": self._memmap("input_ids", np.uint32),
+        }
+        for name in _TOKEN_SHARD_MASK_COLUMNS:
+            if name in self.column_names:
+                self._buffers[name] = self._memmap(name, np.uint8)
+        if "seq_lengths" in self.column_names:
+            self._buffers["seq_offsets"] = self._memmap("seq_offsets", np.int64)
+            self._buffers["seq_lengths"] = self._memmap("seq_lengths", np.int32)
+
+    def _memmap(self, name: str, dtype: np.dtype) -> np.ndarray:
+        filename = os.path.join(self.path, f"{name}.bin")
+        if os.path.getsize(filename) == 0:  # empty files can't be memory-mapped
+            return np.empty(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode="r")
+
+    # Memory maps would be pickled with their content, so they are reopened instead when the dataset is sent to the
+    # dataloader workers
+    def __getstate__(self) -> dict[str, Any]:
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__init__(state["path"])
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def __getitem__(self, idx: int) -> dict[str, np.ndarray]:
+        if idx < 0:
+            idx += self.num_rows
+        if not 0 <= idx < self.num_rows:
+            raise IndexError(f"Index {idx} is out of range for a dataset of {self.num_rows} rows.")
+        start, end = self._buffers["offsets"][idx : idx + 2]
+        example = {"input_ids": self._buffers["input_ids"][start:end].astype(np.int64)}
+        for name in _TOKEN_SHARD_MASK_COLUMNS:
+            if name in self._buffers:
+                example[name] = self._buffers[name][start:end].astype(np.int64)
+        if "seq_lengths" in self._buffers:
+            seq_start, seq_end = self._buffers["seq_offsets"][idx : idx + 2]
+            example["seq_lengths"] = self._buffers["seq_lengths"][seq_start:seq_end].astype(np.int64)
+        return example
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Number of tokens of each row."""
+        return np.diff(self._buffers["offsets"])
+
+
 def is_conversational_from_value(example: dict[str, Any]) -> bool:
     r"""
     Check if the example is in a conversational format (from/value). Note that this format isn't recommended. Prefer
@@ -773,3 +1454,84 @@ def maybe_convert_to_chatml(example: dict[str, list]) -> dict[str, list]:
         example["messages"] = example.pop("conversations")
 
     return example
+
+
+_CHATML_KEYS = ["prompt", "completion", "chosen", "rejected", "messages", "conversations"]
+
+
+def _needs_chatml_conversion(schema: pa.Schema) -> bool:
+    """Dataset-level equivalent of the checks of [`maybe_convert_to_chatml`]."""
+    if "conversations" in schema.names:
+        return True
+    for key in _CHATML_KEYS:
+        if key in schema.names and (
+            _is_messages_type(schema.field(key).type, keys=("from",))
+            or _is_messages_type(schema.field(key).type, keys=("value",))
+        ):
+            return True
+    return False
+
+
+def _convert_to_chatml_batch(examples: pa.Table) -> pa.Table:
+    """Batched version of [`maybe_convert_to_chatml`] for Arrow tables, renaming the fields of the message structs."""
+    columns = dict(zip(examples.column_names, examples.columns))
+    for key in _CHATML_KEYS:
+        if key in columns and _is_messages_type(columns[key].type, keys=()):
+            column = columns[key].combine_chunks()
+            messages = column.values
+            # Same as renaming the keys of the message dictionaries: a renamed key moves to the end, or replaces the
+            # existing key with the new name
+            fields = dict(zip((field.name for field in messages.type), messages.flatten()))
+            for old_name, new_name in [("from", "role"), ("value", "content")]:
+                if old_name in fields:
+                    fields[new_name] = fields.pop(old_name)
+            messages = pa.StructArray.from_arrays(
+                list(fields.values()), names=list(fields), mask=messages.is_null() if messages.null_count else None
+            )
+            columns[key] = type(column).from_arrays(
+                column.offsets, messages, mask=column.is_null() if column.null_count else None
+            )
+    if "conversations" in columns:
+        columns["messages"] = columns.pop("conversations")
+    return pa.table(columns)
+
+
+def maybe_convert_to_chatml_dataset(dataset: DatasetType, map_kwargs: Optional[dict[str, Any]] = None) -> DatasetType:
+    r"""
+    Convert a conversational dataset with fields `from` and `value` to ChatML format.
+
+    Batched equivalent of mapping [`maybe_convert_to_chatml`] over the dataset: the output is the same, but whether the
+    dataset must be converted is decided once, from its features, and the fields of the messages are renamed in Arrow,
+    without converting them to Python objects.
+
+    Args:
+        dataset (`Dataset`, `DatasetDict`, `IterableDataset` or `IterableDatasetDict`):
+            Dataset to convert.
+        map_kwargs (`dict` or `None`, *optional*, defaults to `None`):
+            Additional keyword arguments to pass to the dataset's map method.
+
+    Returns:
+        `Dataset`, `DatasetDict`, `IterableDataset` or `IterableDatasetDict`: The dataset in ChatML format, or the
+        original dataset if there is nothing to convert.
+
+    Example:
+    ```python
+    >>> from datasets import Dataset
+    >>> from trl import maybe_convert_to_chatml_dataset
+
+    >>> dataset = Dataset.from_dict({"conversations": [[{"from": "user", "value": "What color is the sky?"}]]})
+    >>> dataset = maybe_convert_to_chatml_dataset(dataset)
+    >>> dataset[0]
+    {'messages': [{'role': 'user', 'content': 'What color is the sky?'}]}
+    ```
+    """
+    if map_kwargs is None:
+        map_kwargs = {}
+    if isinstance(dataset, (DatasetDict, IterableDatasetDict)):
+        return type(dataset)(
+            {name: maybe_convert_to_chatml_dataset(split, map_kwargs) for name, split in dataset.items()}
+        )
+    schema = _get_schema(dataset)
+    if schema is not None and not _needs_chatml_conversion(schema):
+        return dataset
+    return _map_arrow_batches(dataset, _convert_to_chatml_batch, **map_kwargs)
@@ -17,14 +17,18 @@ import base64
 import logging
 import socket
 import time
+from collections.abc import Iterable, Sequence
 from io import BytesIO
-from typing import Optional
+from itertools import chain
+from typing import Optional, Union
 from urllib.parse import urlparse
 
+import numpy as np
 import torch
 from torch import nn
 
-from ..import_utils import is_requests_available, is_vllm_ascend_available, is_vllm_available
+from ..import_utils import is_requests_available, is_vllm_available
+from .weight_transport import WEIGHT_TRANSPORTS
 
 
 if is_requests_available():
@@ -32,15 +36,77 @@ if is_requests_available():
     from requests import ConnectionError
 
 
-if is_vllm_available():
-    from vllm.distributed.device_communicators.pynccl import PyNcclCommunicator
-    from vllm.distributed.utils import StatelessProcessGroup
+logger = logging.getLogger(__name__)
 
-    if is_vllm_ascend_available():
-        from vllm_ascend.distributed.device_communicators.pyhccl import PyHcclCommunicator as PyNcclCommunicator
+# Default maximum size of the buckets of parameters sent to the server, in megabytes
+DEFAULT_BUCKET_SIZE_MB = 512
+# Alignment of the parameters in a bucket, in bytes. It's a multiple of the size of all the data types.
+BUCKET_ALIGNMENT = 16
+# Media type of the binary responses of the `/generate/` endpoint, see `encode_completions`
+BINARY_RESPONSE_MEDIA_TYPE = "application/x-npz"
 
 
-logger = logging.getLogger(__name__)
+def encode_completions(
+    completion_ids: Sequence[Sequence[int]], logprobs: Optional[Sequence[Sequence[float]]] = None
+) -> bytes:
+    """
+    Encodes completions, and optionally their log-probabilities, into a compact binary format: a NumPy `.npz` archive
+    with the token IDs of all the completions concatenated into a flat `int32` array (`"completion_ids"`), the offsets
+    of the completions in this array (`"offsets"`, with a trailing offset equal to the total number of tokens), and, if
+    provided, the log-probabilities concatenated the same way into a flat `float32` array (`"logprobs"`).
+
+    Args:
+        completion_ids (`Sequence[Sequence[int]]`):
+            Token IDs of the completions.
+        logprobs (`Sequence[Sequence[float]]` or `None`, *optional*, defaults to `None`):
+            Log-probabilities of the tokens of each completion.
+
+    Returns:
+        `bytes`:
+            Encoded completions, to decode with `decode_completions`.
+
+    Example:
+    ```python
+    >>> decode_completions(encode_completions([[1, 2, 3], [4, 5]]))
+    ([array([1, 2, 3], dtype=int32), array([4, 5], dtype=int32)], None)
+    ```
+    """
+    offsets = np.zeros(len(completion_ids) + 1, dtype=np.int64)
+    np.cumsum([len(ids) for ids in completion_ids], out=offsets[1:])
+    num_tokens = int(offsets[-1])
+    arrays = {
+        "completion_ids": np.fromiter(chain.from_iterable(completion_ids), dtype=np.int32, count=num_tokens),
+        "offsets": offsets,
+    }
+    if logprobs is not None:
+        arrays["logprobs"] = np.fromiter(chain.from_iterable(logprobs), dtype=np.float32, count=num_tokens)
+    buffer = BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def decode_completions(content: bytes) -> tuple[list[np.ndarray], Optional[list[np.ndarray]]]:
+    """
+    Decodes completions encoded with `encode_completions`, without converting the token IDs to Python integers.
+
+    Args:
+        content (`bytes`):
+            Encoded completions.
+
+    Returns:
+        `tuple[list[np.ndarray], Optional[list[np.ndarray]]]`:
+            Token IDs of each completion, as `int32` arrays, and log-probabilities of their tokens, as `float32`
+            arrays, if they were encoded. The arrays are views of a single flat array.
+    """
+    with np.load(BytesIO(content)) as data:
+        bounds = list(zip(data["offsets"][:-1].tolist(), data["offsets"][1:].tolist()))
+        flat_completion_ids = data["completion_ids"]
+        completion_ids = [flat_completion_ids[start:end] for start, end in bounds]
+        logprobs = None
+        if "logprobs" in data:
+            flat_logprobs = data["logprobs"]
+            logprobs = [flat_logprobs[start:end] for start, end in bounds]
+    return completion_ids, logprobs
 
 
 class VLLMClient:
@@ -63,6 +129,24 @@ class VLLMClient:
         connection_timeout (`float`, *optional*, defaults to `0.0`):
             Total timeout duration in seconds to wait for the server to be up. If the server is not up after the
             timeout, a `ConnectionError` is raised.
+        response_format (`str`, *optional*, defaults to `"json"`):
+            Format of the completions returned by the server in `generate`. Possible values are:
+
+                - `"json"`: lists of Python integers (and floats for the log-probabilities), decoded from JSON.
+                - `"binary"`: NumPy arrays, decoded from a compact binary format (see `encode_completions`) without
+                  building Python lists. This is much faster for large batches of long completions. If the server
+                  doesn't support it, it replies in JSON.
+        compress_response (`bool`, *optional*, defaults to `False`):
+            Whether to ask the server to compress the binary responses with gzip. Only used when
+            `response_format="binary"`. This reduces the size of the responses, at the cost of some CPU time on both
+            sides.
+        weight_transport (`str`, *optional*, defaults to `"nccl"`):
+            Transport used to send the weights to the server workers. Possible values are:
+
+                - `"nccl"`: broadcast from the client GPU to the server GPUs with NCCL. The client and the server can be
+                  on different nodes.
+                - `"shm"`: write the weights into a shared memory file, that the server workers map in memory. The
+                  client and the server must be on the same node, but don't need GPUs.
 
     Examples:
         Run the vLLM server with the model `Qwen/Qwen2.5-7B`:
@@ -108,11 +192,20 @@ class VLLMClient:
         server_port: int = 8000,
         group_port: int = 51216,
         connection_timeout: float = 0.0,
+        response_format: str = "json",
+        compress_response: bool = False,
+        weight_transport: str = "nccl",
     ):
         if not is_requests_available():
             raise ImportError("requests is not installed. Please install it with `pip install requests`.")
         if not is_vllm_available():
             raise ImportError("vLLM is not installed. Please install it with `pip install vllm`.")
+        if response_format not in ["json", "binary"]:
+            raise ValueError(f"Invalid response format: {response_format}. Possible values are: json, binary.")
+        if weight_transport not in WEIGHT_TRANSPORTS:
+            raise ValueError(
+                f"Invalid weight transport: {weight_transport}. Possible values are: {', '.join(WEIGHT_TRANSPORTS)}."
+            )
 
         self.session = requests.Session()
 
@@ -127,6 +220,10 @@ class VLLMClient:
             self.server_port = server_port
             self.base_url = f"http://{self.host}:{self.server_port}"
         self.group_port = group_port
+        self.response_format = response_format
+        self.compress_response = compress_response
+        self.weight_transport = weight_transport
+        self.transport = None
         self.check_server(connection_timeout)  # check server and fail after timeout
 
     def check_server(self, total_timeout: float = 0.0, retry_interval: float = 2.0):
@@ -167,7 +264,7 @@ class VLLMClient:
 
     def generate(
         self,
-        prompts: list[str],
+        prompts: Optional[list[str]] = None,
         images: Optional[list] = None,
         n: int = 1,
         repetition_penalty: float = 1.0,
@@ -178,13 +275,21 @@ class VLLMClient:
         max_tokens: int = 16,
         guided_decoding_regex: Optional[str] = None,
         generation_kwargs: Optional[dict] = None,
-    ) -> list[list[int]]:
+        return_logprobs: bool = False,
+        prompt_token_ids: Optional[list[list[int]]] = None,
+    ) -> Union[
+        list[list[int]],
+        list[np.ndarray],
+        tuple[list[list[int]], list[list[float]]],
+        tuple[list[np.ndarray], list[np.ndarray]],
+    ]:
         """
         Generates model completions for the provided prompts.
 
         Args:
-            prompts (`list[str]`):
-                List of text prompts for which the model will generate completions.
+            prompts (`list[str]` or `None`, *optional*, defaults to `None`):
+                List of text prompts for which the model will generate completions. Exactly one of `prompts` and
+                `prompt_token_ids` must be provided.
             images (`list[PIL.Image]` or `None`, *optional*, defaults to `None`):
                 List of PIL Images to send along with the prompts.
             n (`int`, *optional*, defaults to `1`):
@@ -207,11 +312,20 @@ class VLLMClient:
                 Additional generation parameters to pass to the vLLM `SamplingParams`. This can include parameters like
                 `seed`, `frequency_penalty`, etc. If it contains keys that conflict with the other parameters, they
                 will override them.
+            return_logprobs (`bool`, *optional*, defaults to `False`):
+                Whether to also return the log-probability of each generated token.
+            prompt_token_ids (`list[list[int]]` or `None`, *optional*, defaults to `None`):
+                List of tokenized prompts, to use instead of `prompts`. The server then generates from these exact
+                tokens, without tokenizing the prompts again.
 
         Returns:
-            `list[list[int]]`:
-                List of lists of token IDs representing the model-generated completions for each prompt.
+            `list[list[int]]` or `tuple[list[list[int]], list[list[float]]]`:
+                List of lists of token IDs representing the model-generated completions for each prompt. If
+                `return_logprobs=True`, a tuple of these token IDs and of the lists of their log-probabilities. With
+                `response_format="binary"`, the lists of token IDs and log-probabilities are NumPy arrays.
         """
+        if (prompts is None) == (prompt_token_ids is None):
+            raise ValueError("Exactly one of `prompts` and `prompt_token_ids` must be provided.")
         url = f"{self.base_url}/generate/"
 
         def pil_to_base64(image):
@@ -223,10 +337,18 @@ class VLLMClient:
         # Convert PIL images to base64 strings
         images = [pil_to_base64(img) for img in images] if images else None
 
+        if self.response_format == "binary":
+            # requests decompresses gzip responses transparently
+            accept_encoding = "gzip" if self.compress_response else "identity"
+            headers = {"Accept": BINARY_RESPONSE_MEDIA_TYPE, "Accept-Encoding": accept_encoding}
+        else:
+            headers = None
+
         response = self.session.post(
             url,
             json={
                 "prompts": prompts,
+                "prompt_token_ids": prompt_token_ids,
                 "images": images,
                 "n": n,
                 "repetition_penalty": repetition_penalty,
@@ -237,10 +359,20 @@ class VLLMClient:
                 "max_tokens": max_tokens,
                 "guided_decoding_regex": guided_decoding_regex,
                 "generation_kwargs": generation_kwargs or {},
+                "return_logprobs": return_logprobs,
             },
+            headers=headers,
         )
         if response.status_code == 200:
-            return response.json()["completion_ids"]
+            # The server may not support the binary format, so we decode the response according to its content type
+            if response.headers.get("Content-Type", "").startswith(BINARY_RESPONSE_MEDIA_TYPE):
+                completion_ids, logprobs = decode_completions(response.content)
+            else:
+                output = response.json()
+                completion_ids, logprobs = output["completion_ids"], output.get("logprobs")
+            if return_logprobs:
+                return completion_ids, logprobs
+            return completion_ids
         else:
             raise Exception(f"Request failed: {response.status_code}, {response.text}")
 
@@ -260,9 +392,19 @@ class VLLMClient:
         self.rank = vllm_world_size  # the client's rank is the last process
 
         # Initialize weight update group
+        self.transport = WEIGHT_TRANSPORTS[self.weight_transport]()
         url = f"{self.base_url}/init_communicator/"
         # In the server side, the host is set to 0.0.0.0
-        response = self.session.post(url, json={"host": "0.0.0.0", "port": self.group_port, "world_size": world_size})
+        response = self.session.post(
+            url,
+            json={
+                "host": "0.0.0.0",
+                "port": self.group_port,
+                "world_size": world_size,
+                "transport": self.weight_transport,
+                "transport_kwargs": self.transport.get_worker_kwargs(),
+            },
+        )
         if response.status_code != 200:
             raise Exception(f"Request failed: {response.status_code}, {response.text}")
 
@@ -271,16 +413,15 @@ class VLLMClient:
         # [W416 23:24:57.460001114 socket.cpp:204] [c10d] The hostname of the client socket cannot be retrieved. err=-3
         time.sleep(0.1)
 
-        # Set up the communication group for weight broadcasting
-        pg = StatelessProcessGroup.create(host=self.host, port=self.group_port, rank=self.rank, world_size=world_size)
-        self.pynccl_comm = PyNcclCommunicator(pg, device=0)
+        # Set up the transport for weight updates (e.g., the communication group for weight broadcasting)
+        self.transport.init_client(self.host, self.group_port, self.rank, world_size)
 
         # When the client object is deleted, close the weight update group
         atexit.register(self.close_communicator)
 
     def update_named_param(self, name: str, weights: torch.Tensor):
         """
-        Updates a specific named parameter in the model and broadcasts it to other processes.
+        Updates a specific named parameter in the model and sends it to other processes.
 
         Args:
             name (`str`):
@@ -290,25 +431,76 @@ class VLLMClient:
         """
         dtype, shape = str(weights.dtype), tuple(weights.shape)
         url = f"{self.base_url}/update_named_param/"
-        response = self.session.post(url, json={"name": name, "dtype": dtype, "shape": shape})
-        if response.status_code != 200:
-            raise Exception(f"Request failed: {response.status_code}, {response.text}")
 
-        # Broadcast the weights to the other processes
-        self.pynccl_comm.broadcast(weights, src=self.rank)
-        self.pynccl_comm.group.barrier()
+        def request():
+            response = self.session.post(url, json={"name": name, "dtype": dtype, "shape": shape})
+            if response.status_code != 200:
+                raise Exception(f"Request failed: {response.status_code}, {response.text}")
+
+        # Send the weights to the other processes
+        self.transport.send(weights.detach().contiguous().view(-1).view(torch.uint8), request)
 
-    def update_model_params(self, model: nn.Module):
+    def update_named_params(
+        self, named_params: Iterable[tuple[str, torch.Tensor]], bucket_size_mb: float = DEFAULT_BUCKET_SIZE_MB
+    ):
         """
-        Updates all parameters of the given model by calling `update_named_param` for each parameter in the model.
+        Updates several named parameters in the model, packed into contiguous buckets. Each bucket is sent with a
+        single request, listing the names, data types, shapes and offsets of its parameters, and a single transfer
+        through the weight transport.
+
+        Each tensor is copied into the current bucket as soon as it's yielded, so `named_params` can be a generator
+        yielding tensors that are only valid until the next one is requested (e.g., gathered from shards).
+
+        Args:
+            named_params (`Iterable[tuple[str, torch.Tensor]]`):
+                Names of the layers whose weights are being updated, and tensors containing the updated weights.
+            bucket_size_mb (`float`, *optional*, defaults to `512`):
+                Maximum size of a bucket, in megabytes. A tensor bigger than this size is sent alone in its bucket.
+        """
+        max_bucket_size = int(bucket_size_mb * 1024 * 1024)
+        bucket, metadata = None, []
+        offset = 0
+        for name, weights in named_params:
+            nbytes = weights.numel() * weights.element_size()
+            # Send the current bucket if the tensor doesn't fit in it
+            if metadata and (offset + nbytes > max_bucket_size or weights.device != bucket.device):
+                self._update_bucket(bucket[:offset], metadata)
+                metadata, offset = [], 0
+            if bucket is None or bucket.device != weights.device or nbytes > bucket.numel():
+                bucket = torch.empty(max(max_bucket_size, nbytes), dtype=torch.uint8, device=weights.device)
+            bucket[offset : offset + nbytes].copy_(weights.detach().contiguous().view(-1).view(torch.uint8))
+            metadata.append((name, str(weights.dtype), tuple(weights.shape), offset))
+            # Align the offsets so that each tensor can be viewed with its data type on the server side
+            offset += -(-nbytes // BUCKET_ALIGNMENT) * BUCKET_ALIGNMENT
+        if metadata:
+            self._update_bucket(bucket[:offset], metadata)
+
+    def _update_bucket(self, bucket: torch.Tensor, metadata: list[tuple[str, str, tuple[int, ...], int]]):
+        names, dtypes, shapes, offsets = (list(values) for values in zip(*metadata))
+        url = f"{self.base_url}/update_named_params/"
+
+        def request():
+            response = self.session.post(
+                url,
+                json={"names": names, "dtypes": dtypes, "shapes": shapes, "offsets": offsets, "size": len(bucket)},
+            )
+            if response.status_code != 200:
+                raise Exception(f"Request failed: {response.status_code}, {response.text}")
+
+        # Send the bucket to the other processes
+        self.transport.send(bucket, request)
+
+    def update_model_params(self, model: nn.Module, bucket_size_mb: float = DEFAULT_BUCKET_SIZE_MB):
+        """
+        Updates all parameters of the given model by calling `update_named_params` with the parameters of the model.
 
         Args:
             model (`nn.Module`):
                 Model whose parameters (weights/biases) are to be updated.
+            bucket_size_mb (`float`, *optional*, defaults to `512`):
+                Maximum size of a bucket of parameters, in megabytes. See `update_named_params`.
         """
-        for name, param in model.named_parameters():
-            # Update each parameter individually
-            self.update_named_param(name, param.data)
+        self.update_named_params(((name, param.data) for name, param in model.named_parameters()), bucket_size_mb)
 
     def reset_prefix_cache(self):
         """
@@ -319,6 +511,23 @@ class VLLMClient:
         if response.status_code != 200:
             raise Exception(f"Request failed: {response.status_code}, {response.text}")
 
+    def get_worker_metrics(self) -> dict[str, list[float]]:
+        """
+        Retrieves the metrics of each data parallel worker of the server, summed over all the generation requests so
+        far: the time spent generating (`"busy_time"`), the time spent waiting for the slowest worker (`"idle_time"`),
+        the number of prompts (`"num_prompts"`) and the number of generated tokens (`"num_completion_tokens"`).
+
+        Returns:
+            `dict[str, list[float]]`:
+                Dictionary mapping each metric name to its values, one per data parallel worker.
+        """
+        url = f"{self.base_url}/get_worker_metrics/"
+        response = self.session.get(url)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            raise Exception(f"Request failed: {response.status_code}, {response.text}")
+
     def close_communicator(self):
         """
         Closes the weight update group and cleans up the communication group.
@@ -334,6 +543,10 @@ class VLLMClient:
             if response.status_code != 200:
                 raise Exception(f"Request failed: {response.status_code}, {response.text}")
 
+        if self.transport is not None:
+            self.transport.close_client()
+            self.transport = None
+
 
 # Example usage
 if __name__ == "__main__":
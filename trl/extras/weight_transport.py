@@ -0,0 +1,231 @@
+# Copyright 2020-2025 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import uuid
+from typing import Callable, Optional
+
+import torch
+
+from ..import_utils import is_vllm_ascend_available, is_vllm_available
+
+
+if is_vllm_available():
+    from vllm.distributed.device_communicators.pynccl import PyNcclCommunicator
+    from vllm.distributed.utils import StatelessProcessGroup
+
+    if is_vllm_ascend_available():
+        from vllm_ascend.distributed.device_communicators.pyhccl import PyHcclCommunicator as PyNcclCommunicator
+
+
+class WeightTransport:
+    """
+    Base class of the transports moving updated weights from a `VLLMClient` (the trainer) to the workers of a vLLM
+    server started with `trl vllm-serve`.
+
+    Weights are sent as flat `torch.uint8` buffers, with the metadata needed to unpack them (names, data types, shapes,
+    offsets) sent separately in the HTTP request. Each transport has a client side (`get_worker_kwargs`, `init_client`,
+    `send`, `close_client`) and a worker side (`init_worker`, `receive`, `close_worker`), each used by a separate
+    instance.
+    """
+
+    # Whether the server must wait for the workers to receive the weights before replying to the update request. This
+    # is the case when the client can only reuse its buffer once the workers are done reading it.
+    synchronous = False
+
+    # Client side
+
+    def get_worker_kwargs(self) -> dict:
+        """
+        Returns the keyword arguments to pass to `init_worker` on the server side, sent with the `init_communicator`
+        request.
+        """
+        return {}
+
+    def init_client(self, host: str, port: int, rank: int, world_size: int) -> None:
+        """
+        Initializes the client side of the transport, once the server has been asked to initialize the workers.
+
+        Args:
+            host (`str`):
+                IP address of the vLLM server.
+            port (`int`):
+                Port number for the weight update group.
+            rank (`int`):
+                Rank of the client in the weight update group, which is the last one.
+            world_size (`int`):
+                Total number of participating processes in the group.
+        """
+
+    def send(self, buffer: torch.Tensor, request: Callable[[], None]) -> None:
+        """
+        Sends a buffer to all the workers.
+
+        Args:
+            buffer (`torch.Tensor`):
+                Flat `torch.uint8` tensor to send.
+            request (`Callable[[], None]`):
+                Function sending the update request to the server, which makes the workers call `receive`.
+        """
+        raise NotImplementedError
+
+    def close_client(self) -> None:
+        """
+        Releases the resources of the client side of the transport.
+        """
+
+    # Worker side
+
+    def init_worker(self, host: str, port: int, rank: int, world_size: int, device: torch.device, **kwargs) -> None:
+        """
+        Initializes the worker side of the transport.
+
+        Args:
+            host (`str`):
+                Hostname or IP address of the master node.
+            port (`int`):
+                Port number to be used for communication.
+            rank (`int`):
+                Rank of the worker in the global world group.
+            world_size (`int`):
+                Total number of participating processes in the group.
+            device (`torch.device`):
+                Device of the worker.
+            **kwargs:
+                Keyword arguments returned by `get_worker_kwargs` on the client side.
+        """
+
+    def receive(self, size: int) -> torch.Tensor:
+        """
+        Receives a buffer sent by the client.
+
+        Args:
+            size (`int`):
+                Size of the buffer, in bytes.
+
+        Returns:
+            `torch.Tensor`:
+                Flat `torch.uint8` tensor of `size` elements. It's only valid until the next call to `receive`.
+        """
+        raise NotImplementedError
+
+    def close_worker(self) -> None:
+        """
+        Releases the resources of the worker side of the transport.
+        """
+
+
+class NCCLWeightTransport(WeightTransport):
+    """
+    Transport broadcasting the weights from the client GPU to the worker GPUs with NCCL, through a
+    `PyNcclCommunicator` over a `StatelessProcessGroup`. The client and the server can be on different nodes.
+    """
+
+    pynccl_comm = None  # Communicator for weight updates
+    client_rank = None  # Source rank for broadcasting updated weights
+
+    def init_client(self, host: str, port: int, rank: int, world_size: int) -> None:
+        pg = StatelessProcessGroup.create(host=host, port=port, rank=rank, world_size=world_size)
+        self.pynccl_comm = PyNcclCommunicator(pg, device=0)
+        self.client_rank = rank
+
+    def send(self, buffer: torch.Tensor, request: Callable[[], None]) -> None:
+        # The workers must be waiting for the broadcast before it starts
+        request()
+        self.pynccl_comm.broadcast(buffer, src=self.client_rank)
+        self.pynccl_comm.group.barrier()
+
+    def close_client(self) -> None:
+        self.pynccl_comm = None
+
+    def init_worker(self, host: str, port: int, rank: int, world_size: int, device: torch.device, **kwargs) -> None:
+        pg = StatelessProcessGroup.create(host=host, port=port, rank=rank, world_size=world_size)
+        self.pynccl_comm = PyNcclCommunicator(pg, device=device)
+        # The client process that sends updated weights has the highest rank (world_size - 1).
+        self.client_rank = world_size - 1
+        self.device = device
+
+    def receive(self, size: int) -> torch.Tensor:
+        buffer = torch.empty(size, dtype=torch.uint8, device=self.device)
+        self.pynccl_comm.broadcast(buffer, src=self.client_rank)
+        self.pynccl_comm.group.barrier()
+        return buffer
+
+    def close_worker(self) -> None:
+        self.pynccl_comm = None
+        self.client_rank = None
+
+
+class SharedMemoryWeightTransport(WeightTransport):
+    """
+    Transport writing the weights into a file in shared memory (`/dev/shm` when available, the temporary directory
+    otherwise), which the workers map in memory and load from without copying it. The client and the server must be on
+    the same node, but don't need GPUs.
+
+    The client creates the file and grows it to the size of the largest buffer sent. Since the client overwrites the
+    file with each buffer, the server only replies to an update request once all the workers have loaded the weights.
+    """
+
+    synchronous = True
+
+    path = None  # Path of the shared file
+    mapped_buffer = None  # Client-side mapping of the shared file
+
+    def get_worker_kwargs(self) -> dict:
+        directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        self.path = os.path.join(directory, f"trl-weights-{uuid.uuid4().hex}")
+        open(self.path, "wb").close()
+        return {"path": self.path}
+
+    def send(self, buffer: torch.Tensor, request: Callable[[], None]) -> None:
+        size = buffer.numel()
+        if self.mapped_buffer is None or size > self.mapped_buffer.numel():
+            os.truncate(self.path, size)
+            self.mapped_buffer = torch.from_file(self.path, shared=True, size=size, dtype=torch.uint8)
+        self.mapped_buffer[:size].copy_(buffer)
+        request()
+
+    def close_client(self) -> None:
+        self.mapped_buffer = None
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+
+    def init_worker(
+        self,
+        host: str,
+        port: int,
+        rank: int,
+        world_size: int,
+        device: torch.device,
+        path: Optional[str] = None,
+        **kwargs,
+    ) -> None:
+        if path is None or not os.path.exists(path):
+            raise FileNotFoundError(
+                f"The shared memory file {path} doesn't exist. The shared memory weight transport requires the client "
+                "and the server to run on the same node."
+            )
+        self.path = path
+
+    def receive(self, size: int) -> torch.Tensor:
+        # Maps the file with `mmap`, without reading it
+        return torch.from_file(self.path, shared=True, size=size, dtype=torch.uint8)
+
+    def close_worker(self) -> None:
+        self.path = None
+
+
+WEIGHT_TRANSPORTS = {"nccl": NCCLWeightTransport, "shm": SharedMemoryWeightTransport}
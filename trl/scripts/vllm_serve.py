@@ -13,33 +13,41 @@
 # limitations under the License.
 
 import argparse
+import asyncio
 import base64
+import gzip
+import heapq
+import itertools
 import logging
+import math
 import os
+import queue
+import threading
+import time
 from collections.abc import Sequence
 from contextlib import asynccontextmanager
 from dataclasses import dataclass, field
 from io import BytesIO
-from itertools import chain
 from multiprocessing import Pipe, Process
 from multiprocessing.connection import Connection
-from typing import Optional
+from typing import Any, Optional
 
 import torch
 from transformers import is_vision_available
 
 from trl import TrlParser
+from trl.extras.vllm_client import BINARY_RESPONSE_MEDIA_TYPE, encode_completions
+from trl.extras.weight_transport import WEIGHT_TRANSPORTS
 from trl.import_utils import (
     is_fastapi_available,
     is_pydantic_available,
     is_uvicorn_available,
-    is_vllm_ascend_available,
     is_vllm_available,
 )
 
 
 if is_fastapi_available():
-    from fastapi import FastAPI
+    from fastapi import FastAPI, Request, Response
 
 
 if is_pydantic_available():
@@ -56,18 +64,16 @@ if is_vision_available():
 
 if is_vllm_available():
     from vllm import LLM, SamplingParams
-    from vllm.distributed.device_communicators.pynccl import PyNcclCommunicator
     from vllm.distributed.parallel_state import get_world_group
-    from vllm.distributed.utils import StatelessProcessGroup
     from vllm.sampling_params import GuidedDecodingParams
     from vllm.utils import get_open_port
 
-    if is_vllm_ascend_available():
-        from vllm_ascend.distributed.device_communicators.pyhccl import PyHcclCommunicator as PyNcclCommunicator
-
 
 logger = logging.getLogger(__name__)
 
+# Average number of characters per token, to estimate the length of text prompts for load balancing
+CHARS_PER_TOKEN = 4
+
 # We use CUDA with multiprocessing, so we must use the 'spawn' start method. Otherwise, we will get the following
 # error: RuntimeError: Cannot re-initialize CUDA in forked subprocess. To use CUDA with multiprocessing, you must use
 # the 'spawn' start method
@@ -78,21 +84,24 @@ class WeightSyncWorkerExtension:
     """
     A vLLM worker extension that enables weight synchronization between a client and multiple server workers.
 
-    This worker uses a `StatelessProcessGroup` to establish communication and a `PyNcclCommunicator` to handle
-    efficient GPU-based communication using NCCL. The primary purpose of this class is to receive updated model weights
-    from a client process and distribute them to all worker processes participating in model inference.
+    The weights are received through a weight transport (see `trl.extras.weight_transport`): either a
+    `PyNcclCommunicator` over a `StatelessProcessGroup`, to handle efficient GPU-based communication using NCCL, or a
+    file in shared memory, when the client runs on the same node. The primary purpose of this class is to receive
+    updated model weights from a client process and distribute them to all worker processes participating in model
+    inference.
     """
 
-    # The following attributes are initialized when `init_communicator` method is called.
-    pynccl_comm = None  # Communicator for weight updates
-    client_rank = None  # Source rank for broadcasting updated weights
+    # The following attribute is initialized when `init_communicator` method is called.
+    transport = None  # Transport for weight updates
 
-    def init_communicator(self, host: str, port: int, world_size: int) -> None:
+    def init_communicator(
+        self, host: str, port: int, world_size: int, transport: str = "nccl", transport_kwargs: Optional[dict] = None
+    ) -> None:
         """
-        Initializes the weight update communicator using a stateless process group.
+        Initializes the weight update transport.
 
-        This method creates a `StatelessProcessGroup` that allows external training processes to communicate with vLLM
-        workers without interfering with the global torch distributed group.
+        With the NCCL transport, this method creates a `StatelessProcessGroup` that allows external training processes
+        to communicate with vLLM workers without interfering with the global torch distributed group.
 
         Args:
             host (`str`):
@@ -101,21 +110,19 @@ class WeightSyncWorkerExtension:
                 Port number to be used for communication.
             world_size (`int`):
                 Total number of participating processes in the update group.
+            transport (`str`, *optional*, defaults to `"nccl"`):
+                Name of the weight transport, `"nccl"` or `"shm"`.
+            transport_kwargs (`dict` or `None`, *optional*, defaults to `None`):
+                Keyword arguments of the transport sent by the client, e.g. the path of the shared memory file.
         """
-        if self.pynccl_comm is not None:
+        if self.transport is not None:
             raise RuntimeError("Weight update group already initialized. Call close_communicator first.")
 
         # Get the rank of the current worker in the global world group.
         rank = get_world_group().rank
 
-        # Create a stateless process group to manage communication between training processes and vLLM workers.
-        pg = StatelessProcessGroup.create(host=host, port=port, rank=rank, world_size=world_size)
-
-        # Initialize the NCCL-based communicator for weight synchronization.
-        self.pynccl_comm = PyNcclCommunicator(pg, device=self.device)
-
-        # The client process that sends updated weights has the highest rank (world_size - 1).
-        self.client_rank = world_size - 1
+        self.transport = WEIGHT_TRANSPORTS[transport]()
+        self.transport.init_worker(host, port, rank, world_size, self.device, **(transport_kwargs or {}))
 
     def update_named_param(self, name: str, dtype: str, shape: Sequence[int]) -> None:
         """
@@ -129,31 +136,65 @@ class WeightSyncWorkerExtension:
             shape (`Sequence[int]`):
                 Shape of the weight tensor.
         """
-        if self.pynccl_comm is None:
+        if self.transport is None:
             raise RuntimeError("Communicator not initialized. Call `init_communicator` first.")
 
         dtype = getattr(torch, dtype.split(".")[-1])
-        # Allocate memory for the incoming weight tensor on the correct device.
-        weight = torch.empty(shape, dtype=dtype, device=self.device)
-
-        # Use NCCL to broadcast the updated weights from the client (src) to all workers.
-        self.pynccl_comm.broadcast(weight, src=self.client_rank)
-        self.pynccl_comm.group.barrier()
+        # Receive the updated weights from the client (src).
+        buffer = self.transport.receive(math.prod(shape) * dtype.itemsize)
+        weight = buffer.view(dtype).view(shape)
 
         # Load the received weights into the model.
         self.model_runner.model.load_weights(weights=[(name, weight)])
 
+    def update_named_params(
+        self,
+        names: Sequence[str],
+        dtypes: Sequence[str],
+        shapes: Sequence[Sequence[int]],
+        offsets: Sequence[int],
+        size: int,
+    ) -> None:
+        """
+        Receives a bucket of updated weights from the client process, as a single contiguous buffer, and updates the
+        named parameters in the model with a single call to `load_weights`.
+
+        Args:
+            names (`Sequence[str]`):
+                Names of the weight tensors being updated.
+            dtypes (`Sequence[str]`):
+                Data types of the weight tensors as strings (e.g., `"torch.float32"`).
+            shapes (`Sequence[Sequence[int]]`):
+                Shapes of the weight tensors.
+            offsets (`Sequence[int]`):
+                Offsets of the weight tensors in the bucket, in bytes.
+            size (`int`):
+                Size of the bucket, in bytes.
+        """
+        if self.transport is None:
+            raise RuntimeError("Communicator not initialized. Call `init_communicator` first.")
+
+        # Receive the bucket from the client (src).
+        bucket = self.transport.receive(size)
+
+        # Unpack the bucket into views of the weight tensors, and load them into the model.
+        weights = []
+        for name, dtype, shape, offset in zip(names, dtypes, shapes, offsets):
+            dtype = getattr(torch, dtype.split(".")[-1])
+            nbytes = math.prod(shape) * dtype.itemsize
+            weights.append((name, bucket[offset : offset + nbytes].view(dtype).view(shape)))
+        self.model_runner.model.load_weights(weights=weights)
+
     def close_communicator(self) -> None:
         """
         Closes the communicator when weight synchronization is no longer needed.
 
-        This method deletes the NCCL communicator to release associated resources.
+        This method closes the weight transport to release associated resources (e.g., the NCCL communicator).
         """
 
-        if self.pynccl_comm is not None:
-            del self.pynccl_comm
-            self.pynccl_comm = None  # Ensure attribute is reset to None
-            self.client_rank = None  # Ensure attribute is reset to None
+        if self.transport is not None:
+            self.transport.close_worker()
+            self.transport = None  # Ensure attribute is reset to None
 
 
 @dataclass
@@ -200,6 +241,12 @@ class ScriptArguments:
         log_level (`str`, *optional*, defaults to `"info"`):
             Log level for uvicorn. Possible choices: `"critical"`, `"error"`, `"warning"`, `"info"`, `"debug"`,
             `"trace"`.
+        load_balancing (`str`, *optional*, defaults to `"tokens"`):
+            How the prompts of a request are split across the data parallel workers. Possible values are:
+
+                - `"tokens"`: balance the estimated number of tokens processed by each worker, `n * (prompt length +
+                  max_tokens)` for each prompt, so that workers finish at about the same time.
+                - `"count"`: give each worker the same number of consecutive prompts.
     """
 
     model: str = field(
@@ -284,6 +331,16 @@ class ScriptArguments:
             "'trace'."
         },
     )
+    load_balancing: str = field(
+        default="tokens",
+        metadata={
+            "help": "How the prompts of a request are split across the data parallel workers. 'tokens': balance the "
+            "estimated number of tokens processed by each worker, `n * (prompt length + max_tokens)` for each prompt, "
+            "so that workers finish at about the same time. 'count': give each worker the same number of consecutive "
+            "prompts.",
+            "choices": ["tokens", "count"],
+        },
+    )
 
 
 def llm_worker(
@@ -315,25 +372,204 @@ def llm_worker(
     # Send ready signal to parent process
     connection.send({"status": "ready"})
 
+    serve_worker(llm, connection)
+
+
+def serve_worker(llm, connection: Connection) -> None:
+    """
+    Runs the commands sent by a `WorkerDispatcher` on the engine of a data parallel worker, until a `"shutdown"`
+    command is received.
+
+    Each command is a dictionary with the `"type"` of the command (`"call"`, `"fire_and_forget"` or `"shutdown"`), a
+    `"request_id"`, and the `"method"` of the engine to call with its `"args"` and `"kwargs"`. For `"call"` commands,
+    the result is sent back as `{"request_id": ..., "result": ...}`, or `{"request_id": ..., "error": ...}` if the call
+    failed. Commands are run in the order they are received, except that the `"generate"` commands already waiting in
+    the pipe are batched into a single call of the engine.
+
+    Args:
+        llm (`vllm.LLM`):
+            Engine of the worker.
+        connection (`multiprocessing.connection.Connection`):
+            Connection to the main process.
+    """
+    next_command = None
     while True:
         # Wait for commands from the parent process
         try:
-            command = connection.recv()
+            command = next_command if next_command is not None else connection.recv()
         except KeyboardInterrupt:
             llm.collective_rpc(method="close_communicator")
             break
+        next_command = None
 
-        # Handle commands
-        if command["type"] in ["call", "fire_and_forget"]:
-            method_name = command["method"]
-            args, kwargs = command.get("args", ()), command.get("kwargs", {})
-            method = getattr(llm, method_name)
-            result = method(*args, **kwargs)
-            if command["type"] == "call":
-                connection.send(result)
-        elif command["type"] == "shutdown":
+        if command["type"] == "shutdown":
             break
 
+        commands = [command]
+        if command["method"] == "generate":
+            # Batch the generation requests that are already waiting, so that the engine schedules them together
+            while connection.poll():
+                next_command = connection.recv()
+                if next_command["type"] != "call" or next_command["method"] != "generate":
+                    break
+                commands.append(next_command)
+                next_command = None
+
+        try:
+            if len(commands) == 1:
+                args, kwargs = command.get("args", ()), command.get("kwargs", {})
+                results = [getattr(llm, command["method"])(*args, **kwargs)]
+            else:
+                results = generate_batch(llm, [command["kwargs"] for command in commands])
+        except Exception as exc:
+            logger.exception(f"Command {command['method']} failed")
+            replies = [
+                {"request_id": command["request_id"], "error": f"{type(exc).__name__}: {exc}"} for command in commands
+            ]
+        else:
+            replies = [
+                {"request_id": command["request_id"], "result": result} for command, result in zip(commands, results)
+            ]
+        for command, reply in zip(commands, replies):
+            if command["type"] == "call":
+                connection.send(reply)
+
+
+def generate_batch(llm, requests: list[dict]) -> list[list]:
+    """
+    Generates the completions of several generation requests with a single call of the engine, using the sampling
+    parameters of each request for its prompts.
+
+    Args:
+        llm (`vllm.LLM`):
+            Engine of the worker.
+        requests (`list[dict]`):
+            Keyword arguments of `LLM.generate` for each request, with the `"prompts"` and their `"sampling_params"`.
+
+    Returns:
+        `list[list[vllm.RequestOutput]]`:
+            Outputs of the prompts of each request.
+    """
+    prompts, sampling_params = [], []
+    for request in requests:
+        prompts.extend(request["prompts"])
+        sampling_params.extend([request["sampling_params"]] * len(request["prompts"]))
+    outputs = llm.generate(prompts=prompts, sampling_params=sampling_params)
+    results, start = [], 0
+    for request in requests:
+        results.append(outputs[start : start + len(request["prompts"])])
+        start += len(request["prompts"])
+    return results
+
+
+class WorkerDispatcher:
+    """
+    Sends commands to a data parallel worker, which runs `serve_worker`, and routes their results back to the
+    coroutines awaiting them, without blocking the event loop of the server.
+
+    Commands are written to the pipe in order by a sender thread, since writing a large command blocks until the worker
+    reads it, and results are read by a receiver thread, which matches them with their command by request ID. Several
+    requests can then be in flight at the same time, and the worker batches the generation ones.
+
+    Args:
+        connection (`multiprocessing.connection.Connection`):
+            Connection to the worker process.
+    """
+
+    def __init__(self, connection: Connection):
+        self.connection = connection
+        self._commands = queue.Queue()
+        self._pending = {}  # request ID -> (event loop, future)
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count()
+        threading.Thread(target=self._send_commands, daemon=True).start()
+        threading.Thread(target=self._receive_results, daemon=True).start()
+
+    async def call(self, method: str, args: tuple = (), kwargs: Optional[dict] = None) -> Any:
+        """
+        Calls a method of the worker engine and waits for its result.
+
+        Args:
+            method (`str`):
+                Name of the method of the engine (e.g., `"generate"` or `"collective_rpc"`).
+            args (`tuple`, *optional*, defaults to `()`):
+                Positional arguments of the method.
+            kwargs (`dict` or `None`, *optional*, defaults to `None`):
+                Keyword arguments of the method.
+
+        Returns:
+            `Any`:
+                Result of the method.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        request_id = next(self._request_ids)
+        with self._lock:
+            self._pending[request_id] = (loop, future)
+        command = {"type": "call", "request_id": request_id, "method": method, "args": args, "kwargs": kwargs or {}}
+        self._commands.put(command)
+        return await future
+
+    def send(self, method: str, args: tuple = (), kwargs: Optional[dict] = None) -> None:
+        """
+        Calls a method of the worker engine without waiting for it, nor for its result. Like all the commands, it runs
+        after the commands sent before it.
+
+        Args:
+            method (`str`):
+                Name of the method of the engine.
+            args (`tuple`, *optional*, defaults to `()`):
+                Positional arguments of the method.
+            kwargs (`dict` or `None`, *optional*, defaults to `None`):
+                Keyword arguments of the method.
+        """
+        request_id = next(self._request_ids)
+        command = {"type": "fire_and_forget", "request_id": request_id, "method": method, "args": args}
+        command["kwargs"] = kwargs or {}
+        self._commands.put(command)
+
+    def shutdown(self) -> None:
+        """
+        Asks the worker to stop once it has run the commands sent before.
+        """
+        self._commands.put({"type": "shutdown"})
+
+    def _send_commands(self) -> None:
+        while True:
+            command = self._commands.get()
+            try:
+                self.connection.send(command)
+            except (BrokenPipeError, OSError):
+                return
+            if command["type"] == "shutdown":
+                return
+
+    def _receive_results(self) -> None:
+        while True:
+            try:
+                message = self.connection.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                loop, future = self._pending.pop(message["request_id"])
+            loop.call_soon_threadsafe(self._set_result, future, message)
+
+        # The worker exited, so the pending commands will never complete
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for loop, future in pending.values():
+            message = {"error": "The worker process exited."}
+            loop.call_soon_threadsafe(self._set_result, future, message)
+
+    @staticmethod
+    def _set_result(future: asyncio.Future, message: dict) -> None:
+        if future.done():  # e.g., cancelled
+            return
+        if "error" in message:
+            future.set_exception(RuntimeError(message["error"]))
+        else:
+            future.set_result(message["result"])
+
 
 def chunk_list(lst: list, n: int) -> list[list]:
     """
@@ -355,6 +591,44 @@ def chunk_list(lst: list, n: int) -> list[list]:
     return [lst[i * k + min(i, r) : (i + 1) * k + min(i + 1, r)] for i in range(n)]
 
 
+def balance_by_cost(costs: Sequence[float], n: int) -> list[list[int]]:
+    """
+    Split the indices of `costs` into `n` sublists with total costs as close as possible, by assigning the items from
+    the most to the least costly to the sublist with the lowest total cost so far. The indices of each sublist are
+    sorted.
+
+    Example:
+    ```python
+    >>> balance_by_cost([5, 1, 1, 1, 1, 1], 2)
+    [[0], [1, 2, 3, 4, 5]]
+
+    >>> balance_by_cost([3, 3, 2, 2, 2], 2)
+    [[0, 2, 4], [1, 3]]
+
+    >>> balance_by_cost([1, 2], 3)
+    [[1], [0], []]
+    ```
+    """
+    heap = [(0.0, rank) for rank in range(n)]  # (total cost, rank) of each sublist
+    chunks = [[] for _ in range(n)]
+    for index in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        total_cost, rank = heapq.heappop(heap)
+        chunks[rank].append(index)
+        heapq.heappush(heap, (total_cost + costs[index], rank))
+    return [sorted(chunk) for chunk in chunks]
+
+
+def estimate_prompt_length(prompt: dict) -> int:
+    """
+    Estimates the number of tokens of a prompt, as passed to `LLM.generate`: the number of token IDs of tokenized
+    prompts, or, since the server doesn't tokenize text prompts itself, the number of characters of text prompts
+    divided by `CHARS_PER_TOKEN`.
+    """
+    if "prompt_token_ids" in prompt:
+        return len(prompt["prompt_token_ids"])
+    return len(prompt["prompt"]) // CHARS_PER_TOKEN + 1
+
+
 def main(script_args: ScriptArguments):
     if not is_fastapi_available():
         raise ImportError(
@@ -377,6 +651,7 @@ def main(script_args: ScriptArguments):
     # Spawn dp workers, and setup pipes for communication
     master_port = get_open_port()
     connections = []
+    dispatchers = []  # created once the workers are ready
     processes = []
     for data_parallel_rank in range(script_args.data_parallel_size):
         parent_connection, child_connection = Pipe()
@@ -395,9 +670,14 @@ def main(script_args: ScriptArguments):
                 if isinstance(msg, dict) and msg.get("status") == "ready":
                     ready_connections.add(connection)
 
+        # From now on, the workers are only reached through the dispatchers, without blocking the event loop
+        dispatchers.extend(WorkerDispatcher(connection) for connection in connections)
+
         yield
 
         # Wait for processes to terminate
+        for dispatcher in dispatchers:
+            dispatcher.shutdown()
         for process in processes:
             process.join(timeout=10)  # Wait for 10 seconds for the process to terminate
             if process.is_alive():
@@ -431,8 +711,62 @@ def main(script_args: ScriptArguments):
         """
         return {"world_size": script_args.tensor_parallel_size * script_args.data_parallel_size}
 
+    # Cumulative metrics of each data parallel worker over the generation requests
+    worker_metrics = {
+        "busy_time": [0.0] * script_args.data_parallel_size,
+        "idle_time": [0.0] * script_args.data_parallel_size,
+        "num_prompts": [0] * script_args.data_parallel_size,
+        "num_completion_tokens": [0] * script_args.data_parallel_size,
+    }
+
+    @app.get("/get_worker_metrics/")
+    async def get_worker_metrics():
+        """
+        Retrieves the metrics of each data parallel worker, summed over all the generation requests so far. They show
+        how well the prompts are balanced across the workers (see the `load_balancing` argument).
+
+        Returns:
+            `dict`:
+                A dictionary with, for each metric, a list of values, one per data parallel worker:
+                - `busy_time` (list of `float`): Time, in seconds, the worker spent with generation requests in flight.
+                - `idle_time` (list of `float`): Time, in seconds, the worker waited for the slowest worker to finish
+                  the same requests.
+                - `num_prompts` (list of `int`): Number of prompts the worker generated completions for.
+                - `num_completion_tokens` (list of `int`): Number of tokens the worker generated.
+
+        Example response:
+        ```json
+        {"busy_time": [52.1, 50.7], "idle_time": [0.3, 1.7], "num_prompts": [96, 160], "num_completion_tokens": [18592, 17908]}
+        ```
+        """
+        return worker_metrics
+
+    # Number of generation requests in flight on each worker, and since when the worker is busy with them
+    num_in_flight = [0] * script_args.data_parallel_size
+    busy_start_times = [0.0] * script_args.data_parallel_size
+
+    async def generate_on_worker(rank: int, prompts: list, sampling_params: SamplingParams) -> tuple[list, float]:
+        # Generates the completions of a chunk of prompts on a worker, and returns them with the time they were
+        # received. A worker is busy as long as it has generation requests in flight.
+        if num_in_flight[rank] == 0:
+            busy_start_times[rank] = time.perf_counter()
+        num_in_flight[rank] += 1
+        # When the number of prompts is less than data_parallel_size, some workers will receive empty prompts.
+        # However, vLLM requires that we always send at least one prompt. So we send a placeholder prompt to comply
+        # with vLLM's requirement, and we later ignore the result.
+        kwargs = {"prompts": prompts or ["<placeholder>"], "sampling_params": sampling_params}
+        try:
+            outputs = await dispatchers[rank].call("generate", kwargs=kwargs)
+        finally:
+            end_time = time.perf_counter()
+            num_in_flight[rank] -= 1
+            if num_in_flight[rank] == 0:
+                worker_metrics["busy_time"][rank] += end_time - busy_start_times[rank]
+        return outputs, end_time
+
     class GenerateRequest(BaseModel):
-        prompts: list[str]
+        prompts: Optional[list[str]] = None
+        prompt_token_ids: Optional[list[list[int]]] = None
         images: Optional[list[str]] = None
         n: int = 1
         repetition_penalty: float = 1.0
@@ -443,18 +777,27 @@ def main(script_args: ScriptArguments):
         max_tokens: int = 16
         guided_decoding_regex: Optional[str] = None
         generation_kwargs: dict = field(default_factory=dict)
+        return_logprobs: bool = False
 
     class GenerateResponse(BaseModel):
         completion_ids: list[list[int]]
+        logprobs: Optional[list[list[float]]] = None
 
     @app.post("/generate/", response_model=GenerateResponse)
-    async def generate(request: GenerateRequest):
+    async def generate(request: GenerateRequest, http_request: Request):
         """
         Generates completions for the provided prompts.
 
+        The completions are returned in JSON by default. If the `Accept` header of the request is
+        `application/x-npz`, they are returned in a compact binary format instead: a NumPy `.npz` archive with the
+        flat token IDs of the completions, their offsets, and their flat log-probabilities if `return_logprobs` is
+        `True` (see `trl.extras.vllm_client.encode_completions`). The binary response is compressed with gzip if the
+        `Accept-Encoding` header of the request includes `gzip`.
+
         Args:
             request (`GenerateRequest`):
-                - `prompts` (list of `str`): A list of prompts (text strings) for the model to generate completions.
+                - `prompts` (list of `str`, *optional*): A list of prompts (text strings) for the model to generate completions.
+                - `prompt_token_ids` (list of list of `int`, *optional*): A list of tokenized prompts, to use instead of `prompts`. This avoids tokenizing the prompts on the server, and guarantees that the model generates from the exact same tokens as the client's ones.
                 - `images` (list of `str`, *optional*, default to `None`): A list of base64 encoded images to process along with prompts.
                 - `n` (`int`, *optional*, defaults to `1`): Number of completions to generate for each prompt.
                 - `repetition_penalty` (`float`, *optional*, defaults to `1.0`): Repetition penalty to apply during generation.
@@ -465,26 +808,43 @@ def main(script_args: ScriptArguments):
                 - `max_tokens` (`int`, *optional*, defaults to `16`): Maximum number of tokens to generate for each completion.
                 - `guided_decoding_regex` (`str`, *optional*): A regex pattern for guided decoding. If provided, the model will only generate tokens that match this regex pattern.
                 - `generation_kwargs` (`dict`, *optional*): Additional generation parameters to pass to the vLLM `SamplingParams`. This can include parameters like `seed`, `frequency_penalty`, etc. If it contains keys that conflict with the other parameters, they will override them.
+                - `return_logprobs` (`bool`, *optional*, defaults to `False`): Whether to also return the log-probability of each generated token.
 
         Returns:
             `GenerateResponse`:
                 - `completion_ids` (list of list of `int`): A list of lists of token IDs for each generated completion.
+                - `logprobs` (list of list of `float` or `None`): A list of lists of log-probabilities of the tokens of each generated completion, if `return_logprobs` is `True`.
 
         Example request:
         ```json
         {"prompts": ["Hello world", "What is AI?"]}
         ```
 
+        or, with tokenized prompts:
+        ```json
+        {"prompt_token_ids": [[9707, 1879], [3838, 374, 15235, 30]]}
+        ```
+
         Example response:
         ```json
         {"completion_ids": [[101, 102, 103], [201, 202, 203]]}
         ```
+
+        or, in binary, an archive with the arrays:
+        ```python
+        {"completion_ids": array([101, 102, 103, 201, 202, 203], dtype=int32), "offsets": array([0, 3, 6])}
+        ```
         """
-        request.images = request.images or [None] * len(request.prompts)
+        if (request.prompts is None) == (request.prompt_token_ids is None):
+            raise ValueError("Exactly one of `prompts` and `prompt_token_ids` must be provided.")
+        if request.prompts is not None:
+            rows = [{"prompt": prompt} for prompt in request.prompts]
+        else:
+            rows = [{"prompt_token_ids": token_ids} for token_ids in request.prompt_token_ids]
+        request.images = request.images or [None] * len(rows)
 
         prompts = []
-        for prompt, image in zip(request.prompts, request.images):
-            row = {"prompt": prompt}
+        for row, image in zip(rows, request.images):
             if image is not None:
                 row["multi_modal_data"] = {"image": Image.open(BytesIO(base64.b64decode(image)))}
             prompts.append(row)
@@ -504,38 +864,79 @@ def main(script_args: ScriptArguments):
             "min_p": request.min_p,
             "max_tokens": request.max_tokens,
             "guided_decoding": guided_decoding,
+            # With `logprobs=0`, vLLM only returns the log-probability of the sampled token
+            "logprobs": 0 if request.return_logprobs else None,
         }
         generation_kwargs.update(request.generation_kwargs)
         sampling_params = SamplingParams(**generation_kwargs)
 
-        # Evenly distribute prompts across DP ranks
-        chunked_prompts = chunk_list(prompts, script_args.data_parallel_size)
-
-        # Send the prompts to each worker
-        for connection, prompts in zip(connections, chunked_prompts):
-            # When the number of prompts is less than data_parallel_size, some workers will receive empty prompts.
-            # However, vLLM requires that we always send at least one prompt. So we send a placeholder prompt to comply
-            # with vLLM's requirement, and we later ignore the result.
-            if not prompts:
-                prompts = ["<placeholder>"]
-            kwargs = {"prompts": prompts, "sampling_params": sampling_params}
-            connection.send({"type": "call", "method": "generate", "kwargs": kwargs})
-
-        # Receive results
-        all_outputs = [connection.recv() for connection in connections]
+        # Distribute prompts across DP ranks, either evenly or by estimated number of tokens
+        if script_args.load_balancing == "tokens":
+            costs = [request.n * (estimate_prompt_length(prompt) + request.max_tokens) for prompt in prompts]
+            chunked_indices = balance_by_cost(costs, script_args.data_parallel_size)
+        else:
+            chunked_indices = chunk_list(list(range(len(prompts))), script_args.data_parallel_size)
+        chunked_prompts = [[prompts[index] for index in indices] for indices in chunked_indices]
 
-        # Handle empty prompts (see above)
-        all_outputs = [output for output, prompts in zip(all_outputs, chunked_prompts) if prompts]
+        # Send the prompts to each worker, and wait for all of them to finish
+        worker_outputs = await asyncio.gather(
+            *(generate_on_worker(rank, prompts, sampling_params) for rank, prompts in enumerate(chunked_prompts))
+        )
+        end_times = [end_time for _, end_time in worker_outputs]
+        for rank, ((outputs, end_time), indices) in enumerate(zip(worker_outputs, chunked_indices)):
+            worker_metrics["idle_time"][rank] += max(end_times) - end_time
+            worker_metrics["num_prompts"][rank] += len(indices)
+            if indices:  # Handle empty prompts (see `generate_on_worker`)
+                num_tokens = sum(
+                    len(output.token_ids) for request_output in outputs for output in request_output.outputs
+                )
+                worker_metrics["num_completion_tokens"][rank] += num_tokens
+        worker_outputs = [outputs for outputs, _ in worker_outputs]
+
+        # Put the results back in the order of the prompts
+        all_outputs = [None] * len(rows)
+        for indices, outputs in zip(chunked_indices, worker_outputs):
+            for index, output in zip(indices, outputs):
+                all_outputs[index] = output
 
-        # Flatten and combine all results
-        all_outputs = list(chain.from_iterable(all_outputs))  # from list of list to single list
         completion_ids = [list(output.token_ids) for outputs in all_outputs for output in outputs.outputs]
-        return {"completion_ids": completion_ids}
+        logprobs = None
+        if request.return_logprobs:
+            logprobs = [
+                [logprob[token_id].logprob for token_id, logprob in zip(output.token_ids, output.logprobs)]
+                for outputs in all_outputs
+                for output in outputs.outputs
+            ]
+
+        if BINARY_RESPONSE_MEDIA_TYPE in http_request.headers.get("accept", ""):
+            content = encode_completions(completion_ids, logprobs)
+            headers = {}
+            if "gzip" in http_request.headers.get("accept-encoding", ""):
+                content = gzip.compress(content, compresslevel=1)
+                headers["Content-Encoding"] = "gzip"
+            return Response(content=content, media_type=BINARY_RESPONSE_MEDIA_TYPE, headers=headers)
+        if not request.return_logprobs:
+            return {"completion_ids": completion_ids}
+        return {"completion_ids": completion_ids, "logprobs": logprobs}
 
     class InitCommunicatorRequest(BaseModel):
         host: str
         port: int
         world_size: int
+        transport: str = "nccl"
+        transport_kwargs: dict = field(default_factory=dict)
+
+    # Transport used for the weight updates, set when the communicator is initialized
+    weight_transport = None
+
+    async def update_weights(kwargs: dict) -> None:
+        # With a synchronous transport, the client can only send the next weights once all workers have received them,
+        # so we wait for the workers to be done.
+        if weight_transport is not None and weight_transport.synchronous:
+            await asyncio.gather(*(dispatcher.call("collective_rpc", kwargs=kwargs) for dispatcher in dispatchers))
+        else:
+            for dispatcher in dispatchers:
+                dispatcher.send("collective_rpc", kwargs=kwargs)
 
     @app.post("/init_communicator/")
     async def init_communicator(request: InitCommunicatorRequest):
@@ -547,15 +948,25 @@ def main(script_args: ScriptArguments):
                 - `host` (`str`): Hostname or IP address of the master node.
                 - `port` (`int`): Port number to be used for communication.
                 - `world_size` (`int`): Total number of participating processes in the group.
+                - `transport` (`str`, *optional*, defaults to `"nccl"`): Weight transport, `"nccl"` to broadcast the weights with NCCL, or `"shm"` to read them from a shared memory file written by a client on the same node.
+                - `transport_kwargs` (`dict`, *optional*): Keyword arguments of the transport, e.g. the path of the shared memory file.
         """
+        nonlocal weight_transport
+        if request.transport not in WEIGHT_TRANSPORTS:
+            raise ValueError(
+                f"Invalid weight transport: {request.transport}. Possible values are: {', '.join(WEIGHT_TRANSPORTS)}."
+            )
+        weight_transport = WEIGHT_TRANSPORTS[request.transport]
         world_size = script_args.tensor_parallel_size * script_args.data_parallel_size + 1
 
-        # The function init_communicator is called this way: init_communicator(host, port, world_size)
+        # The function init_communicator is called this way:
+        # init_communicator(host, port, world_size, transport, transport_kwargs)
         # So with collective_rpc we need to call it this way:
-        # llm.collective_rpc(method="init_communicator", args=(host, port, world_size))
-        kwargs = {"method": "init_communicator", "args": (request.host, request.port, world_size)}
-        for connection in connections:
-            connection.send({"type": "fire_and_forget", "method": "collective_rpc", "kwargs": kwargs})
+        # llm.collective_rpc(method="init_communicator", args=(host, port, world_size, transport, transport_kwargs))
+        args = (request.host, request.port, world_size, request.transport, request.transport_kwargs)
+        kwargs = {"method": "init_communicator", "args": args}
+        for dispatcher in dispatchers:
+            dispatcher.send("collective_rpc", kwargs=kwargs)
 
         return {"message": "Request received, initializing communicator"}
 
@@ -570,6 +981,8 @@ def main(script_args: ScriptArguments):
         Updates the model weights with the provided tensor.
 
         Once this endpoint is called, the client process should broadcast the updated weights to all server workers.
+        With the shared memory transport, the client writes the weights before calling this endpoint instead, and the
+        endpoint returns once all the server workers have loaded them.
 
         Args:
             request (`UpdateWeightsRequest`):
@@ -582,20 +995,49 @@ def main(script_args: ScriptArguments):
         # So with collective_rpc we need to call it this way:
         # llm.collective_rpc("update_named_param", args=("name", "torch.float32", (10, 10)))
         kwargs = {"method": "update_named_param", "args": (request.name, request.dtype, tuple(request.shape))}
-        for connection in connections:
-            connection.send({"type": "fire_and_forget", "method": "collective_rpc", "kwargs": kwargs})
+        await update_weights(kwargs)
 
         return {"message": "Request received, updating named parameter"}
 
+    class UpdateWeightsBucketRequest(BaseModel):
+        names: list[str]
+        dtypes: list[str]
+        shapes: list[list[int]]
+        offsets: list[int]
+        size: int
+
+    @app.post("/update_named_params/")
+    async def update_named_params(request: UpdateWeightsBucketRequest):
+        """
+        Updates several model weights at once, from a bucket packing the tensors into a contiguous buffer.
+
+        Once this endpoint is called, the client process should broadcast the bucket to all server workers. With the
+        shared memory transport, the client writes the bucket before calling this endpoint instead, and the endpoint
+        returns once all the server workers have loaded it.
+
+        Args:
+            request (`UpdateWeightsBucketRequest`):
+                - `names` (list of `str`): Names of the weight tensors being updated.
+                - `dtypes` (list of `str`): Data types of the weight tensors (e.g., `"torch.float32"`).
+                - `shapes` (list of list of `int`): Shapes of the weight tensors.
+                - `offsets` (list of `int`): Offsets of the weight tensors in the bucket, in bytes.
+                - `size` (`int`): Size of the bucket, in bytes.
+        """
+        kwargs = {
+            "method": "update_named_params",
+            "args": (request.names, request.dtypes, request.shapes, request.offsets, request.size),
+        }
+        await update_weights(kwargs)
+
+        return {"message": "Request received, updating named parameters"}
+
     @app.post("/reset_prefix_cache/")
     async def reset_prefix_cache():
         """
         Resets the prefix cache for the model.
         """
-        for connection in connections:
-            connection.send({"type": "call", "method": "reset_prefix_cache"})
         # Wait for and collect all results
-        all_outputs = [connection.recv() for connection in connections]
+        all_outputs = await asyncio.gather(*(dispatcher.call("reset_prefix_cache") for dispatcher in dispatchers))
         success = all(output for output in all_outputs)
         return {"message": "Request received, resetting prefix cache status: " + str(success)}
 
@@ -605,8 +1047,8 @@ def main(script_args: ScriptArguments):
         Closes the weight update group and cleans up associated resources.
         """
         kwargs = {"method": "close_communicator"}
-        for connection in connections:
-            connection.send({"type": "fire_and_forget", "method": "collective_rpc", "kwargs": kwargs})
+        for dispatcher in dispatchers:
+            dispatcher.send("collective_rpc", kwargs=kwargs)
         return {"message": "Request received, closing communicator"}
 
     # Start the server
@@ -180,6 +180,16 @@ class DPOConfig(TrainingArguments):
             τ parameter from the [TR-DPO](https://huggingface.co/papers/2404.09656) paper, which determines how
             frequently the current policy is synchronized with the reference policy. To use this parameter, you must
             set `sync_ref_model=True`.
+        max_tokens_per_batch (`int` or `None`, *optional*, defaults to `None`):
+            If set, the training batches hold a variable number of examples, up to this number of tokens (padding
+            included, counting both the chosen and rejected sequences), instead of `per_device_train_batch_size`
+            examples. The losses of the batches of a gradient accumulation step are weighted by their number of
+            examples. The lengths are read from the `length_column_name` column if the dataset has one, and computed
+            from the tokenized dataset otherwise.
+        length_bucket_size (`int` or `None`, *optional*, defaults to `None`):
+            When `max_tokens_per_batch` is set, number of examples of the buckets within which the shuffled examples
+            are sorted by length, so that the batches group examples of similar lengths. If `None`, no bucketing is
+            applied.
 
         > Parameters that control the logging
 
@@ -433,6 +443,24 @@ class DPOConfig(TrainingArguments):
             "synchronized with the reference policy. To use this parameter, you must set `sync_ref_model=True`."
         },
     )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "If set, the training batches hold a variable number of examples, up to this number of tokens "
+            "(padding included, counting both the chosen and rejected sequences), instead of "
+            "`per_device_train_batch_size` examples. The losses of the batches of a gradient accumulation step are "
+            "weighted by their number of examples. The lengths are read from the `length_column_name` column if the "
+            "dataset has one, and computed from the tokenized dataset otherwise."
+        },
+    )
+    length_bucket_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "When `max_tokens_per_batch` is set, number of examples of the buckets within which the shuffled "
+            "examples are sorted by length, so that the batches group examples of similar lengths. If `None`, no "
+            "bucketing is applied."
+        },
+    )
 
     # Parameters that control the logging
     generate_during_eval: bool = field(
@@ -23,6 +23,7 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import Any, Callable, Literal, Optional, Union
 
+import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
@@ -54,7 +55,7 @@ from transformers.trainer_callback import TrainerCallback
 from transformers.trainer_utils import EvalLoopOutput
 from transformers.utils import is_liger_kernel_available, is_peft_available
 
-from ..data_utils import maybe_apply_chat_template, maybe_extract_prompt
+from ..data_utils import maybe_apply_chat_template_dataset, maybe_extract_prompt_dataset
 from ..models import create_reference_model, prepare_deepspeed
 from ..models.utils import prepare_fsdp
 from .callbacks import SyncRefModelCallback
@@ -68,6 +69,8 @@ from .utils import (
     flush_right,
     generate_model_card,
     get_comet_experiment_url,
+    get_list_lengths,
+    get_token_budget_dataloader,
     log_table_to_comet_experiment,
     pad,
     pad_to_length,
@@ -628,13 +631,13 @@ class DPOTrainer(Trainer):
             # Extract prompt if needed
             if isinstance(dataset, Dataset):  # `IterableDataset.map` does not support `desc`
                 map_kwargs["desc"] = f"Extracting prompt in {dataset_name} dataset"
-            dataset = dataset.map(maybe_extract_prompt, **map_kwargs)
+            dataset = maybe_extract_prompt_dataset(dataset, map_kwargs=map_kwargs)
 
             # Apply the chat template if needed
             if isinstance(dataset, Dataset):  # `IterableDataset.map` does not support `desc`
                 map_kwargs["desc"] = f"Applying chat template to {dataset_name} dataset"
-            dataset = dataset.map(
-                maybe_apply_chat_template, fn_kwargs={"tokenizer": processing_class, "tools": args.tools}, **map_kwargs
+            dataset = maybe_apply_chat_template_dataset(
+                dataset, processing_class, tools=args.tools, map_kwargs=map_kwargs
             )
 
             # Tokenize the dataset
@@ -833,7 +836,43 @@ class DPOTrainer(Trainer):
 
             self._precomputed_train_ref_log_probs = True
 
-        return super().get_train_dataloader()
+        if self.args.max_tokens_per_batch is None:
+            return super().get_train_dataloader()
+        if isinstance(self.train_dataset, IterableDataset):
+            raise ValueError("`max_tokens_per_batch` is not supported with an iterable dataset.")
+        if self.args.length_column_name in self.train_dataset.column_names:
+            lengths = np.asarray(self.train_dataset[self.args.length_column_name])
+        else:
+            lengths = get_list_lengths(
+                self.train_dataset, ["prompt_input_ids", "chosen_input_ids", "rejected_input_ids"]
+            )
+            prompt_lengths, chosen_lengths, rejected_lengths = lengths.T
+            if self.padding_free:
+                lengths = 2 * prompt_lengths + chosen_lengths + rejected_lengths
+            else:
+                # Chosen and rejected sequences are concatenated, with the prompts and the completions padded
+                # separately
+                lengths = 2 * np.stack([prompt_lengths, np.maximum(chosen_lengths, rejected_lengths)], axis=1)
+        return get_token_budget_dataloader(self, lengths, padding_free=self.padding_free)
+
+    def get_batch_samples(self, epoch_iterator, num_batches, device):
+        if self.args.max_tokens_per_batch is None:
+            return super().get_batch_samples(epoch_iterator, num_batches, device)
+        batch_samples, num_items_in_batch = super().get_batch_samples(epoch_iterator, num_batches, device)
+        # Count the tokens of the optimization step, to compare the throughput of fixed and token-budget batching, and
+        # the examples, to weight the losses of batches of varying sizes
+        counts = torch.zeros(2, dtype=torch.long, device=device)
+        for batch in batch_samples:
+            counts[0] += (
+                2 * batch["prompt_attention_mask"].sum()
+                + batch["chosen_attention_mask"].sum()
+                + batch["rejected_attention_mask"].sum()
+            )
+            counts[1] += len(batch["prompt_input_ids"])
+        counts = self.accelerator.gather(counts).view(-1, 2).sum(dim=0)
+        self._stored_metrics["train"]["tokens_per_step"].append(float(counts[0]))
+        self._num_examples_per_device = counts[1].item() / self.accelerator.num_processes
+        return batch_samples, num_items_in_batch
 
     def get_eval_dataloader(self, eval_dataset: Optional[Dataset] = None) -> DataLoader:
         """
@@ -1745,6 +1784,11 @@ class DPOTrainer(Trainer):
 
         # Make sure to move the loss to the device the original accumulating loss is at back in the `Trainer` class:
         loss = loss.to(self.args.device)
+        if self.args.max_tokens_per_batch is not None and self.model.training:
+            # The loss is averaged over the batch, so batches of varying sizes would weigh the same in the gradient
+            # accumulation step. Weight them by their number of examples instead.
+            num_examples = len(inputs["prompt_input_ids"])
+            loss = loss * num_examples * self.args.gradient_accumulation_steps / self._num_examples_per_device
         # force log the metrics
         self.store_metrics(metrics, train_eval="train")
 
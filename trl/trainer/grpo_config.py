@@ -114,6 +114,12 @@ class GRPOConfig(TrainingArguments):
               separate server but may cause resource contention with training.
         vllm_guided_decoding_regex (`str` or `None`, *optional*, defaults to `None`):
             Regex for vLLM guided decoding. If `None` (default), guided decoding is disabled.
+        use_vllm_logprobs (`bool`, *optional*, defaults to `False`):
+            Whether to use the log-probabilities of the sampled tokens returned by vLLM as the old log-probabilities
+            of the importance sampling ratio, instead of recomputing them with a forward pass of the model. This saves
+            one forward pass per generation batch, but vLLM's log-probabilities may slightly differ from the trainer's
+            ones due to numerical differences. Requires `temperature=1.0`, since vLLM may return the log-probabilities
+            before temperature scaling.
 
         > Parameters that control the vLLM server (only used when `vllm_mode` is `"server"`)
 
@@ -127,6 +133,32 @@ class GRPOConfig(TrainingArguments):
         vllm_server_timeout (`float`, *optional*, defaults to `240.0`):
             Total timeout duration in seconds to wait for the vLLM server to be up. If the server is not up after the
             timeout, a `ConnectionError` is raised.
+        vllm_weight_sync_bucket_size_mb (`float`, *optional*, defaults to `512`):
+            Maximum size, in megabytes, of the buckets of parameters sent to the vLLM server when syncing the weights.
+            The parameters of a bucket are packed into a contiguous buffer, sent with a single request and broadcast.
+            Larger buckets mean fewer round trips, at the cost of a larger temporary buffer on the training device.
+        vllm_response_format (`str`, *optional*, defaults to `"json"`):
+            Format of the completions returned by the vLLM server. Possible values are `"json"` and `"binary"`. The
+            binary format sends the token IDs (and log-probabilities) as flat arrays, which are decoded without
+            building Python lists. It's much faster than JSON for large batches of long completions.
+        vllm_compress_response (`bool`, *optional*, defaults to `False`):
+            Whether to compress the binary responses of the vLLM server with gzip. Only used when
+            `vllm_response_format="binary"`. Useful when the server is on another node and the network is slow.
+        vllm_weight_transport (`str`, *optional*, defaults to `"nccl"`):
+            Transport used to send the weights to the vLLM server. Possible values are:
+
+                - `"nccl"` (default): broadcast the weights from the training GPU to the server GPUs with NCCL.
+                - `"shm"`: write the weights into a shared memory file that the server workers map in memory. The
+                  trainer and the server must run on the same node, but don't need GPUs.
+        async_generation (`bool`, *optional*, defaults to `False`):
+            Whether to generate the completions of the next generation batch on the vLLM server while training on the
+            current one. Generation then overlaps with training, but the completions are generated with the weights of
+            the previous generation batch ("one-step off-policy").
+        max_staleness (`int`, *optional*, defaults to `1`):
+            Only used when `async_generation=True`. Maximum number of generation batches by which the weights used to
+            generate the completions may lag behind the weights they are trained with. The weights are synced with the
+            vLLM server every `max_staleness` generation batches, so higher values save weight syncs at the cost of
+            more off-policy completions.
 
         > Parameters that control colocated vLLM execution (only used when `vllm_mode` is `"colocate"`)
 
@@ -163,6 +195,16 @@ class GRPOConfig(TrainingArguments):
             are normalized by the standard deviation, ensuring they have unit variance. If `False`, no scaling is
             applied. The [Dr. GRPO paper](https://huggingface.co/papers/2503.20783) recommends not scaling the rewards,
             as scaling by the standard deviation introduces a question-level difficulty bias.
+        dynamic_sampling (`bool`, *optional*, defaults to `False`):
+            Whether to drop the groups whose completions all got the same reward after scoring, and to replace them
+            with groups generated from further prompts, as in [DAPO](https://huggingface.co/papers/2503.14476). These
+            groups have zero advantage, so they would otherwise go through the model without contributing to the
+            loss. Each process refills its own groups, so `per_device_train_batch_size * steps_per_generation` must be
+            a multiple of `num_generations`.
+        max_dynamic_sampling_attempts (`int`, *optional*, defaults to `3`):
+            Only used when `dynamic_sampling=True`. Maximum number of additional generation batches to generate per
+            generation step to refill the groups. The groups that still have zero reward standard deviation after
+            these attempts are kept.
         loss_type (`str`, *optional*, defaults to `"bnpo"`):
             Specifies the loss formulation to use. Supported values are:
 
@@ -180,6 +222,17 @@ class GRPOConfig(TrainingArguments):
             When enabled, truncated completions are excluded from the loss calculation, preventing them from being
             incorrectly penalized and introducing noise during training. According to the
             [DAPO](https://huggingface.co/papers/2503.14476) paper, this is a good practice for training stability.
+        skip_zero_advantages (`bool`, *optional*, defaults to `False`):
+            Whether to remove the samples with an advantage of exactly zero from the training batches, since they
+            don't contribute to the loss. The remaining samples are spread evenly over the `steps_per_generation`
+            batches of the generation batch, and weighted so that the loss is the same as without removing them, for
+            all loss types. Requires `beta=0.0`, and isn't supported with `use_liger_loss=True` or
+            `top_entropy_quantile < 1.0`.
+        bucket_by_length (`bool`, *optional*, defaults to `False`):
+            Whether to group the samples of the generation batch into training batches by total (prompt + completion)
+            length, and to trim each batch of its padding columns before the forward pass. Samples are only moved
+            between batches of the same optimization step, and weighted so that the loss is the same as without
+            grouping, for all loss types. Isn't supported with `use_liger_loss=True` or `top_entropy_quantile < 1.0`.
         sync_ref_model (`bool`, *optional*, defaults to `False`):
             Whether to synchronize the reference model with the active model every `ref_model_sync_steps` steps, using
             the `ref_model_mixup_alpha` parameter. This synchronization originates from the
@@ -201,6 +254,19 @@ class GRPOConfig(TrainingArguments):
             If used with `mask_truncated_completions=True`, only tokens from non-truncated completions are considered.
         use_liger_loss (`bool`, *optional*, defaults to `False`):
             Whether to use the Liger GRPO loss.
+        shared_prompt_forward (`bool`, *optional*, defaults to `False`):
+            Whether to forward each unique prompt of a batch only once when computing the per-token log-probabilities
+            (for the old, reference and current policies), and to run all its completions against its cached keys and
+            values. This saves the recomputation of the prompt for each of its `num_generations` completions. Requires
+            a model that supports `past_key_values`. It is not used for vision-language models, and for the policy
+            model when gradient checkpointing is enabled.
+        padding_free (`bool`, *optional*, defaults to `False`):
+            Whether to compute the per-token log-probabilities (for the old, reference and current policies) without
+            padding, by flattening the prompt-completion pairs of each batch into a single packed sequence, with
+            position IDs restarting at each pair. This saves the computation on the padding tokens, which are located
+            on the left of the prompts and on the right of the completions. Currently, this is only efficient with the
+            `flash_attention_2` attention implementation; the other ones materialize an attention mask over the whole
+            packed sequence. It is not used for vision-language models.
 
         > Parameters that control the logging
 
@@ -391,6 +457,16 @@ class GRPOConfig(TrainingArguments):
         default=None,
         metadata={"help": "Regex for vLLM guided decoding. If `None` (default), guided decoding is disabled."},
     )
+    use_vllm_logprobs: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to use the log-probabilities of the sampled tokens returned by vLLM as the old "
+            "log-probabilities of the importance sampling ratio, instead of recomputing them with a forward pass of "
+            "the model. This saves one forward pass per generation batch, but vLLM's log-probabilities may slightly "
+            "differ from the trainer's ones due to numerical differences. Requires `temperature=1.0`, since vLLM may "
+            "return the log-probabilities before temperature scaling."
+        },
+    )
 
     # Parameters that control the vLLM server (only used when `vllm_mode` is `"server"`)
     vllm_server_host: str = field(
@@ -408,6 +484,59 @@ class GRPOConfig(TrainingArguments):
             "after the timeout, a `ConnectionError` is raised."
         },
     )
+    vllm_weight_sync_bucket_size_mb: float = field(
+        default=512,
+        metadata={
+            "help": "Maximum size, in megabytes, of the buckets of parameters sent to the vLLM server when syncing the "
+            "weights. The parameters of a bucket are packed into a contiguous buffer, sent with a single request and "
+            "broadcast. Larger buckets mean fewer round trips, at the cost of a larger temporary buffer on the "
+            "training device."
+        },
+    )
+    vllm_response_format: str = field(
+        default="json",
+        metadata={
+            "help": "Format of the completions returned by the vLLM server. Possible values are `'json'` and "
+            "`'binary'`. The binary format sends the token IDs (and log-probabilities) as flat arrays, which are "
+            "decoded without building Python lists. It's much faster than JSON for large batches of long "
+            "completions.",
+            "choices": ["json", "binary"],
+        },
+    )
+    vllm_compress_response: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to compress the binary responses of the vLLM server with gzip. Only used when "
+            "`vllm_response_format='binary'`. Useful when the server is on another node and the network is slow."
+        },
+    )
+    vllm_weight_transport: str = field(
+        default="nccl",
+        metadata={
+            "help": "Transport used to send the weights to the vLLM server. Possible values are: `'nccl'` (default): "
+            "broadcast the weights from the training GPU to the server GPUs with NCCL. `'shm'`: write the weights into "
+            "a shared memory file that the server workers map in memory. The trainer and the server must run on the "
+            "same node, but don't need GPUs.",
+            "choices": ["nccl", "shm"],
+        },
+    )
+    async_generation: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to generate the completions of the next generation batch on the vLLM server while "
+            "training on the current one. Generation then overlaps with training, but the completions are generated "
+            "with the weights of the previous generation batch (one-step off-policy)."
+        },
+    )
+    max_staleness: int = field(
+        default=1,
+        metadata={
+            "help": "Only used when `async_generation=True`. Maximum number of generation batches by which the "
+            "weights used to generate the completions may lag behind the weights they are trained with. The weights "
+            "are synced with the vLLM server every `max_staleness` generation batches, so higher values save weight "
+            "syncs at the cost of more off-policy completions."
+        },
+    )
 
     # Parameters that control colocated vLLM execution (only used when `vllm_mode` is `"colocate"`)
     vllm_gpu_memory_utilization: float = field(
@@ -474,6 +603,24 @@ class GRPOConfig(TrainingArguments):
             "deviation introduces a question-level difficulty bias."
         },
     )
+    dynamic_sampling: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to drop the groups whose completions all got the same reward after scoring, and to "
+            "replace them with groups generated from further prompts, as in DAPO. These groups have zero advantage, "
+            "so they would otherwise go through the model without contributing to the loss. Each process refills its "
+            "own groups, so `per_device_train_batch_size * steps_per_generation` must be a multiple of "
+            "`num_generations`."
+        },
+    )
+    max_dynamic_sampling_attempts: int = field(
+        default=3,
+        metadata={
+            "help": "Only used when `dynamic_sampling=True`. Maximum number of additional generation batches to "
+            "generate per generation step to refill the groups. The groups that still have zero reward standard "
+            "deviation after these attempts are kept."
+        },
+    )
     loss_type: str = field(
         default="bnpo",
         metadata={
@@ -498,6 +645,26 @@ class GRPOConfig(TrainingArguments):
             "a good practice for training stability."
         },
     )
+    skip_zero_advantages: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to remove the samples with an advantage of exactly zero from the training batches, since "
+            "they don't contribute to the loss. The remaining samples are spread evenly over the "
+            "`steps_per_generation` batches of the generation batch, and weighted so that the loss is the same as "
+            "without removing them, for all loss types. Requires `beta=0.0`, and isn't supported with "
+            "`use_liger_loss=True` or `top_entropy_quantile < 1.0`."
+        },
+    )
+    bucket_by_length: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to group the samples of the generation batch into training batches by total (prompt + "
+            "completion) length, and to trim each batch of its padding columns before the forward pass. Samples are "
+            "only moved between batches of the same optimization step, and weighted so that the loss is the same as "
+            "without grouping, for all loss types. Isn't supported with `use_liger_loss=True` or "
+            "`top_entropy_quantile < 1.0`."
+        },
+    )
     sync_ref_model: bool = field(
         default=False,
         metadata={
@@ -534,6 +701,27 @@ class GRPOConfig(TrainingArguments):
         default=False,
         metadata={"help": "Whether to use the Liger GRPO loss."},
     )
+    shared_prompt_forward: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to forward each unique prompt of a batch only once when computing the per-token "
+            "log-probabilities (for the old, reference and current policies), and to run all its completions against "
+            "its cached keys and values. This saves the recomputation of the prompt for each of its `num_generations` "
+            "completions. Requires a model that supports `past_key_values`. It is not used for vision-language "
+            "models, and for the policy model when gradient checkpointing is enabled."
+        },
+    )
+    padding_free: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to compute the per-token log-probabilities (for the old, reference and current policies) "
+            "without padding, by flattening the prompt-completion pairs of each batch into a single packed sequence, "
+            "with position IDs restarting at each pair. This saves the computation on the padding tokens, which are "
+            "located on the left of the prompts and on the right of the completions. Currently, this is only "
+            "efficient with the `flash_attention_2` attention implementation; the other ones materialize an attention "
+            "mask over the whole packed sequence. It is not used for vision-language models."
+        },
+    )
 
     # Parameters that control the logging
     log_completions: bool = field(
@@ -596,5 +784,77 @@ class GRPOConfig(TrainingArguments):
                 f"{self.num_generations}, which is less than the minimum required."
             )
 
+        if self.dynamic_sampling:
+            per_device_generation_batch_size = self.per_device_train_batch_size * self.steps_per_generation
+            if per_device_generation_batch_size % self.num_generations != 0:
+                raise ValueError(
+                    f"With `dynamic_sampling=True`, the per-device generation batch size "
+                    f"(per_device_train_batch_size * steps_per_generation = {per_device_generation_batch_size}) must "
+                    f"be divisible by the number of generations per prompt ({self.num_generations})."
+                )
+            if self.max_dynamic_sampling_attempts < 1:
+                raise ValueError(
+                    f"max_dynamic_sampling_attempts ({self.max_dynamic_sampling_attempts}) must be at least 1."
+                )
+
+        if self.skip_zero_advantages:
+            if self.beta != 0.0:
+                raise ValueError(
+                    f"`skip_zero_advantages=True` requires `beta=0.0`, but got {self.beta}. With a KL term, the samples "
+                    "with a zero advantage still contribute to the loss."
+                )
+            if self.use_liger_loss:
+                raise ValueError("`skip_zero_advantages=True` is not supported with `use_liger_loss=True`.")
+            if self.top_entropy_quantile < 1.0:
+                raise ValueError(
+                    "`skip_zero_advantages=True` is not supported with `top_entropy_quantile < 1.0`, since the "
+                    "entropy quantile is computed over the batch."
+                )
+
+        if self.bucket_by_length and self.use_liger_loss:
+            raise ValueError("`bucket_by_length=True` is not supported with `use_liger_loss=True`.")
+
+        if self.bucket_by_length and self.top_entropy_quantile < 1.0:
+            raise ValueError(
+                "`bucket_by_length=True` is not supported with `top_entropy_quantile < 1.0`, since the entropy quantile "
+                "is computed over the batch."
+            )
+
+        if self.padding_free and self.shared_prompt_forward:
+            raise ValueError("`padding_free=True` and `shared_prompt_forward=True` can't be used together.")
+
+        if self.padding_free and self.use_liger_loss:
+            raise ValueError("`padding_free=True` is not supported with `use_liger_loss=True`.")
+
         if self.delta is not None and self.use_liger_loss:
             raise ValueError("Liger loss does not support two-sided GRPO loss yet.")
+
+        if self.async_generation and not (self.use_vllm and self.vllm_mode == "server"):
+            raise ValueError("`async_generation=True` requires `use_vllm=True` and `vllm_mode='server'`.")
+
+        if self.vllm_weight_sync_bucket_size_mb <= 0:
+            raise ValueError(
+                f"vllm_weight_sync_bucket_size_mb ({self.vllm_weight_sync_bucket_size_mb}) must be positive."
+            )
+
+        if self.vllm_response_format not in ["json", "binary"]:
+            raise ValueError(
+                f"vllm_response_format must be either 'json' or 'binary', got {self.vllm_response_format}."
+            )
+
+        if self.vllm_weight_transport not in ["nccl", "shm"]:
+            raise ValueError(
+                f"vllm_weight_transport must be either 'nccl' or 'shm', got {self.vllm_weight_transport}."
+            )
+
+        if self.max_staleness < 1:
+            raise ValueError(f"max_staleness ({self.max_staleness}) must be at least 1.")
+
+        if self.use_vllm_logprobs and not self.use_vllm:
+            raise ValueError("`use_vllm_logprobs=True` requires `use_vllm=True`.")
+
+        if self.use_vllm_logprobs and self.temperature != 1.0:
+            raise ValueError(
+                f"`use_vllm_logprobs=True` requires `temperature=1.0`, but got {self.temperature}. vLLM may return the "
+                "log-probabilities before temperature scaling, which would not match the trainer's ones."
+            )
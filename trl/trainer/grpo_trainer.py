@@ -17,9 +17,11 @@ import inspect
 import os
 import re
 import textwrap
+import time
 import warnings
 from collections import defaultdict, deque
 from collections.abc import Sequence, Sized
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from contextlib import nullcontext
 from functools import partial
 from pathlib import Path
@@ -60,10 +62,12 @@ from ..models.utils import _ForwardRedirection
 from .callbacks import SyncRefModelCallback
 from .grpo_config import GRPOConfig
 from .utils import (
+    MetricsAccumulator,
     disable_dropout_in_model,
     entropy_from_logits,
     generate_model_card,
     get_comet_experiment_url,
+    masked_tolist,
     pad,
     print_prompt_completions_sample,
     selective_log_softmax,
@@ -78,6 +82,7 @@ if is_liger_kernel_available():
 
 if is_vllm_available():
     from vllm import LLM, SamplingParams
+    from vllm.inputs import TokensPrompt
     from vllm.sampling_params import GuidedDecodingParams
 
 if is_wandb_available():
@@ -186,6 +191,51 @@ class RepeatSampler(Sampler):
         return (self.num_samples // self.batch_size) * self.batch_size * self.mini_repeat_count * self.repeat_count
 
 
+class _LookaheadIterator:
+    """
+    Iterator wrapper that can return upcoming items before they are used.
+
+    The consumer first takes the items with `next`, possibly several at a time, and then uses them one by one, calling
+    `mark_used` after each.
+
+    Args:
+        iterator (`Iterator`):
+            Iterator to wrap.
+    """
+
+    def __init__(self, iterator):
+        self.iterator = iterator
+        self.taken = deque()  # items taken by the consumer, but not yet used
+        self.buffer = deque()  # items read from the iterator, but not yet taken
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self.buffer.popleft() if self.buffer else next(self.iterator)
+        self.taken.append(item)
+        return item
+
+    def mark_used(self) -> None:
+        if self.taken:
+            self.taken.popleft()
+
+    def peek(self, n: int):
+        """
+        Return the item that will be used `n` items after the next one to be used, or `None` if the iterator is
+        exhausted before it.
+        """
+        if n < len(self.taken):
+            return self.taken[n]
+        n -= len(self.taken)
+        while len(self.buffer) <= n:
+            try:
+                self.buffer.append(next(self.iterator))
+            except StopIteration:
+                return None
+        return self.buffer[n]
+
+
 # torch.nanstd doesn't exist, so we define it here
 def nanstd(tensor: torch.Tensor) -> torch.Tensor:
     """
@@ -265,6 +315,37 @@ def shuffle_sequence_dict(seq_dict: dict[str, Optional[Sequence]]) -> dict[str,
     return {key: permute(val) for key, val in seq_dict.items()}
 
 
+def trim_padding_columns(batch: dict[str, Optional[torch.Tensor]]) -> dict[str, Optional[torch.Tensor]]:
+    """
+    Removes the columns of a batch that are padding for all the samples: on the left of the left-padded prompts, and
+    on the right of the right-padded completions. At least one completion column is kept.
+
+    Example:
+    ```python
+    >>> batch = {
+    ...     "prompt_ids": torch.tensor([[0, 0, 1], [0, 2, 3]]),
+    ...     "prompt_mask": torch.tensor([[0, 0, 1], [0, 1, 1]]),
+    ...     "completion_ids": torch.tensor([[4, 0, 0], [5, 6, 0]]),
+    ...     "completion_mask": torch.tensor([[1, 0, 0], [1, 1, 0]]),
+    ... }
+    >>> trim_padding_columns(batch)
+    {'prompt_ids': tensor([[0, 1], [2, 3]]),
+     'prompt_mask': tensor([[0, 1], [1, 1]]),
+     'completion_ids': tensor([[4, 0], [5, 6]]),
+     'completion_mask': tensor([[1, 0], [1, 1]])}
+    ```
+    """
+    prompt_start = int(batch["prompt_mask"].any(dim=0).int().argmax())
+    completion_end = max(1, int(batch["completion_mask"].any(dim=0).cumsum(dim=0).argmax()) + 1)
+    batch = dict(batch)
+    for key in ["prompt_ids", "prompt_mask"]:
+        batch[key] = batch[key][:, prompt_start:]
+    for key in ["completion_ids", "completion_mask", "old_per_token_logps", "ref_per_token_logps"]:
+        if batch.get(key) is not None:
+            batch[key] = batch[key][:, :completion_end]
+    return batch
+
+
 def nanmin(tensor: torch.Tensor) -> torch.Tensor:
     """
     Compute the minimum value of a tensor, ignoring NaNs. This function only supports 1D tensors.
@@ -701,6 +782,21 @@ class GRPOTrainer(Trainer):
         # Buffer the batch to reuse generated outputs across multiple updates. For more details, see
         # `_get_train_sampler` and `_prepare_inputs`.
         self._buffered_inputs = None
+        # In async generation mode, the completions of the next generation batch are requested from a background
+        # thread, using the epoch iterator to look ahead at the next generation batch. See
+        # `_generate_and_score_completions_async`. The thread is started with the first request and stopped at the end
+        # of training.
+        self._generation_executor = None
+        self._pending_generation = None
+        self._epoch_iterator = None
+        self._generation_steps_since_sync = 0
+        self._last_generation_end_time = None
+        # With dynamic sampling, the zero-std groups are refilled with prompts from a separate dataloader. See
+        # `_refill_zero_std_groups`.
+        if args.dynamic_sampling and isinstance(train_dataset, IterableDataset):
+            raise ValueError("Dynamic sampling is not supported with an iterable training dataset.")
+        self._dynamic_sampling_dataloader = None
+        self._dynamic_sampling_iterator = None
 
         # The trainer estimates the number of FLOPs (floating-point operations) using the number of elements in the
         # input tensor associated with the key "input_ids". However, in GRPO, the sampled data does not include the
@@ -710,6 +806,14 @@ class GRPOTrainer(Trainer):
         # This acts as a flag to indicate that the warning has already been issued.
         model.warnings_issued["estimate_tokens"] = True
 
+        if args.padding_free and model.config._attn_implementation != "flash_attention_2":
+            warnings.warn(
+                "Padding-free forward passes are enabled, but the attention implementation is not set to "
+                "'flash_attention_2'. The other attention implementations materialize an attention mask over the whole "
+                "packed sequence, which may be slower than the regular forward pass. To benefit from padding-free "
+                "forward passes, set `attn_implementation='flash_attention_2'` in `model_init_kwargs`."
+            )
+
         super().__init__(
             model=model,
             args=args,
@@ -762,7 +866,7 @@ class GRPOTrainer(Trainer):
             )
 
         # Initialize the metrics
-        self._metrics = {"train": defaultdict(list), "eval": defaultdict(list)}
+        self._metrics = {"train": MetricsAccumulator(), "eval": MetricsAccumulator()}
         self._total_train_tokens = 0
         self.log_completions = args.log_completions
         self.wandb_log_unique_prompts = args.wandb_log_unique_prompts
@@ -793,7 +897,13 @@ class GRPOTrainer(Trainer):
                     base_url = args.vllm_server_base_url
                 else:
                     base_url = f"http://{args.vllm_server_host}:{args.vllm_server_port}"
-                self.vllm_client = VLLMClient(base_url=base_url, connection_timeout=args.vllm_server_timeout)
+                self.vllm_client = VLLMClient(
+                    base_url=base_url,
+                    connection_timeout=args.vllm_server_timeout,
+                    response_format=args.vllm_response_format,
+                    compress_response=args.vllm_compress_response,
+                    weight_transport=args.vllm_weight_transport,
+                )
                 self.vllm_client.init_communicator()
 
             elif self.vllm_mode == "colocate":
@@ -909,6 +1019,13 @@ class GRPOTrainer(Trainer):
         if self._signature_columns is None:
             self._signature_columns = ["prompt", "image"]
 
+    def train(self, *args, **kwargs):
+        try:
+            return super().train(*args, **kwargs)
+        finally:
+            # In async generation mode, the completions of the next generation batch may still be requested
+            self._shutdown_generation_executor()
+
     # This method overrides `Trainer.get_train_dataloader` to support our custom batching strategy.
     # Instead of returning a standard per-step batch (i.e., `per_device_batch_size), our dataloader loads an
     # *generation* batch (i.e., `per_device_batch_size × steps_per_generation`). This allows us to generate completions
@@ -1059,33 +1176,49 @@ class GRPOTrainer(Trainer):
     ) -> dict[str, Optional[torch.Tensor]]:
         """Compute log‐probs and (optionally) entropies for each token."""
         batch_size = batch_size or input_ids.size(0)  # Chunk inputs into smaller batches to reduce memory peak
+        # Gradient checkpointing disables the KV cache of the model in training mode, and we don't split the image
+        # inputs of VLMs between the prompts and the completions
+        shared_prompt_forward = (
+            self.args.shared_prompt_forward
+            and pixel_values is None
+            and "past_key_values" in self.model_kwarg_keys
+            and not (model.training and self.args.gradient_checkpointing)
+        )
+        padding_free = self.args.padding_free and pixel_values is None
         all_logps = []
         all_entropies = []
         for start in range(0, input_ids.size(0), batch_size):
             input_ids_batch = input_ids[start : start + batch_size]
             attention_mask_batch = attention_mask[start : start + batch_size]
 
-            # Build model inputs - check if the model supports logits_to_keep (some models and VLMs don't)
-            model_inputs = {"input_ids": input_ids_batch, "attention_mask": attention_mask_batch}
-
-            if image_grid_thw is not None and pixel_values is not None:
-                model_inputs["image_grid_thw"] = image_grid_thw[start : start + batch_size]
-                start_pixel_idx = image_grid_thw[:start].prod(-1).sum().item()
-                end_pixel_idx = image_grid_thw[: start + batch_size].prod(-1).sum().item()
-                model_inputs["pixel_values"] = pixel_values[start_pixel_idx:end_pixel_idx]
-            elif pixel_values is not None:
-                model_inputs["pixel_values"] = pixel_values[start : start + batch_size]
-
-            # Only add logits_to_keep if the model supports it
-            if "logits_to_keep" in self.model_kwarg_keys:
-                # We add 1 to `logits_to_keep` because the last logits of the sequence is later excluded
-                model_inputs["logits_to_keep"] = logits_to_keep + 1
-
-            logits = model(**model_inputs).logits
-            # Exclude the last value: it corresponds to the next token pred
-            logits = logits[:, :-1, :]  # (B, L-1, H)
-            # Only keep the last logits_to_keep. For model that support logits_to_keep, this is a no-op.
-            logits = logits[:, -logits_to_keep:, :]  # (B, logits_to_keep, H)
+            if shared_prompt_forward:
+                logits = self._get_logits_with_shared_prompts(
+                    model, input_ids_batch, attention_mask_batch, logits_to_keep
+                )
+            elif padding_free:
+                logits = self._get_logits_padding_free(model, input_ids_batch, attention_mask_batch, logits_to_keep)
+            else:
+                # Build model inputs - check if the model supports logits_to_keep (some models and VLMs don't)
+                model_inputs = {"input_ids": input_ids_batch, "attention_mask": attention_mask_batch}
+
+                if image_grid_thw is not None and pixel_values is not None:
+                    model_inputs["image_grid_thw"] = image_grid_thw[start : start + batch_size]
+                    start_pixel_idx = image_grid_thw[:start].prod(-1).sum().item()
+                    end_pixel_idx = image_grid_thw[: start + batch_size].prod(-1).sum().item()
+                    model_inputs["pixel_values"] = pixel_values[start_pixel_idx:end_pixel_idx]
+                elif pixel_values is not None:
+                    model_inputs["pixel_values"] = pixel_values[start : start + batch_size]
+
+                # Only add logits_to_keep if the model supports it
+                if "logits_to_keep" in self.model_kwarg_keys:
+                    # We add 1 to `logits_to_keep` because the last logits of the sequence is later excluded
+                    model_inputs["logits_to_keep"] = logits_to_keep + 1
+
+                logits = model(**model_inputs).logits
+                # Exclude the last value: it corresponds to the next token pred
+                logits = logits[:, :-1, :]  # (B, L-1, H)
+                # Only keep the last logits_to_keep. For model that support logits_to_keep, this is a no-op.
+                logits = logits[:, -logits_to_keep:, :]  # (B, logits_to_keep, H)
             # Divide logits by sampling temperature.
             # See https://huggingface.co/blog/the_n_implementation_details_of_rlhf_with_ppo#policy-training-implementation-details
             logits = logits / self.temperature
@@ -1102,6 +1235,59 @@ class GRPOTrainer(Trainer):
         entropies = torch.cat(all_entropies, dim=0) if compute_entropy else None
         return logps, entropies
 
+    def _get_logits_with_shared_prompts(self, model, input_ids, attention_mask, logits_to_keep) -> torch.Tensor:
+        """
+        Compute the logits predicting the last `logits_to_keep` tokens (the completions), like a regular forward pass,
+        but forward each unique prompt only once. The keys and values of the prompts are cached and expanded to all
+        their completions, which are then forwarded against them.
+        """
+        prompt_length = input_ids.size(1) - logits_to_keep
+        prompt_ids, completion_ids = input_ids[:, :prompt_length], input_ids[:, prompt_length:]
+        prompt_mask = attention_mask[:, :prompt_length]
+
+        # The completions of a prompt share the same (left-padded) prompt IDs and mask
+        prompts = torch.cat([prompt_ids, prompt_mask.to(prompt_ids.dtype)], dim=1)
+        unique_prompts, inverse = torch.unique(prompts, dim=0, return_inverse=True)
+        model_inputs = {
+            "input_ids": unique_prompts[:, :prompt_length],
+            "attention_mask": unique_prompts[:, prompt_length:],
+            "use_cache": True,
+        }
+        if "logits_to_keep" in self.model_kwarg_keys:
+            model_inputs["logits_to_keep"] = 1
+        prompt_outputs = model(**model_inputs)
+        past_key_values = prompt_outputs.past_key_values
+        past_key_values.batch_select_indices(inverse)
+
+        # The positions of the completion tokens follow the cached prompt, as in the regular forward pass
+        logits = model(
+            input_ids=completion_ids, attention_mask=attention_mask, past_key_values=past_key_values, use_cache=True
+        ).logits
+        # The last prompt logits predict the first completion token, and the last completion logits are excluded
+        return torch.cat([prompt_outputs.logits[inverse, -1:], logits[:, :-1]], dim=1)
+
+    def _get_logits_padding_free(self, model, input_ids, attention_mask, logits_to_keep) -> torch.Tensor:
+        """
+        Compute the logits predicting the last `logits_to_keep` tokens (the completions), like a regular forward pass,
+        but without padding: the sequences are flattened into a single packed sequence, with position IDs restarting
+        at 0 for each sequence. The logits at the padding positions are the ones of the previous token of the sequence.
+        """
+        # input_ids = [[0, a, b, c, 0], -> input_ids = [[a, b, c, d, e, f, g]]
+        #              [d, e, f, g, 0]]  position_ids = [[0, 1, 2, 0, 1, 2, 3]]
+        mask = attention_mask.bool()
+        position_ids = attention_mask.cumsum(dim=1)[mask].unsqueeze(0) - 1
+        # Index of each token of the batch in the packed sequence
+        packed_index = (mask.view(-1).cumsum(dim=0) - 1).view(mask.shape).clamp(min=0)
+        # The logits of the last prompt token and of the completion tokens (except the last one) predict the completion
+        logits_index = packed_index[:, -logits_to_keep - 1 : -1]
+        # Without attention mask nor KV cache, the attention implementations infer the sequences from the position IDs
+        model_inputs = {"input_ids": input_ids[mask].unsqueeze(0), "position_ids": position_ids, "use_cache": False}
+        if "logits_to_keep" in self.model_kwarg_keys:
+            # A tensor of indices selects the positions of the logits to compute
+            model_inputs["logits_to_keep"] = logits_index.reshape(-1)
+            return model(**model_inputs).logits.view(*logits_index.shape, -1)
+        return model(**model_inputs).logits[0, logits_index]
+
     def _fix_param_name_to_vllm(self, name, extra_prefixes: Optional[list[str]] = None):
         extra_prefixes = extra_prefixes or []
         prefixes = ["_checkpoint_wrapped_module."] + extra_prefixes
@@ -1109,14 +1295,17 @@ class GRPOTrainer(Trainer):
             name = name.replace(prefix, "")
         return name
 
-    def _sync_fsdp_params_to_vllm(self, module: nn.Module, prefix: str = "", visited=None):
-        """Memory-efficient post-order traversal of FSDP modules to extract full parameters and sync with vLLM."""
+    def _iter_fsdp_params_for_vllm(self, module: nn.Module, prefix: str = "", visited=None):
+        """
+        Memory-efficient post-order traversal of FSDP modules to extract full parameters to sync with vLLM. Yields the
+        names and the full data of the parameters.
+        """
         if visited is None:
             visited = set()
 
         for child_name, child_module in module.named_children():
             child_prefix = f"{prefix}.{child_name}" if prefix else child_name
-            self._sync_fsdp_params_to_vllm(
+            yield from self._iter_fsdp_params_for_vllm(
                 child_module, prefix=child_prefix, visited=visited
             )  # recurse into the child
 
@@ -1130,14 +1319,14 @@ class GRPOTrainer(Trainer):
                         continue  # skip FSDP subtrees already traversed
                     visited.add(full_name)
 
-                    if self.vllm_mode == "server" and self.accelerator.is_main_process:
-                        self.vllm_client.update_named_param(full_name, param.data)
-                    elif self.vllm_mode == "colocate":
-                        llm_model = self.llm.llm_engine.model_executor.driver_worker.model_runner.model
-                        llm_model.load_weights([(full_name, param.data)])
+                    yield full_name, param.data
 
-    @profiling_decorator
-    def _move_model_to_vllm(self):
+    def _iter_params_for_vllm(self):
+        """
+        Yields the names (as expected by vLLM) and the full data of the model parameters to sync with vLLM. With
+        DeepSpeed ZeRO-3 and FSDP, the parameters are gathered one module or parameter at a time, so the data of a
+        parameter is only valid until the next one is requested, and all processes must iterate over the parameters.
+        """
         # For DeepSpeed ZeRO-3 and FSDP, we need to gather all parameters before operations
         deepspeed_plugin = self.accelerator.state.deepspeed_plugin
         zero_stage_3 = deepspeed_plugin is not None and deepspeed_plugin.zero_stage == 3
@@ -1159,7 +1348,7 @@ class GRPOTrainer(Trainer):
                 if self.is_fsdp_enabled:  # note if using FSDP, gather_if_zero3 is nullcontext
                     # Update vLLM weights while parameters are gathered
                     # For PEFT with FSDP we need to use the memory efficient post-order traversal
-                    self._sync_fsdp_params_to_vllm(self.model)
+                    yield from self._iter_fsdp_params_for_vllm(self.model)
                 else:
                     # DeepSpeed ZeRO-3 with PEFT
                     for name, param in self.model.named_parameters():
@@ -1171,28 +1360,34 @@ class GRPOTrainer(Trainer):
                         if "original_module" in name:
                             continue
                         name = self._fix_param_name_to_vllm(name, extra_prefixes=["modules_to_save.default."])
-
-                        if self.vllm_mode == "server" and self.accelerator.is_main_process:
-                            self.vllm_client.update_named_param(name, param.data)
-                        elif self.vllm_mode == "colocate":
-                            llm_model = self.llm.llm_engine.model_executor.driver_worker.model_runner.model
-                            llm_model.load_weights([(name, param.data)])
+                        yield name, param.data
                 # Unmerge adapters while parameters are still gathered
                 self.model.unmerge_adapter()
                 # Parameters will automatically be repartitioned when exiting the context
         else:
             # For non-PEFT models, simply gather (if needed) and update each parameter individually.
             if self.is_fsdp_enabled:
-                self._sync_fsdp_params_to_vllm(self.model)  # use memory-efficient post-order traversal for FSDP
+                yield from self._iter_fsdp_params_for_vllm(self.model)  # use memory-efficient post-order traversal
             else:
                 for name, param in self.model.named_parameters():
                     name = self._fix_param_name_to_vllm(name)
                     with gather_if_zero3([param]):
-                        if self.vllm_mode == "server" and self.accelerator.is_main_process:
-                            self.vllm_client.update_named_param(name, param.data)
-                        elif self.vllm_mode == "colocate":
-                            llm_model = self.llm.llm_engine.model_executor.driver_worker.model_runner.model
-                            llm_model.load_weights([(name, param.data)])
+                        yield name, param.data
+
+    @profiling_decorator
+    def _move_model_to_vllm(self):
+        named_params = self._iter_params_for_vllm()
+        if self.vllm_mode == "server" and self.accelerator.is_main_process:
+            # The parameters are packed into buckets, each sent with a single request and broadcast
+            self.vllm_client.update_named_params(named_params, self.args.vllm_weight_sync_bucket_size_mb)
+        elif self.vllm_mode == "colocate":
+            llm_model = self.llm.llm_engine.model_executor.driver_worker.model_runner.model
+            for name, param in named_params:
+                llm_model.load_weights([(name, param)])
+        else:
+            # The other processes take part in gathering the sharded parameters
+            for _ in named_params:
+                pass
 
         # Reset cache on vLLM
         if self.vllm_mode == "server" and self.accelerator.is_main_process:
@@ -1200,6 +1395,14 @@ class GRPOTrainer(Trainer):
         elif self.vllm_mode == "colocate":
             self.llm.reset_prefix_cache()
 
+    def get_batch_samples(self, epoch_iterator, num_batches, device):
+        # In async generation mode, wrap the epoch iterator to look ahead at the next generation batch
+        if self.args.async_generation:
+            if self._epoch_iterator is None or self._epoch_iterator.iterator is not epoch_iterator:
+                self._epoch_iterator = _LookaheadIterator(epoch_iterator)
+            epoch_iterator = self._epoch_iterator
+        return super().get_batch_samples(epoch_iterator, num_batches, device)
+
     @profiling_decorator
     def _prepare_inputs(
         self, generation_batch: dict[str, Union[torch.Tensor, Any]]
@@ -1222,19 +1425,127 @@ class GRPOTrainer(Trainer):
             generate_every = self.args.steps_per_generation * self.num_iterations
             if self._step % generate_every == 0 or self._buffered_inputs is None:
                 # self._buffered_inputs=None can occur when resuming from a checkpoint
-                generation_batch = self._generate_and_score_completions(generation_batch)
+                if self.args.async_generation:
+                    steps_to_next_generation = generate_every - self._step % generate_every
+                    generation_batch = self._generate_and_score_completions_async(
+                        generation_batch, steps_to_next_generation
+                    )
+                else:
+                    generation_batch = self._generate_and_score_completions(generation_batch)
                 generation_batch = split_pixel_values_by_grid(generation_batch)
                 generation_batch = shuffle_sequence_dict(generation_batch)
-                generation_batches = split_tensor_dict(generation_batch, self.args.steps_per_generation)
+                if self.args.skip_zero_advantages or self.args.bucket_by_length:
+                    generation_batches = self._split_generation_batch(generation_batch)
+                else:
+                    generation_batches = split_tensor_dict(generation_batch, self.args.steps_per_generation)
                 self._buffered_inputs = [unsplit_pixel_values_by_grid(batch) for batch in generation_batches]
             inputs = self._buffered_inputs[self._step % self.args.steps_per_generation]
             self._step += 1
+            if self._epoch_iterator is not None:
+                self._epoch_iterator.mark_used()
         else:
             # In evaluation, there is neither batch grouping for generation, nor multiple iterations, hence
             # local generation batch == local eval batch
             inputs = self._generate_and_score_completions(generation_batch)
         return inputs
 
+    def _split_generation_batch(self, generation_batch: dict[str, Any]) -> list[dict[str, Any]]:
+        # Splits the local generation batch into `steps_per_generation` batches, like `split_tensor_dict`, but moving
+        # samples between the batches of the same optimization step:
+        #   - With `skip_zero_advantages` (beta=0.0), the samples with a zero advantage, which have a zero loss and
+        #     gradient, are removed, and the remaining ones are spread evenly over the batches.
+        #   - With `bucket_by_length`, the samples are grouped by total length, and each batch is trimmed of its
+        #     padding columns.
+        # Each sample is weighted as in the loss of the batch it would have been in, so the loss of each optimization
+        # step is unchanged (see `_compute_loss`).
+        steps_per_generation = self.args.steps_per_generation
+        batch_size = self.args.per_device_train_batch_size
+        prompt_mask, completion_mask = generation_batch["prompt_mask"], generation_batch["completion_mask"]
+        num_tokens = completion_mask.sum(dim=1).float()
+        if self.loss_type == "grpo":
+            loss_weights = 1.0 / (batch_size * num_tokens.clamp(min=1.0))
+        elif self.loss_type == "bnpo":
+            batch_num_tokens = num_tokens.view(steps_per_generation, batch_size).sum(dim=1, keepdim=True)
+            loss_weights = (1.0 / batch_num_tokens.clamp(min=1.0)).expand(-1, batch_size).reshape(-1)
+        elif self.loss_type == "dr_grpo":
+            loss_weights = torch.full_like(num_tokens, 1.0 / (batch_size * self.max_completion_length))
+        else:
+            raise ValueError(f"Unknown loss type: {self.loss_type}")
+        generation_batch = {**generation_batch, "loss_weights": loss_weights}
+
+        # Number of consecutive batches of the generation batch that belong to the same optimization step
+        gradient_accumulation_steps = self.args.gradient_accumulation_steps
+        if steps_per_generation % gradient_accumulation_steps == 0:
+            num_batches_per_step = gradient_accumulation_steps
+        elif gradient_accumulation_steps % steps_per_generation == 0:
+            num_batches_per_step = steps_per_generation
+        else:
+            num_batches_per_step = 1
+
+        def select(v: Optional[Sequence], rows: torch.Tensor) -> Optional[Sequence]:
+            if v is None:
+                return None
+            if isinstance(v, torch.Tensor):
+                return v[rows]
+            return [v[i] for i in rows.tolist()]
+
+        batches = []
+        num_skipped = 0
+        is_zero = generation_batch["advantages"] == 0
+        lengths = prompt_mask.sum(dim=1) + completion_mask.sum(dim=1)
+        for start in range(0, steps_per_generation * batch_size, num_batches_per_step * batch_size):
+            rows = torch.arange(start, start + num_batches_per_step * batch_size, device=is_zero.device)
+            if self.args.skip_zero_advantages:
+                step_is_zero = is_zero[rows]
+                kept_rows = rows[~step_is_zero]
+                # All processes run the forward and backward passes together, so each batch keeps at least one
+                # sample. The batches are completed with zero-advantage samples, which don't contribute to the loss.
+                new_batch_size = max(1, -(-len(kept_rows) // num_batches_per_step))
+                num_padding_rows = new_batch_size * num_batches_per_step - len(kept_rows)
+                rows = torch.cat([kept_rows, rows[step_is_zero][:num_padding_rows]])
+                num_skipped += (batch_size - new_batch_size) * num_batches_per_step
+            if self.args.bucket_by_length:
+                rows = rows[lengths[rows].argsort(stable=True)]
+            step_batch = {key: select(val, rows) for key, val in generation_batch.items()}
+            batches.extend(split_tensor_dict(step_batch, num_batches_per_step))
+        if self.args.bucket_by_length:
+            batches = [trim_padding_columns(batch) for batch in batches]
+
+        device = self.accelerator.device
+        metrics = self._metrics["train"]
+        if self.args.skip_zero_advantages:
+            # Training FLOPs saved, estimated as in `PreTrainedModel.floating_point_ops`, from the number of positions
+            # (including padding) of the removed samples
+            counts = torch.tensor([num_skipped, len(is_zero)], device=device)
+            num_skipped, num_samples = self.accelerator.gather(counts).view(-1, 2).sum(0)
+            sequence_length = prompt_mask.size(1) + completion_mask.size(1)
+            num_params = self.accelerator.unwrap_model(self.model).num_parameters(exclude_embeddings=True)
+            flops_saved = 6 * num_params * num_skipped.float() * sequence_length * self.num_iterations
+            metrics.add("skip_zero_advantages/skipped_ratio", num_skipped / num_samples, reduction="none")
+            metrics.add("skip_zero_advantages/flops_saved", flops_saved, reduction="none")
+        if self.args.bucket_by_length:
+            # Fraction of padding positions (including the masked tokens after EOS) in the batches, before and after
+            # grouping and trimming
+            counts = torch.tensor(
+                [
+                    lengths.sum(),
+                    lengths.numel() * (prompt_mask.size(1) + completion_mask.size(1)),
+                    sum(batch["prompt_mask"].sum() + batch["completion_mask"].sum() for batch in batches),
+                    sum(batch["prompt_mask"].numel() + batch["completion_mask"].numel() for batch in batches),
+                ],
+                device=device,
+            )
+            num_tokens_before, num_positions_before, num_tokens_after, num_positions_after = (
+                self.accelerator.gather(counts).view(-1, 4).sum(0).float()
+            )
+            metrics.add(
+                "bucket_by_length/padding_ratio_before", 1 - num_tokens_before / num_positions_before, reduction="none"
+            )
+            metrics.add(
+                "bucket_by_length/padding_ratio_after", 1 - num_tokens_after / num_positions_after, reduction="none"
+            )
+        return batches
+
     @profiling_decorator
     def _calculate_rewards(self, inputs, prompts, completions, completion_ids_list):
         device = self.accelerator.device
@@ -1288,12 +1599,10 @@ class GRPOTrainer(Trainer):
         rewards_per_func = gather(rewards_per_func)
         return rewards_per_func
 
-    def _generate_and_score_completions(
-        self, inputs: list[dict[str, Union[torch.Tensor, Any]]]
-    ) -> dict[str, Union[torch.Tensor, Any]]:
-        device = self.accelerator.device
-        mode = "train" if self.model.training else "eval"
-
+    def _prepare_prompts(self, inputs: list[dict[str, Union[torch.Tensor, Any]]]) -> tuple:
+        # Applies the chat template to the prompts of a generation batch, tokenizes and truncates them. Returns the
+        # prompts, a copy of the original text-only prompts, the images (or None), the prompt texts, and the tokenized
+        # prompt inputs. Generation uses the tokenized prompts, except with images, where it uses the prompt texts.
         prompts = [x["prompt"] for x in inputs]
 
         # We don't yet support visual reward models/function, so we keep a copy of the original text-only prompts for
@@ -1332,76 +1641,352 @@ class GRPOTrainer(Trainer):
 
         if self.max_prompt_length is not None:
             # If max_prompt_length is set, we trim the prompt to keep only the last `max_prompt_length` tokens.
-            # Then we decode those tokens back into text. We manually remove leading pad tokens from the decoded text,
-            # because we can't use `skip_special_tokens=True` (some special tokens are still needed for generation).
             protected = [self.image_token_id, self.vision_start_token_id, self.vision_end_token_id]
             protected = [token for token in protected if token is not None]
             prompt_ids, prompt_mask = truncate_with_protected_tokens(
                 prompt_ids, prompt_mask, self.max_prompt_length, protected
             )
 
-            prompts_text = self.processing_class.batch_decode(
-                prompt_ids, skip_special_tokens=False, clean_up_tokenization_spaces=False
+            # With images, vLLM generates from the prompt texts, so we decode the truncated tokens back into text. We
+            # manually remove leading pad tokens from the decoded text, because we can't use `skip_special_tokens=True`
+            # (some special tokens are still needed for generation).
+            if has_images:
+                prompts_text = self.processing_class.batch_decode(
+                    prompt_ids, skip_special_tokens=False, clean_up_tokenization_spaces=False
+                )
+                prompts_text = [re.sub(rf"^({re.escape(self.pad_token)})+", "", text) for text in prompts_text]
+
+                # The chat template inserts a single image token into the prompt text. However, when this text is
+                # later tokenized, the single image token string is expanded into multiple image token IDs, depending
+                # on the image size. Since we're detokenizing here, we may see repeated image tokens in the decoded
+                # text. We collapse them back into a single token string to match the original template.
+                if self.image_token is not None:
+                    prompts_text = [
+                        re.sub(rf"({re.escape(self.image_token)})+", self.image_token, text) for text in prompts_text
+                    ]
+
+        prompt_inputs["input_ids"], prompt_inputs["attention_mask"] = prompt_ids, prompt_mask
+        return prompts, original_prompts, images if has_images else None, prompts_text, prompt_inputs
+
+    def _get_generation_prompts(
+        self, prompts_text: list[str], prompt_inputs: dict[str, torch.Tensor], images: Optional[list]
+    ) -> Union[list[str], list[list[int]]]:
+        # Returns the prompts to generate from: the unpadded prompt token IDs, so that they are neither decoded nor
+        # re-tokenized (which could also change the tokens). For VLMs, the image placeholder token is expanded from
+        # the prompt text and the image, so we use the prompt texts instead.
+        if images is not None:
+            return prompts_text
+        return masked_tolist(prompt_inputs["input_ids"], prompt_inputs["attention_mask"])
+
+    def _submit_vllm_generation(
+        self, prompts: Union[list[str], list[list[int]]], images: Optional[list]
+    ) -> Optional[Future]:
+        # Gathers the prompts (texts or token IDs) of all processes, and sends them to the vLLM server from the main
+        # process. In async generation mode, the request runs in a background thread, and the returned future must be
+        # passed to `_collect_vllm_generation` on all processes to get the completions.
+        all_prompts = gather_object(prompts)
+        if images is not None:
+            all_images = gather_object(images)
+
+        if not self.accelerator.is_main_process:
+            return None
+
+        # Since 'prompts' contains 'num_generations' duplicates, we first take unique prompts, and generate
+        # num_generations outputs for each one. This is faster than generating outputs for each duplicate prompt
+        # individually.
+        ordered_set_of_prompts = all_prompts[:: self.num_generations]
+        if images is None:
+            prompt_kwargs = {"prompt_token_ids": ordered_set_of_prompts}
+        else:
+            prompt_kwargs = {"prompts": ordered_set_of_prompts}
+
+        if images is not None:
+            ordered_set_of_images = all_images[:: self.num_generations]
+        else:
+            ordered_set_of_images = None
+
+        def generate():
+            start_time = time.perf_counter()
+            output = self.vllm_client.generate(
+                **prompt_kwargs,
+                images=ordered_set_of_images,
+                n=self.num_generations,
+                repetition_penalty=self.repetition_penalty,
+                temperature=self.temperature,
+                top_p=self.top_p,
+                top_k=-1 if self.top_k is None else self.top_k,
+                min_p=0.0 if self.min_p is None else self.min_p,
+                max_tokens=self.max_completion_length,
+                guided_decoding_regex=self.guided_decoding_regex,
+                generation_kwargs=self.args.generation_kwargs,
+                return_logprobs=self.args.use_vllm_logprobs,
+            )
+            completion_ids, logprobs = output if self.args.use_vllm_logprobs else (output, None)
+            return completion_ids, logprobs, start_time, time.perf_counter()
+
+        if self.args.async_generation:
+            if self._generation_executor is None:
+                self._generation_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vllm-generation")
+            return self._generation_executor.submit(generate)
+        future = Future()
+        with profiling_context(self, "vLLM.generate"):
+            future.set_result(generate())
+        return future
+
+    def _collect_vllm_generation(
+        self, future: Optional[Future], num_prompts: int
+    ) -> tuple[list[list[int]], Optional[list[list[float]]]]:
+        # Waits for the completions requested with `_submit_vllm_generation`, and broadcasts them, along with their
+        # log-probabilities if `use_vllm_logprobs=True`, from the main process to all processes, ensuring each process
+        # receives its corresponding slice.
+        start_time = time.perf_counter()
+        if self.accelerator.is_main_process:
+            completion_ids, logprobs, generation_start_time, generation_end_time = future.result()
+            outputs = [completion_ids, logprobs]
+        else:
+            outputs = [None, None]
+        completion_ids, logprobs = broadcast_object_list(outputs, from_process=0)
+
+        if self.args.async_generation and self.model.training:
+            # Time the training waited for the completions, time the generation took, and how much of it was hidden
+            # behind training. The vLLM server idles between the end of a generation and the next request.
+            wait_time = time.perf_counter() - start_time
+            generation_time = overlap = server_idle_time = 0.0
+            if self.accelerator.is_main_process:
+                generation_time = generation_end_time - generation_start_time
+                overlap = max(0.0, 1.0 - wait_time / generation_time) if generation_time > 0 else 1.0
+                if self._last_generation_end_time is not None:
+                    server_idle_time = max(0.0, generation_start_time - self._last_generation_end_time)
+                self._last_generation_end_time = generation_end_time
+            metrics = self._metrics["train"]
+            metrics.add("async/wait_time", wait_time)
+            # Only known on the main process, the other processes report 0
+            metrics.add("async/generation_time", generation_time, reduction="max")
+            metrics.add("async/overlap", overlap, reduction="max")
+            metrics.add("async/server_idle_time", server_idle_time, reduction="max")
+
+        process_slice = slice(
+            self.accelerator.process_index * num_prompts, (self.accelerator.process_index + 1) * num_prompts
+        )
+        return completion_ids[process_slice], logprobs[process_slice] if logprobs is not None else None
+
+    def _sync_weights_to_vllm(self):
+        # Updates the vLLM weights if the model changed since they were last updated
+        if self.state.global_step != self._last_loaded_step:
+            if self.args.async_generation and self._pending_generation is not None:
+                # The vLLM server can't update its weights while generating
+                if self.accelerator.is_main_process:
+                    wait([self._pending_generation["future"]])
+            self._move_model_to_vllm()
+            self._last_loaded_step = self.state.global_step
+
+    def _shutdown_generation_executor(self):
+        # Drops the completions requested in advance for a generation batch that won't be trained on, and waits for the
+        # background thread to finish, so that no request reaches the vLLM server once training is over
+        if self._pending_generation is not None:
+            future = self._pending_generation["future"]
+            if future is not None:  # only set on the main process
+                future.cancel()
+            self._pending_generation = None
+        if self._generation_executor is not None:
+            self._generation_executor.shutdown(wait=True)
+            self._generation_executor = None
+
+    def _request_vllm_generation(self, inputs: list[dict[str, Union[torch.Tensor, Any]]]) -> dict[str, Any]:
+        # Prepares the prompts of a generation batch and requests their completions in the background
+        prepared_prompts = self._prepare_prompts(inputs)
+        _, _, images, prompts_text, prompt_inputs = prepared_prompts
+        generation_prompts = self._get_generation_prompts(prompts_text, prompt_inputs, images)
+        return {
+            "prompts": [x["prompt"] for x in inputs],
+            "prepared_prompts": prepared_prompts,
+            "future": self._submit_vllm_generation(generation_prompts, images),
+        }
+
+    def _generate_and_score_completions_async(
+        self, inputs: list[dict[str, Union[torch.Tensor, Any]]], steps_to_next_generation: int
+    ) -> dict[str, Union[torch.Tensor, Any]]:
+        # Takes the completions of this generation batch that were requested at the previous generation step, and
+        # requests the completions of the next generation batch, which are generated while training on this one.
+        pending_generation, self._pending_generation = self._pending_generation, None
+        if pending_generation is not None and pending_generation["prompts"] != [x["prompt"] for x in inputs]:
+            # E.g., when resuming from a checkpoint. The generation is discarded once it's done.
+            if self.accelerator.is_main_process:
+                wait([pending_generation["future"]])
+            pending_generation = None
+        if pending_generation is None:
+            # Nothing was requested in advance, e.g., for the first generation batch of an epoch
+            self._sync_weights_to_vllm()
+            pending_generation = self._request_vllm_generation(inputs)
+        completion_ids, completion_logprobs = self._collect_vllm_generation(pending_generation["future"], len(inputs))
+
+        next_inputs = None
+        if self._epoch_iterator is not None:
+            next_inputs = self._epoch_iterator.peek(steps_to_next_generation)
+        if next_inputs is not None:
+            # Sync the weights only when the completions would otherwise be generated with weights more than
+            # `max_staleness` generation batches older than the ones they are trained with
+            self._generation_steps_since_sync += 1
+            if self._generation_steps_since_sync >= self.args.max_staleness:
+                self._sync_weights_to_vllm()
+                self._generation_steps_since_sync = 0
+            self._pending_generation = self._request_vllm_generation(next_inputs)
+
+        return self._generate_and_score_completions(
+            inputs,
+            prepared_prompts=pending_generation["prepared_prompts"],
+            completion_ids=completion_ids,
+            completion_logprobs=completion_logprobs,
+        )
+
+    def _get_dynamic_sampling_inputs(self) -> list[dict[str, Any]]:
+        # Returns a generation batch of further prompts to refill the zero-std groups with. They're drawn from a
+        # separate dataloader, shuffled with another seed, so that the training dataloader is left untouched.
+        if self._dynamic_sampling_dataloader is None:
+            train_dataset = self.train_dataset
+            if is_datasets_available() and isinstance(train_dataset, datasets.Dataset):
+                train_dataset = self._remove_unused_columns(train_dataset, description="training")
+            sampler = RepeatSampler(
+                data_source=train_dataset,
+                mini_repeat_count=self.num_generations,
+                batch_size=self.args.generation_batch_size // self.num_generations,
+                seed=self.args.seed + 1,
             )
-            prompts_text = [re.sub(rf"^({re.escape(self.pad_token)})+", "", text) for text in prompts_text]
+            dataloader = DataLoader(
+                train_dataset,
+                batch_size=self._train_batch_size * self.args.steps_per_generation,
+                sampler=sampler,
+                collate_fn=self.data_collator,
+            )
+            self._dynamic_sampling_dataloader = self.accelerator.prepare(dataloader)
+        if self._dynamic_sampling_iterator is not None:
+            inputs = next(self._dynamic_sampling_iterator, None)
+            if inputs is not None:
+                return inputs
+        # Start a new pass over the dataset. The sampler's generator isn't reset, so the order differs.
+        self._dynamic_sampling_iterator = iter(self._dynamic_sampling_dataloader)
+        return next(self._dynamic_sampling_iterator)
+
+    def _is_group_reward_std_zero(self, rewards_per_func: torch.Tensor) -> torch.Tensor:
+        # Whether all the completions of each group got the same (weighted) reward
+        rewards = (rewards_per_func * self.reward_weights.to(rewards_per_func.device).unsqueeze(0)).nansum(dim=1)
+        std_grouped_rewards = rewards.view(-1, self.num_generations).std(dim=1)
+        return torch.isclose(std_grouped_rewards, torch.zeros_like(std_grouped_rewards))
+
+    def _replace_groups(
+        self, batch: dict[str, Any], groups: torch.Tensor, new_batch: dict[str, Any], new_groups: torch.Tensor
+    ) -> dict[str, Any]:
+        # Returns a copy of the batch where the given groups are replaced with the given groups of the new batch. Both
+        # batches are local to the process. The prompts are left-padded and the completions right-padded to the
+        # longest of both batches.
+        offsets = torch.arange(self.num_generations, device=groups.device)
+        rows = (groups.unsqueeze(1) * self.num_generations + offsets).flatten()
+        new_rows = (new_groups.unsqueeze(1) * self.num_generations + offsets).flatten()
+        batch = dict(batch)
+        padded_keys = [
+            ("prompt_ids", self.pad_token_id, "left"),
+            ("prompt_mask", 0, "left"),
+            ("completion_ids", self.pad_token_id, "right"),
+            ("completion_mask", 0, "right"),
+            ("is_eos", False, "right"),
+            ("completion_logprobs", 0.0, "right"),
+        ]
+        for key, padding_value, padding_side in padded_keys:
+            if batch[key] is None:
+                continue
+            tensor, new_tensor = batch[key], new_batch[key]
+            length = max(tensor.size(1), new_tensor.size(1))
+            padding = (length - tensor.size(1), 0) if padding_side == "left" else (0, length - tensor.size(1))
+            new_padding = (
+                (length - new_tensor.size(1), 0) if padding_side == "left" else (0, length - new_tensor.size(1))
+            )
+            tensor = nn.functional.pad(tensor, padding, value=padding_value)
+            tensor[rows] = nn.functional.pad(new_tensor, new_padding, value=padding_value)[new_rows]
+            batch[key] = tensor
+        for key in ["completion_lengths", "rewards_per_func"]:
+            batch[key] = batch[key].clone()
+            batch[key][rows] = new_batch[key][new_rows]
+        rows, new_rows = rows.tolist(), new_rows.tolist()
+        for key in ["inputs", "prompts", "prompts_text", "completions_text"]:
+            batch[key] = list(batch[key])
+            for row, new_row in zip(rows, new_rows):
+                batch[key][row] = new_batch[key][new_row]
+        return batch
 
-            # The chat template inserts a single image token into the prompt text. However, when this text is later
-            # tokenized, the single image token string is expanded into multiple image token IDs, depending on the
-            # image size. Since we're detokenizing here, we may see repeated image tokens in the decoded text. We
-            # collapse them back into a single token string to match the original template.
-            if self.image_token is not None:
-                prompts_text = [
-                    re.sub(rf"({re.escape(self.image_token)})+", self.image_token, text) for text in prompts_text
-                ]
+    def _refill_zero_std_groups(self, batch: dict[str, Any]) -> dict[str, Any]:
+        # Dynamic sampling: replaces the groups whose completions all got the same reward (zero advantage) with groups
+        # with distinct rewards, generated from further prompts, within `max_dynamic_sampling_attempts` additional
+        # generation batches. The groups are local to each process (see `GRPOConfig.dynamic_sampling`), so each
+        # process refills its own groups, and the batch keeps its size and layout.
+        if batch["images"] is not None:
+            raise ValueError("Dynamic sampling is not supported for vision-language models yet.")
+        device = self.accelerator.device
+        num_prompts = len(batch["prompts"])
+        process_slice = slice(
+            self.accelerator.process_index * num_prompts, (self.accelerator.process_index + 1) * num_prompts
+        )
+
+        # Work on the local rewards, and gather them again at the end
+        batch = {**batch, "rewards_per_func": batch["rewards_per_func"][process_slice]}
+        is_std_zero = self._is_group_reward_std_zero(batch["rewards_per_func"])
+        num_generated = num_prompts
+        num_generation_batches = 1
+        for _ in range(self.args.max_dynamic_sampling_attempts):
+            zero_std_groups = is_std_zero.nonzero().squeeze(1)
+            # All processes generate together, so they stop when none of them has zero-std groups left
+            if self.accelerator.gather(torch.tensor([len(zero_std_groups)], device=device)).sum() == 0:
+                break
+            new_batch = self._generate_and_score_batch(self._get_dynamic_sampling_inputs())
+            new_batch["rewards_per_func"] = new_batch["rewards_per_func"][process_slice]
+            num_generated += num_prompts
+            num_generation_batches += 1
+            new_groups = (~self._is_group_reward_std_zero(new_batch["rewards_per_func"])).nonzero().squeeze(1)
+            num_replaced = min(len(zero_std_groups), len(new_groups))
+            zero_std_groups, new_groups = zero_std_groups[:num_replaced], new_groups[:num_replaced]
+            batch = self._replace_groups(batch, zero_std_groups, new_batch, new_groups)
+            is_std_zero[zero_std_groups] = False
+        batch["rewards_per_func"] = self.accelerator.gather(batch["rewards_per_func"])
+
+        # Number of completions in groups with distinct rewards in the final batch, and of generated completions
+        counts = torch.stack([(~is_std_zero).sum() * self.num_generations, torch.tensor(num_generated, device=device)])
+        effective_batch_size, num_generated = self.accelerator.gather(counts).view(-1, 2).sum(dim=0).float()
+        metrics = self._metrics["train"]
+        metrics.add("dynamic_sampling/num_generation_batches", num_generation_batches)
+        metrics.add("dynamic_sampling/effective_batch_size", effective_batch_size, reduction="none")
+        metrics.add("dynamic_sampling/wasted_generations", 1 - effective_batch_size / num_generated, reduction="none")
+        return batch
+
+    def _generate_and_score_batch(
+        self,
+        inputs: list[dict[str, Union[torch.Tensor, Any]]],
+        prepared_prompts: Optional[tuple] = None,
+        completion_ids: Optional[list[list[int]]] = None,
+        completion_logprobs: Optional[list[list[float]]] = None,
+    ) -> dict[str, Any]:
+        # Generates the completions of a generation batch and computes their rewards. `prepared_prompts`,
+        # `completion_ids` and `completion_logprobs` are passed in async generation mode, where the prompts were
+        # prepared and the completions generated in advance. All the values of the returned batch are local to the
+        # process, except `rewards_per_func`, which is gathered across processes.
+        device = self.accelerator.device
+
+        if prepared_prompts is None:
+            prepared_prompts = self._prepare_prompts(inputs)
+        prompts, original_prompts, images, prompts_text, prompt_inputs = prepared_prompts
+        has_images = images is not None
+        prompt_ids, prompt_mask = prompt_inputs["input_ids"], prompt_inputs["attention_mask"]
 
         # Generate completions using either vLLM or regular generation
         if self.use_vllm:
-            # First, update the vLLM weights if needed
-            if self.state.global_step != self._last_loaded_step:
-                self._move_model_to_vllm()
-                self._last_loaded_step = self.state.global_step
+            if completion_ids is None:
+                # First, update the vLLM weights if needed
+                self._sync_weights_to_vllm()
 
             # Generate completions using vLLM: gather all prompts and use them in a single call in the main process
             if self.vllm_mode == "server":
-                all_prompts_text = gather_object(prompts_text)
-                if has_images:
-                    all_images = gather_object(images)
-
-                if self.accelerator.is_main_process:
-                    # Since 'prompts' contains 'num_generations' duplicates, we first take unique prompts, and generate
-                    # num_generations outputs for each one. This is faster than generating outputs for each duplicate
-                    # prompt individually.
-                    ordered_set_of_prompts = all_prompts_text[:: self.num_generations]
-
-                    if has_images:
-                        ordered_set_of_images = all_images[:: self.num_generations]
-                    else:
-                        ordered_set_of_images = None
-
-                    with profiling_context(self, "vLLM.generate"):
-                        completion_ids = self.vllm_client.generate(
-                            prompts=ordered_set_of_prompts,
-                            images=ordered_set_of_images,
-                            n=self.num_generations,
-                            repetition_penalty=self.repetition_penalty,
-                            temperature=self.temperature,
-                            top_p=self.top_p,
-                            top_k=-1 if self.top_k is None else self.top_k,
-                            min_p=0.0 if self.min_p is None else self.min_p,
-                            max_tokens=self.max_completion_length,
-                            guided_decoding_regex=self.guided_decoding_regex,
-                            generation_kwargs=self.args.generation_kwargs,
-                        )
-                else:
-                    completion_ids = [None] * len(all_prompts_text)
-                # Broadcast the completions from the main process to all processes, ensuring each process receives its
-                # corresponding slice.
-                completion_ids = broadcast_object_list(completion_ids, from_process=0)
-                process_slice = slice(
-                    self.accelerator.process_index * len(prompts),
-                    (self.accelerator.process_index + 1) * len(prompts),
-                )
-                completion_ids = completion_ids[process_slice]
+                if completion_ids is None:
+                    generation_prompts = self._get_generation_prompts(prompts_text, prompt_inputs, images)
+                    future = self._submit_vllm_generation(generation_prompts, images)
+                    completion_ids, completion_logprobs = self._collect_vllm_generation(future, len(prompts))
 
             # Generate completions using colocated vLLM instances: each device holds vLLM copy and work on their own batch of prompts
             elif self.vllm_mode == "colocate":
@@ -1419,18 +2004,21 @@ class GRPOTrainer(Trainer):
                     "min_p": 0.0 if self.min_p is None else self.min_p,
                     "max_tokens": self.max_completion_length,
                     "guided_decoding": guided_decoding,
+                    # With `logprobs=0`, vLLM only returns the log-probability of the sampled token
+                    "logprobs": 0 if self.args.use_vllm_logprobs else None,
                 }
                 if self.args.generation_kwargs is not None:
                     generation_kwargs.update(self.args.generation_kwargs)
                 sampling_params = SamplingParams(**generation_kwargs)
 
+                generation_prompts = self._get_generation_prompts(prompts_text, prompt_inputs, images)
                 if self.vllm_tensor_parallel_size > 1:
                     # Gather prompts from all ranks in the TP group and flatten.
                     # Each rank starts with its own prompts; after gathering, all ranks see the full group set.
-                    orig_size = len(prompts_text)
+                    orig_size = len(generation_prompts)
                     gathered_prompts = [None for _ in range(self.vllm_tensor_parallel_size)]
-                    torch.distributed.all_gather_object(gathered_prompts, prompts_text, group=self.tp_group)
-                    all_prompts_text = [p for sublist in gathered_prompts for p in sublist]
+                    torch.distributed.all_gather_object(gathered_prompts, generation_prompts, group=self.tp_group)
+                    all_prompts = [p for sublist in gathered_prompts for p in sublist]
 
                     if has_images:
                         gathered_images = [None for _ in range(self.vllm_tensor_parallel_size)]
@@ -1439,23 +2027,31 @@ class GRPOTrainer(Trainer):
                     else:
                         all_images = None
                 else:
-                    all_prompts_text = prompts_text
+                    all_prompts = generation_prompts
                     all_images = images if has_images else None
 
                 if has_images and all_images:
                     vllm_inputs = []
-                    for prompt, image in zip(all_prompts_text, all_images):
+                    for prompt, image in zip(all_prompts, all_images):
                         if image is not None:
                             vllm_inputs.append({"prompt": prompt, "multi_modal_data": {"image": image}})
                         else:
                             vllm_inputs.append(prompt)
+                elif has_images:
+                    vllm_inputs = all_prompts
                 else:
-                    vllm_inputs = all_prompts_text
+                    vllm_inputs = [TokensPrompt(prompt_token_ids=token_ids) for token_ids in all_prompts]
 
                 with profiling_context(self, "vLLM.generate"):
                     all_outputs = self.llm.generate(vllm_inputs, sampling_params=sampling_params, use_tqdm=False)
 
                 completion_ids = [output.token_ids for outputs in all_outputs for output in outputs.outputs]
+                if self.args.use_vllm_logprobs:
+                    completion_logprobs = [
+                        [logprob[token_id].logprob for token_id, logprob in zip(output.token_ids, output.logprobs)]
+                        for outputs in all_outputs
+                        for output in outputs.outputs
+                    ]
 
                 if self.vllm_tensor_parallel_size > 1:
                     # Slice completions for this rank within its TP group.
@@ -1463,16 +2059,19 @@ class GRPOTrainer(Trainer):
                     local_rank_in_group = torch.distributed.get_rank(group=self.tp_group)
                     tp_slice = slice(local_rank_in_group * orig_size, (local_rank_in_group + 1) * orig_size)
                     completion_ids = completion_ids[tp_slice]
+                    if completion_logprobs is not None:
+                        completion_logprobs = completion_logprobs[tp_slice]
 
-            # Pad the completions, and concatenate them with the prompts
-            completion_ids = [torch.tensor(ids, device=device) for ids in completion_ids]
+            # Pad the completions. With `vllm_response_format="binary"`, the token IDs are int32 NumPy arrays.
+            completion_ids = [torch.tensor(ids, dtype=torch.long, device=device) for ids in completion_ids]
             completion_ids = pad(completion_ids, padding_value=self.pad_token_id)
-            prompt_completion_ids = torch.cat([prompt_ids, completion_ids], dim=1)
+            if completion_logprobs is not None:
+                completion_logprobs = [torch.tensor(logprobs, device=device) for logprobs in completion_logprobs]
+                completion_logprobs = pad(completion_logprobs, padding_value=0.0)
 
         elif self.use_transformers_paged:
-            # Re-process inputs for paged generation if needed
-            # Note: images are already validated and preprocessed above
-            paged_prompt_inputs = self.processing_class(text=prompts_text, **kwargs)
+            # Paged generation takes the unpadded prompt token IDs
+            prompt_token_ids = masked_tolist(prompt_ids, prompt_mask)
             previous_attn = self.model_wrapped.config._attn_implementation
 
             if is_flash_attn_2_available():
@@ -1494,14 +2093,11 @@ class GRPOTrainer(Trainer):
                     unwrapped_model.to(torch.float16)
                 with torch.inference_mode():
                     all_outputs = unwrapped_model.generate_batch(
-                        paged_prompt_inputs.input_ids, generation_config=self.generation_config, progress_bar=False
+                        prompt_token_ids, generation_config=self.generation_config, progress_bar=False
                     )
             completion_ids = [output.generated_tokens for output in all_outputs.values()]
             completion_ids = [torch.tensor(ids, device=device) for ids in completion_ids]
             completion_ids = pad(completion_ids, padding_value=self.pad_token_id, padding_side="right")
-            prompt_ids = [torch.tensor(ids, device=device) for ids in paged_prompt_inputs.input_ids]
-            prompt_ids = pad(prompt_ids, padding_value=self.pad_token_id, padding_side="left")
-            prompt_completion_ids = torch.cat([prompt_ids, completion_ids], dim=1)
             # Restore the original attention implementation, training mode
             self.model_wrapped.config._attn_implementation = previous_attn
         else:
@@ -1532,9 +2128,8 @@ class GRPOTrainer(Trainer):
 
         # Convert tensor to a list of lists of token IDs. This will be passed to the reward function, avoiding the need
         # to re-tokenize completions if the reward is computed from tokens.
-        completion_ids_list = [
-            [id.item() for id, m in zip(row, mask_row) if m] for row, mask_row in zip(completion_ids, completion_mask)
-        ]
+        with profiling_context(self, "completion_ids_list"):
+            completion_ids_list = masked_tolist(completion_ids, completion_mask)
 
         # Sum along sequence dimension (dim=1) to get completion length per sequence, used for logging
         completion_lengths = completion_mask.sum(1)
@@ -1544,6 +2139,62 @@ class GRPOTrainer(Trainer):
             truncated_completions = ~is_eos.any(dim=1)
             completion_mask = completion_mask * (~truncated_completions).unsqueeze(1).int()
 
+        # Decode the generated completions
+        completions_text = self.processing_class.batch_decode(completion_ids, skip_special_tokens=True)
+        if is_conversational(inputs[0]):
+            completions = []
+            for prompt, completion in zip(prompts, completions_text):
+                bootstrap = prompt.pop()["content"] if prompt[-1]["role"] == "assistant" else ""
+                completions.append([{"role": "assistant", "content": bootstrap + completion}])
+        else:
+            completions = completions_text
+
+        # Calculate rewards for each reward function. rewards_per_func aggregates rewards across all processes. This is
+        # important because rewards will be normalized per group, and completions are distributed. We will later slice
+        # rewards_per_func to extract each process's subset.
+        rewards_per_func = self._calculate_rewards(inputs, original_prompts, completions, completion_ids_list)
+
+        return {
+            "inputs": inputs,
+            "prompts": prompts,
+            "prompts_text": prompts_text,
+            "images": images,
+            "prompt_inputs": prompt_inputs,
+            "prompt_ids": prompt_ids,
+            "prompt_mask": prompt_mask,
+            "completion_ids": completion_ids,
+            "completion_mask": completion_mask,
+            "completion_logprobs": completion_logprobs,
+            "completion_lengths": completion_lengths,
+            "is_eos": is_eos,
+            "completions_text": completions_text,
+            "rewards_per_func": rewards_per_func,
+        }
+
+    def _generate_and_score_completions(
+        self,
+        inputs: list[dict[str, Union[torch.Tensor, Any]]],
+        prepared_prompts: Optional[tuple] = None,
+        completion_ids: Optional[list[list[int]]] = None,
+        completion_logprobs: Optional[list[list[float]]] = None,
+    ) -> dict[str, Union[torch.Tensor, Any]]:
+        # `prepared_prompts`, `completion_ids` and `completion_logprobs` are passed in async generation mode, see
+        # `_generate_and_score_batch`
+        device = self.accelerator.device
+        mode = "train" if self.model.training else "eval"
+
+        batch = self._generate_and_score_batch(inputs, prepared_prompts, completion_ids, completion_logprobs)
+        if self.args.dynamic_sampling and mode == "train":
+            batch = self._refill_zero_std_groups(batch)
+        prompts, prompts_text, completions_text = batch["prompts"], batch["prompts_text"], batch["completions_text"]
+        images, prompt_inputs = batch["images"], batch["prompt_inputs"]
+        has_images = images is not None
+        prompt_ids, prompt_mask = batch["prompt_ids"], batch["prompt_mask"]
+        completion_ids, completion_mask = batch["completion_ids"], batch["completion_mask"]
+        completion_lengths, is_eos = batch["completion_lengths"], batch["is_eos"]
+        completion_logprobs, rewards_per_func = batch["completion_logprobs"], batch["rewards_per_func"]
+        prompt_completion_ids = torch.cat([prompt_ids, completion_ids], dim=1)
+
         # Concatenate prompt_mask with completion_mask for logit computation
         attention_mask = torch.cat([prompt_mask, completion_mask], dim=1)  # (B, P+C)
 
@@ -1555,9 +2206,14 @@ class GRPOTrainer(Trainer):
             # a full optimizer step (when gradient_accumulation_steps is not a multiple of generate_every)—then the
             # samples may come from an earlier version of the model. In that case, we need to track old_per_token_logps
             # for importance sampling. If the steps are aligned, importance sampling isn't necessary and we set
-            # old_per_token_logps to None.
+            # old_per_token_logps to None. With `use_vllm_logprobs=True`, we use the log-probabilities of the sampled
+            # tokens returned by vLLM instead of recomputing them. Since they come from the weights that generated the
+            # completions, we also use them in async generation mode, where the samples are always off-policy.
             generate_every = self.args.steps_per_generation * self.num_iterations  # generation frequency
-            if self.args.gradient_accumulation_steps % generate_every != 0:
+            is_off_policy = self.args.gradient_accumulation_steps % generate_every != 0
+            if completion_logprobs is not None and (is_off_policy or self.args.async_generation):
+                old_per_token_logps = completion_logprobs.float()
+            elif is_off_policy:
                 old_per_token_logps, _ = self._get_per_token_logps_and_entropies(
                     self.model,
                     prompt_completion_ids,
@@ -1596,21 +2252,6 @@ class GRPOTrainer(Trainer):
             else:
                 ref_per_token_logps = None
 
-        # Decode the generated completions
-        completions_text = self.processing_class.batch_decode(completion_ids, skip_special_tokens=True)
-        if is_conversational(inputs[0]):
-            completions = []
-            for prompt, completion in zip(prompts, completions_text):
-                bootstrap = prompt.pop()["content"] if prompt[-1]["role"] == "assistant" else ""
-                completions.append([{"role": "assistant", "content": bootstrap + completion}])
-        else:
-            completions = completions_text
-
-        # Calculate rewards for each reward function. rewards_per_func aggregates rewards across all processes. This is
-        # important because rewards will be normalized per group, and completions are distributed. We will later slice
-        # rewards_per_func to extract each process's subset.
-        rewards_per_func = self._calculate_rewards(inputs, original_prompts, completions, completion_ids_list)
-
         # Apply weights to each reward function's output and sum
         rewards = (rewards_per_func * self.reward_weights.to(device).unsqueeze(0)).nansum(dim=1)
 
@@ -1625,6 +2266,9 @@ class GRPOTrainer(Trainer):
         advantages = rewards - mean_grouped_rewards
         if self.scale_rewards:
             advantages = advantages / (std_grouped_rewards + 1e-4)
+        # The mean of identical rewards can differ from them by a rounding error, amplified by the scaling above. The
+        # advantages of the zero-std groups are exactly zero, which allows skipping them (see `skip_zero_advantages`).
+        advantages = advantages.masked_fill(is_std_zero.repeat_interleave(self.num_generations, dim=0), 0.0)
 
         # Slice to keep only the local part of the data
         process_slice = slice(
@@ -1637,34 +2281,40 @@ class GRPOTrainer(Trainer):
         # Log the metrics
         if mode == "train":
             self.state.num_input_tokens_seen += self.accelerator.gather(attention_mask.sum()).sum().item()
-        self._metrics[mode]["num_tokens"] = [self.state.num_input_tokens_seen]
+        self._metrics[mode].set("num_tokens", self.state.num_input_tokens_seen)
+
+        # The metrics below are computed from gathered tensors, so they're the same on all processes and aren't
+        # reduced again when logged. They stay on the device until then.
+        metrics = self._metrics[mode]
 
         # Log completion lengths, mean, min, max
-        agg_completion_lengths = self.accelerator.gather(completion_lengths)
-        self._metrics[mode]["completions/mean_length"].append(agg_completion_lengths.float().mean().item())
-        self._metrics[mode]["completions/min_length"].append(agg_completion_lengths.float().min().item())
-        self._metrics[mode]["completions/max_length"].append(agg_completion_lengths.float().max().item())
+        agg_completion_lengths = self.accelerator.gather(completion_lengths).float()
+        metrics.add("completions/mean_length", agg_completion_lengths.mean(), reduction="none")
+        metrics.add("completions/min_length", agg_completion_lengths.min(), reduction="none")
+        metrics.add("completions/max_length", agg_completion_lengths.max(), reduction="none")
 
         # Identify sequences that terminated with EOS and log their lengths
         agg_terminated_with_eos = self.accelerator.gather(is_eos.any(dim=1))
-        term_completion_lengths = agg_completion_lengths[agg_terminated_with_eos]
-        clipped_completions_ratio = 1 - len(term_completion_lengths) / len(agg_completion_lengths)
-        self._metrics[mode]["completions/clipped_ratio"].append(clipped_completions_ratio)
-        if len(term_completion_lengths) == 0:  # edge case where no terminated sequences are found
-            term_completion_lengths = torch.zeros(1, device=device)
-        self._metrics[mode]["completions/mean_terminated_length"].append(term_completion_lengths.float().mean().item())
-        self._metrics[mode]["completions/min_terminated_length"].append(term_completion_lengths.float().min().item())
-        self._metrics[mode]["completions/max_terminated_length"].append(term_completion_lengths.float().max().item())
+        metrics.add("completions/clipped_ratio", 1 - agg_terminated_with_eos.float().mean(), reduction="none")
+        # Lengths of the terminated sequences are all 0 in the edge case where no terminated sequences are found
+        term_lengths = agg_completion_lengths * agg_terminated_with_eos
+        min_term_length = agg_completion_lengths.masked_fill(~agg_terminated_with_eos, torch.inf).min()
+        min_term_length = torch.where(agg_terminated_with_eos.any(), min_term_length, 0.0)
+        metrics.add(
+            "completions/mean_terminated_length",
+            term_lengths.sum() / agg_terminated_with_eos.sum().clamp(min=1),
+            reduction="none",
+        )
+        metrics.add("completions/min_terminated_length", min_term_length, reduction="none")
+        metrics.add("completions/max_terminated_length", term_lengths.max(), reduction="none")
 
         # Calculate mean reward per function, but only for samples where the function was applied (non-NaN values)
         for i, reward_func_name in enumerate(self.reward_func_names):
-            mean_rewards = torch.nanmean(rewards_per_func[:, i]).item()
-            self._metrics[mode][f"rewards/{reward_func_name}/mean"].append(mean_rewards)
-            std_rewards = nanstd(rewards_per_func[:, i]).item()
-            self._metrics[mode][f"rewards/{reward_func_name}/std"].append(std_rewards)
-        self._metrics[mode]["reward"].append(mean_grouped_rewards.mean().item())
-        self._metrics[mode]["reward_std"].append(std_grouped_rewards.mean().item())
-        self._metrics[mode]["frac_reward_zero_std"].append(is_std_zero.float().mean().item())
+            metrics.add(f"rewards/{reward_func_name}/mean", torch.nanmean(rewards_per_func[:, i]), reduction="none")
+            metrics.add(f"rewards/{reward_func_name}/std", nanstd(rewards_per_func[:, i]), reduction="none")
+        metrics.add("reward", mean_grouped_rewards.mean(), reduction="none")
+        metrics.add("reward_std", std_grouped_rewards.mean(), reduction="none")
+        metrics.add("frac_reward_zero_std", is_std_zero.float().mean(), reduction="none")
 
         # Log prompt and completion texts
         self._logs["prompt"].extend(gather_object(prompts_text))
@@ -1729,8 +2379,8 @@ class GRPOTrainer(Trainer):
 
         mode = "train" if self.model.training else "eval"
         if self.beta != 0.0:
-            self._metrics[mode]["kl"].append(self.accelerator.gather(mean_kl).mean().item())
-        self._metrics[mode]["clip_ratio"].append(self.accelerator.gather(clip_ratio).mean().item())
+            self._metrics[mode].add("kl", mean_kl)
+        self._metrics[mode].add("clip_ratio", clip_ratio)
         return loss
 
     @profiling_decorator
@@ -1797,7 +2447,10 @@ class GRPOTrainer(Trainer):
         if self.beta != 0.0:
             per_token_loss = per_token_loss + self.beta * per_token_kl
 
-        if self.loss_type == "grpo":
+        if "loss_weights" in inputs:
+            # Samples were moved between the batches of the same optimization step, see `_split_generation_batch`
+            loss = (per_token_loss * completion_mask * inputs["loss_weights"].unsqueeze(1)).sum()
+        elif self.loss_type == "grpo":
             loss = ((per_token_loss * completion_mask).sum(-1) / completion_mask.sum(-1).clamp(min=1.0)).mean()
         elif self.loss_type == "bnpo":
             loss = (per_token_loss * completion_mask).sum() / completion_mask.sum().clamp(min=1.0)
@@ -1811,7 +2464,7 @@ class GRPOTrainer(Trainer):
 
         if self.beta != 0.0:
             mean_kl = (per_token_kl * completion_mask).sum() / completion_mask.sum()
-            self._metrics[mode]["kl"].append(self.accelerator.gather(mean_kl).nanmean().item())
+            self._metrics[mode].add("kl", mean_kl, reduction="nanmean")
 
         # Compute the clipped probability ratios
         is_low_clipped = (coef_1 < 1 - self.epsilon_low) & (advantages.unsqueeze(1) < 0)
@@ -1822,14 +2475,12 @@ class GRPOTrainer(Trainer):
         high_clip = (is_high_clipped * completion_mask).sum() / completion_mask.sum()
         clip_ratio = (is_region_clipped * completion_mask).sum() / completion_mask.sum()
 
-        gathered_low_clip = self.accelerator.gather(low_clip)
-        self._metrics[mode]["clip_ratio/low_mean"].append(gathered_low_clip.nanmean().item())
-        self._metrics[mode]["clip_ratio/low_min"].append(nanmin(gathered_low_clip).item())
-        gathered_high_clip = self.accelerator.gather(high_clip)
-        self._metrics[mode]["clip_ratio/high_mean"].append(gathered_high_clip.nanmean().item())
-        self._metrics[mode]["clip_ratio/high_max"].append(nanmax(gathered_high_clip).item())
-        gathered_clip_ratio = self.accelerator.gather(clip_ratio)
-        self._metrics[mode]["clip_ratio/region_mean"].append(gathered_clip_ratio.nanmean().item())
+        # Reduced across processes when logged
+        self._metrics[mode].add("clip_ratio/low_mean", low_clip, reduction="nanmean")
+        self._metrics[mode].add("clip_ratio/low_min", low_clip, reduction="nanmin")
+        self._metrics[mode].add("clip_ratio/high_mean", high_clip, reduction="nanmean")
+        self._metrics[mode].add("clip_ratio/high_max", high_clip, reduction="nanmax")
+        self._metrics[mode].add("clip_ratio/region_mean", clip_ratio, reduction="nanmean")
         return loss
 
     def prediction_step(self, model, inputs, prediction_loss_only, ignore_keys: Optional[list[str]] = None):
@@ -1842,7 +2493,8 @@ class GRPOTrainer(Trainer):
 
     def log(self, logs: dict[str, float], start_time: Optional[float] = None) -> None:
         mode = "train" if self.model.training else "eval"
-        metrics = {key: sum(val) / len(val) for key, val in self._metrics[mode].items()}  # average the metrics
+        # Reduce the metrics across processes and average them over the steps, with a single synchronization
+        metrics = self._metrics[mode].compute(self.accelerator)
 
         # This method can be called both in training and evaluation. When called in evaluation, the keys in `logs`
         # start with "eval_". We need to add the prefix "eval_" to the keys in `metrics` to match the format.
@@ -50,7 +50,11 @@ from transformers import (
 from transformers.trainer_utils import EvalLoopOutput, has_length
 from transformers.utils import is_peft_available
 
-from ..data_utils import maybe_apply_chat_template, maybe_extract_prompt, maybe_unpair_preference_dataset
+from ..data_utils import (
+    maybe_apply_chat_template_dataset,
+    maybe_extract_prompt_dataset,
+    maybe_unpair_preference_dataset,
+)
 from ..import_utils import is_liger_kernel_available
 from ..models import create_reference_model, prepare_deepspeed
 from .kto_config import KTOConfig
@@ -588,32 +592,32 @@ class KTOTrainer(Trainer):
         # see: https://github.com/huggingface/trl/pull/1255
         with PartialState().main_process_first():
             # Extract the prompt if needed
-            train_dataset = train_dataset.map(
-                maybe_extract_prompt, num_proc=args.dataset_num_proc, desc="Extracting prompt from train dataset"
+            train_dataset = maybe_extract_prompt_dataset(
+                train_dataset,
+                map_kwargs={"num_proc": args.dataset_num_proc, "desc": "Extracting prompt from train dataset"},
             )
             # Unpair the dataset if needed
             train_dataset = maybe_unpair_preference_dataset(
                 train_dataset, args.dataset_num_proc, desc="Unpairing train dataset"
             )
             # Apply the chat template if needed
-            train_dataset = train_dataset.map(
-                maybe_apply_chat_template,
-                fn_kwargs={"tokenizer": processing_class},
-                num_proc=args.dataset_num_proc,
-                desc="Applying chat template to train dataset",
+            train_dataset = maybe_apply_chat_template_dataset(
+                train_dataset,
+                processing_class,
+                map_kwargs={"num_proc": args.dataset_num_proc, "desc": "Applying chat template to train dataset"},
             )
             if eval_dataset is not None:
-                eval_dataset = eval_dataset.map(
-                    maybe_extract_prompt, num_proc=args.dataset_num_proc, desc="Extracting prompt from eval dataset"
+                eval_dataset = maybe_extract_prompt_dataset(
+                    eval_dataset,
+                    map_kwargs={"num_proc": args.dataset_num_proc, "desc": "Extracting prompt from eval dataset"},
                 )
                 eval_dataset = maybe_unpair_preference_dataset(
                     eval_dataset, args.dataset_num_proc, desc="Unpairing eval dataset"
                 )
-                eval_dataset = eval_dataset.map(
-                    maybe_apply_chat_template,
-                    fn_kwargs={"tokenizer": processing_class},
-                    num_proc=args.dataset_num_proc,
-                    desc="Applying chat template to eval dataset",
+                eval_dataset = maybe_apply_chat_template_dataset(
+                    eval_dataset,
+                    processing_class,
+                    map_kwargs={"num_proc": args.dataset_num_proc, "desc": "Applying chat template to eval dataset"},
                 )
 
             # Tokenize and prepare the training datasets
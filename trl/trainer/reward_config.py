@@ -45,6 +45,16 @@ class RewardConfig(TrainingArguments):
         remove_unused_columns (`bool`, *optional*, defaults to `False`):
             Whether to remove the columns that are not used by the model's forward pass. Can be `True` only if the
             dataset is pretokenized.
+        max_tokens_per_batch (`int` or `None`, *optional*, defaults to `None`):
+            If set, the training batches hold a variable number of examples, up to this number of tokens (padding
+            included, counting both the chosen and rejected sequences), instead of `per_device_train_batch_size`
+            examples. The losses of the batches of a gradient accumulation step are weighted by their number of
+            examples. The lengths are read from the `length_column_name` column if the dataset has one, and computed
+            from the tokenized dataset otherwise.
+        length_bucket_size (`int` or `None`, *optional*, defaults to `None`):
+            When `max_tokens_per_batch` is set, number of examples of the buckets within which the shuffled examples
+            are sorted by length, so that the batches group examples of similar lengths. If `None`, no bucketing is
+            applied.
     """
 
     # Parameters whose default values are overridden from TrainingArguments
@@ -103,6 +113,24 @@ class RewardConfig(TrainingArguments):
             "if the dataset is pretokenized."
         },
     )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "If set, the training batches hold a variable number of examples, up to this number of tokens "
+            "(padding included, counting both the chosen and rejected sequences), instead of "
+            "`per_device_train_batch_size` examples. The losses of the batches of a gradient accumulation step are "
+            "weighted by their number of examples. The lengths are read from the `length_column_name` column if the "
+            "dataset has one, and computed from the tokenized dataset otherwise."
+        },
+    )
+    length_bucket_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "When `max_tokens_per_batch` is set, number of examples of the buckets within which the shuffled "
+            "examples are sorted by length, so that the batches group examples of similar lengths. If `None`, no "
+            "bucketing is applied."
+        },
+    )
 
     def __post_init__(self):
         self.bf16 = not (self.fp16) if self.bf16 is None else self.bf16
@@ -20,12 +20,14 @@ from dataclasses import FrozenInstanceError, replace
 from pathlib import Path
 from typing import Any, Callable, Optional, Union
 
+import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
 from accelerate import PartialState
 from accelerate.utils import gather_object
-from datasets import Dataset
+from datasets import Dataset, IterableDataset
+from torch.utils.data import DataLoader
 from transformers import (
     BaseImageProcessor,
     DataCollator,
@@ -50,6 +52,8 @@ from .utils import (
     disable_dropout_in_model,
     generate_model_card,
     get_comet_experiment_url,
+    get_list_lengths,
+    get_token_budget_dataloader,
     log_table_to_comet_experiment,
     print_rich_table,
 )
@@ -239,8 +243,9 @@ class RewardTrainer(Trainer):
                     # get truncated => noisy signal the chosen/rejected label gets lost. The downside is that the
                     # user might get surprised if N samples are missing from training.
                     eval_dataset = eval_dataset.filter(
-                        lambda x: len(x["input_ids_chosen"]) <= max_length
-                        and len(x["input_ids_rejected"]) <= max_length,
+                        lambda x: (
+                            len(x["input_ids_chosen"]) <= max_length and len(x["input_ids_rejected"]) <= max_length
+                        ),
                         num_proc=args.dataset_num_proc,
                     )
 
@@ -262,6 +267,35 @@ class RewardTrainer(Trainer):
         if hasattr(self.model, "add_model_tags"):
             self.model.add_model_tags(self._tag_names)
 
+        self._metrics = {"train": defaultdict(list), "eval": defaultdict(list)}
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.args.max_tokens_per_batch is None:
+            return super().get_train_dataloader()
+        if isinstance(self.train_dataset, IterableDataset):
+            raise ValueError("`max_tokens_per_batch` is not supported with an iterable dataset.")
+        if self.args.length_column_name in self.train_dataset.column_names:
+            lengths = np.asarray(self.train_dataset[self.args.length_column_name])
+        else:
+            # Chosen and rejected sequences are padded separately
+            lengths = get_list_lengths(self.train_dataset, ["input_ids_chosen", "input_ids_rejected"])
+        return get_token_budget_dataloader(self, lengths)
+
+    def get_batch_samples(self, epoch_iterator, num_batches, device):
+        if self.args.max_tokens_per_batch is None:
+            return super().get_batch_samples(epoch_iterator, num_batches, device)
+        batch_samples, num_items_in_batch = super().get_batch_samples(epoch_iterator, num_batches, device)
+        # Count the tokens of the optimization step, to compare the throughput of fixed and token-budget batching, and
+        # the examples, to weight the losses of batches of varying sizes
+        counts = torch.zeros(2, dtype=torch.long, device=device)
+        for batch in batch_samples:
+            counts[0] += batch["attention_mask_chosen"].sum() + batch["attention_mask_rejected"].sum()
+            counts[1] += len(batch["input_ids_chosen"])
+        counts = self.accelerator.gather(counts).view(-1, 2).sum(dim=0)
+        self._metrics["train"]["tokens_per_step"].append(counts[0].item())
+        self._num_examples_per_device = counts[1].item() / self.accelerator.num_processes
+        return batch_samples, num_items_in_batch
+
     def compute_loss(
         self,
         model: Union[PreTrainedModel, nn.Module],
@@ -288,6 +322,12 @@ class RewardTrainer(Trainer):
         if self.args.center_rewards_coefficient is not None:
             loss += self.args.center_rewards_coefficient * torch.mean((rewards_chosen + rewards_rejected) ** 2)
 
+        if self.args.max_tokens_per_batch is not None and self.model.training:
+            # The loss is averaged over the batch, so batches of varying sizes would weigh the same in the gradient
+            # accumulation step. Weight them by their number of examples instead.
+            num_examples = len(inputs["input_ids_chosen"])
+            loss = loss * num_examples * self.args.gradient_accumulation_steps / self._num_examples_per_device
+
         if return_outputs:
             return loss, {
                 "rewards_chosen": rewards_chosen,
@@ -332,6 +372,13 @@ class RewardTrainer(Trainer):
         self.visualize_samples(num_print_samples)
         return super().evaluate(*args, **kwargs)
 
+    def log(self, logs: dict[str, float], start_time: Optional[float] = None) -> None:
+        mode = "train" if self.model.training else "eval"
+        metrics = {key: sum(val) / len(val) for key, val in self._metrics[mode].items()}  # average the metrics
+        logs = {**logs, **metrics}
+        super().log(logs, start_time)
+        self._metrics[mode].clear()
+
     def visualize_samples(self, num_print_samples: int):
         """
         Visualize the reward model logits prediction
@@ -52,6 +52,19 @@ class SFTConfig(TrainingArguments):
             `skip_prepare_dataset`.
         dataset_num_proc (`int` or `None`, *optional*, defaults to `None`):
             Number of processes to use for processing the dataset.
+        batched_tokenization (`bool`, *optional*, defaults to `False`):
+            Whether to tokenize the dataset by batches instead of example by example. Chat templates are rendered and
+            encoded for a whole batch with the fast tokenizer, and the completion mask is derived from the token
+            offsets of the prompt+completion instead of tokenizing the prompt a second time. The result is the same as
+            the example-by-example tokenization. Requires a fast tokenizer.
+        dataset_cache_dir (`str` or `None`, *optional*, defaults to `None`):
+            If set, directory of an on-disk cache of preprocessed datasets. The cache key combines the dataset
+            fingerprint, a hash of the tokenizer (vocabulary, special tokens and chat template), the formatting
+            function and the preprocessing parameters, so that a relaunch with the same inputs loads the preprocessed
+            (memory-mapped) dataset instead of preprocessing it again. Only supported for [`~datasets.Dataset`].
+        dataset_cache_max_size_gb (`float` or `None`, *optional*, defaults to `None`):
+            Maximum size of the dataset cache in GB. When exceeded, the least recently used entries are removed. If
+            `None`, entries are never removed.
         eos_token (`str` or `None`, *optional*, defaults to `None`):
             Token used to indicate the end of a turn or sequence. If `None`, it defaults to
             `processing_class.eos_token`.
@@ -66,6 +79,18 @@ class SFTConfig(TrainingArguments):
             padding. Uses `max_length` to define sequence length.
         packing_strategy (`str`, *optional*, defaults to `"bfd"`):
             Strategy for packing sequences. Can be either `"bfd"` (best-fit decreasing, default), or `"wrapped"`.
+        global_packing (`bool`, *optional*, defaults to `False`):
+            Whether to pack the whole dataset at once instead of packing each batch of the dataset's map method
+            independently. This avoids partially filled packed sequences at the end of every batch. Only supported for
+            [`~datasets.Dataset`].
+        packing_window_size (`int` or `None`, *optional*, defaults to `None`):
+            When `global_packing=True` with strategy `"bfd"`, number of consecutive sequences over which the bin
+            assignment is computed before a final merge pass. If `None`, the assignment is computed over the whole
+            dataset.
+        packing_buffer_size (`int`, *optional*, defaults to `1000`):
+            When the dataset is an [`~datasets.IterableDataset`], it is packed on the fly and this sets the maximum
+            number of sequences held in memory while packing. A larger buffer gives a better packing at the cost of
+            memory.
         padding_free (`bool`, *optional*, defaults to `False`):
             Whether to perform forward passes without padding by flattening all sequences in the batch into a single
             continuous sequence. This reduces memory usage by eliminating padding overhead. Currently, this is only
@@ -76,6 +101,11 @@ class SFTConfig(TrainingArguments):
             If set, the sequences will be padded to a multiple of this value.
         eval_packing (`bool` or `None`, *optional*, defaults to `None`):
             Whether to pack the eval dataset. If `None`, uses the same value as `packing`.
+        arrow_collation (`bool`, *optional*, defaults to `False`):
+            Whether the dataloader fetches each batch as a single Arrow table instead of a list of examples, so that
+            [`~trainer.sft_trainer.DataCollatorForLanguageModeling`] builds each field with one vectorized operation
+            from the flat values and offsets of the table. The batches are the same. Only supported for
+            [`~datasets.Dataset`] and the default data collator.
 
         > Parameters that control the training
 
@@ -91,6 +121,15 @@ class SFTConfig(TrainingArguments):
             loss is computed on the entire sequence.
         activation_offloading (`bool`, *optional*, defaults to `False`):
             Whether to offload the activations to the CPU.
+        max_tokens_per_batch (`int` or `None`, *optional*, defaults to `None`):
+            If set, the training batches hold a variable number of examples, up to this number of tokens (padding
+            included), instead of `per_device_train_batch_size` examples. The losses of the batches of a
+            gradient accumulation step are weighted by their number of tokens. The lengths are read from the
+            `length_column_name` column if the dataset has one, and computed from the tokenized dataset otherwise.
+        length_bucket_size (`int` or `None`, *optional*, defaults to `None`):
+            When `max_tokens_per_batch` is set, number of examples of the buckets within which the shuffled examples
+            are sorted by length, so that the batches group examples of similar lengths. If `None`, no bucketing is
+            applied.
     """
 
     _VALID_DICT_FIELDS = TrainingArguments._VALID_DICT_FIELDS + ["model_init_kwargs"]
@@ -160,6 +199,32 @@ class SFTConfig(TrainingArguments):
         default=None,
         metadata={"help": "Number of processes to use for processing the dataset."},
     )
+    batched_tokenization: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to tokenize the dataset by batches instead of example by example. Chat templates are "
+            "rendered and encoded for a whole batch with the fast tokenizer, and the completion mask is derived from "
+            "the token offsets of the prompt+completion instead of tokenizing the prompt a second time. The result is "
+            "the same as the example-by-example tokenization. Requires a fast tokenizer."
+        },
+    )
+    dataset_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "If set, directory of an on-disk cache of preprocessed datasets. The cache key combines the "
+            "dataset fingerprint, a hash of the tokenizer (vocabulary, special tokens and chat template), the "
+            "formatting function and the preprocessing parameters, so that a relaunch with the same inputs loads the "
+            "preprocessed (memory-mapped) dataset instead of preprocessing it again. Only supported for "
+            "`datasets.Dataset`."
+        },
+    )
+    dataset_cache_max_size_gb: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": "Maximum size of the dataset cache in GB. When exceeded, the least recently used entries are "
+            "removed. If `None`, entries are never removed."
+        },
+    )
     eos_token: Optional[str] = field(
         default=None,
         metadata={
@@ -195,6 +260,30 @@ class SFTConfig(TrainingArguments):
             "`'wrapped'`."
         },
     )
+    global_packing: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to pack the whole dataset at once instead of packing each batch of the dataset's map "
+            "method independently. This avoids partially filled packed sequences at the end of every batch. Only "
+            "supported for `datasets.Dataset`."
+        },
+    )
+    packing_window_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "When `global_packing=True` with strategy `'bfd'`, number of consecutive sequences over which the "
+            "bin assignment is computed before a final merge pass. If `None`, the assignment is computed over the "
+            "whole dataset."
+        },
+    )
+    packing_buffer_size: int = field(
+        default=1000,
+        metadata={
+            "help": "When the dataset is a `datasets.IterableDataset`, it is packed on the fly and this sets the "
+            "maximum number of sequences held in memory while packing. A larger buffer gives a better packing at the "
+            "cost of memory."
+        },
+    )
     padding_free: bool = field(
         default=False,
         metadata={
@@ -213,6 +302,15 @@ class SFTConfig(TrainingArguments):
         default=None,
         metadata={"help": "Whether to pack the eval dataset. If `None`, uses the same value as `packing`."},
     )
+    arrow_collation: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether the dataloader fetches each batch as a single Arrow table instead of a list of examples, "
+            "so that `DataCollatorForLanguageModeling` builds each field with one vectorized operation from the flat "
+            "values and offsets of the table. The batches are the same. Only supported for `datasets.Dataset` and "
+            "the default data collator."
+        },
+    )
 
     # Parameters that control the training
     completion_only_loss: Optional[bool] = field(
@@ -241,7 +339,35 @@ class SFTConfig(TrainingArguments):
         default=False,
         metadata={"help": "Whether to offload the activations to the CPU."},
     )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "If set, the training batches hold a variable number of examples, up to this number of tokens "
+            "(padding included), instead of `per_device_train_batch_size` examples. The losses of the "
+            "batches of a gradient accumulation step are weighted by their number of tokens. The lengths are read "
+            "from the `length_column_name` column if the dataset has one, and computed from the tokenized dataset "
+            "otherwise."
+        },
+    )
+    length_bucket_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "When `max_tokens_per_batch` is set, number of examples of the buckets within which the shuffled "
+            "examples are sorted by length, so that the batches group examples of similar lengths. If `None`, no "
+            "bucketing is applied."
+        },
+    )
 
     def __post_init__(self):
         self.bf16 = not (self.fp16) if self.bf16 is None else self.bf16
         super().__post_init__()
+
+        if self.packing_window_size is not None and self.packing_window_size <= 0:
+            raise ValueError(f"packing_window_size must be a positive integer, got {self.packing_window_size}.")
+        if self.packing_window_size is not None and not (self.global_packing and self.packing_strategy == "bfd"):
+            raise ValueError(
+                "packing_window_size is only supported with global_packing=True and packing_strategy='bfd'."
+            )
+
+        if self.packing_buffer_size < 1:
+            raise ValueError(f"packing_buffer_size must be a positive integer, got {self.packing_buffer_size}.")
@@ -12,9 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
 import contextlib
 import dataclasses
+import hashlib
+import json
 import os
+import pickle
+import shutil
 import warnings
 from collections import defaultdict
 from collections.abc import Mapping
@@ -22,11 +27,16 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import Any, Callable, Optional, TypeVar, Union
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import torch
 import torch.nn as nn
 from accelerate import PartialState
-from datasets import Dataset, IterableDataset
+from datasets import Dataset, IterableDataset, load_from_disk
+from datasets.fingerprint import Hasher
 from packaging import version
+from torch.utils.data import DataLoader
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
@@ -43,18 +53,29 @@ from transformers import (
 from transformers.data.data_collator import DataCollatorMixin
 from transformers.trainer_callback import TrainerCallback
 from transformers.trainer_utils import EvalPrediction
-from transformers.utils import is_peft_available
+from transformers.utils import is_peft_available, logging
 
+from .. import __version__ as trl_version
 from ..data_utils import (
+    TokenShardDataset,
     is_conversational,
     is_conversational_from_value,
-    maybe_convert_to_chatml,
+    maybe_convert_to_chatml_dataset,
     pack_dataset,
     truncate_dataset,
 )
 from ..models import clone_chat_template, get_act_offloading_ctx_manager
 from .sft_config import SFTConfig
-from .utils import generate_model_card, get_comet_experiment_url, pad, peft_module_casting_to_bf16
+from .utils import (
+    evict_dataset_cache,
+    generate_model_card,
+    get_comet_experiment_url,
+    get_list_lengths,
+    get_token_budget_dataloader,
+    hash_processing_class,
+    pad,
+    peft_module_casting_to_bf16,
+)
 
 
 if is_peft_available():
@@ -65,6 +86,8 @@ if is_wandb_available():
     import wandb
 
 
+logger = logging.get_logger(__name__)
+
 TListOrMapping = TypeVar("TListOrMapping", list, Mapping)
 
 
@@ -99,6 +122,40 @@ def remove_none_values(example: TListOrMapping) -> TListOrMapping:
         raise TypeError("Input must be a list or a dictionary.")
 
 
+def _get_column_names(dataset: Union[Dataset, IterableDataset]) -> list[str]:
+    """
+    Returns the column names of a dataset. When they are unknown, as for an `IterableDataset` whose features can't be
+    inferred, they are read from the first example.
+    """
+    if dataset.column_names is not None:
+        return dataset.column_names
+    return list(next(iter(dataset), {}).keys())
+
+
+def _num_prompt_tokens(offsets: list[tuple[int, int]], prompt_length: int) -> Optional[int]:
+    """
+    Returns the number of tokens the prompt alone is tokenized into, given the character offsets of the tokenized
+    prompt+completion and the number of characters of the prompt, or `None` if a token spans both the prompt and the
+    completion (in which case the prompt must be tokenized on its own).
+
+    Special tokens added by the tokenizer have empty `(0, 0)` offsets: the leading ones belong to the prompt, and the
+    trailing ones would also be added at the end of the prompt tokenized on its own.
+    """
+    num_tokens = len(offsets)
+    while num_tokens > 0 and offsets[num_tokens - 1] == (0, 0):
+        num_tokens -= 1
+    # Without the trailing special tokens, the offsets are sorted, so the first token that starts after the prompt is
+    # found by bisection
+    i = bisect.bisect_left(offsets, (prompt_length,), 0, num_tokens)
+    if i > 0 and offsets[i - 1][1] > prompt_length:
+        return None
+    while i < num_tokens and offsets[i][1] <= prompt_length:  # empty tokens at the end of the prompt
+        i += 1
+    if i == num_tokens:  # no completion token
+        return len(offsets)
+    return i + len(offsets) - num_tokens
+
+
 @dataclass
 class DataCollatorForLanguageModeling(DataCollatorMixin):
     """
@@ -177,7 +234,10 @@ class DataCollatorForLanguageModeling(DataCollatorMixin):
     pad_to_multiple_of: Optional[int] = None
     return_tensors: str = "pt"
 
-    def torch_call(self, examples: list[Union[list[int], Any, dict[str, Any]]]) -> dict[str, Any]:
+    def torch_call(self, examples: Union[list[Union[list[int], Any, dict[str, Any]]], pa.Table]) -> dict[str, Any]:
+        if isinstance(examples, pa.Table):
+            return self._arrow_torch_call(examples)
+
         # Convert to tensor
         input_ids = [torch.tensor(example["input_ids"]) for example in examples]
 
@@ -249,6 +309,61 @@ class DataCollatorForLanguageModeling(DataCollatorMixin):
                 output["labels"][assistant_masks == 0] = -100
         return output
 
+    def _arrow_torch_call(self, examples: pa.Table) -> dict[str, Any]:
+        # Same as `torch_call`, but each field is built at once from the flat values and lengths of the batch
+        input_ids, lengths = self._flatten(examples["input_ids"])
+        has_packed_position_ids = (
+            self.return_position_ids and "seq_lengths" in examples.column_names and self.padding_free
+        )
+
+        if self.return_position_ids:
+            if "seq_lengths" in examples.column_names:
+                seq_lengths, _ = self._flatten(examples["seq_lengths"])
+            else:
+                seq_lengths = lengths
+            # Position IDs restart from 0 at the start of each sequence
+            seq_starts = seq_lengths.cumsum(0) - seq_lengths
+            position_ids = torch.arange(len(input_ids)) - seq_starts.repeat_interleave(seq_lengths)
+        if "labels" in examples.column_names:
+            labels, _ = self._flatten(examples["labels"])
+        else:
+            labels = input_ids.clone()
+        if self.completion_only_loss and "completion_mask" in examples.column_names:
+            completion_mask, _ = self._flatten(examples["completion_mask"])
+            labels[completion_mask == 0] = -100  # mask everything that is not in the completion
+        if "assistant_masks" in examples.column_names:
+            assistant_masks, _ = self._flatten(examples["assistant_masks"])
+            labels[assistant_masks == 0] = -100
+
+        output = {}
+        if self.padding_free:
+            output["input_ids"] = input_ids.unsqueeze(0)
+            if not has_packed_position_ids:
+                output["attention_mask"] = torch.ones_like(output["input_ids"])
+            if self.return_position_ids:
+                output["position_ids"] = position_ids.unsqueeze(0)
+            output["labels"] = labels.unsqueeze(0)
+        else:
+            max_length = int(lengths.max())
+            if self.pad_to_multiple_of is not None:
+                max_length = -(-max_length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+            mask = torch.arange(max_length) < lengths.unsqueeze(1)
+            output["input_ids"] = input_ids.new_full(mask.shape, self.pad_token_id).masked_scatter_(mask, input_ids)
+            output["attention_mask"] = mask.long()
+            if self.return_position_ids:
+                output["position_ids"] = position_ids.new_zeros(mask.shape).masked_scatter_(mask, position_ids)
+            output["labels"] = labels.new_full(mask.shape, -100).masked_scatter_(mask, labels)
+        return output
+
+    @staticmethod
+    def _flatten(column: Union[pa.Array, pa.ChunkedArray]) -> tuple[torch.Tensor, torch.Tensor]:
+        """Concatenated values and lengths of the lists of an Arrow list column, as `int64` tensors."""
+        if isinstance(column, pa.ChunkedArray):
+            column = column.combine_chunks()
+        values = pc.list_flatten(column).to_numpy(zero_copy_only=False)
+        lengths = pc.list_value_length(column).to_numpy(zero_copy_only=False)
+        return torch.tensor(values, dtype=torch.long), torch.tensor(lengths, dtype=torch.long)
+
     @staticmethod
     def _convert_seq_lengths_to_position_ids(batch_seq_lengths: list[list[int]]) -> list[torch.Tensor]:
         example_lengths = [sum(seq_lengths) for seq_lengths in batch_seq_lengths]
@@ -262,6 +377,26 @@ class DataCollatorForLanguageModeling(DataCollatorMixin):
         return list(position_ids.split(example_lengths))
 
 
+class _ArrowBatchDataset(torch.utils.data.Dataset):
+    """
+    Wrapper of a [`~datasets.Dataset`] whose batches are fetched by the dataloader as a single Arrow table, sliced from
+    the dataset without converting the rows to Python objects.
+    """
+
+    def __init__(self, dataset: Dataset):
+        self.dataset = dataset.with_format("arrow")
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, idx: int) -> pa.Table:
+        return self.dataset[idx : idx + 1]
+
+    # Called by the dataloader with the indices of a batch, instead of `__getitem__` for each of them
+    def __getitems__(self, indices: list[int]) -> pa.Table:
+        return self.dataset[indices]
+
+
 class SFTTrainer(Trainer):
     """
     Trainer for Supervised Fine-Tuning (SFT) method.
@@ -303,7 +438,8 @@ class SFTTrainer(Trainer):
             - [Conversational](dataset_formats#conversational): Each sample contains structured messages (e.g., role
               and content).
 
-            The trainer also supports processed datasets (tokenized) as long as they contain an `input_ids` field.
+            The trainer also supports processed datasets (tokenized) as long as they contain an `input_ids` field, and
+            [`TokenShardDataset`] shards written from them.
         eval_dataset ([`~datasets.Dataset`], [`~datasets.IterableDataset`] or `dict[str, Union[Dataset, IterableDataset]]`):
             Dataset to use for evaluation. It must meet the same requirements as `train_dataset`.
         processing_class ([`~transformers.PreTrainedTokenizerBase`], [`~transformers.BaseImageProcessor`], [`~transformers.FeatureExtractionMixin`] or [`~transformers.ProcessorMixin`], *optional*, defaults to `None`):
@@ -344,7 +480,7 @@ class SFTTrainer(Trainer):
         model: Union[str, nn.Module, PreTrainedModel],
         args: Optional[Union[SFTConfig, TrainingArguments]] = None,
         data_collator: Optional[DataCollator] = None,  # type: ignore
-        train_dataset: Optional[Union[Dataset, IterableDataset]] = None,
+        train_dataset: Optional[Union[Dataset, IterableDataset, TokenShardDataset]] = None,
         eval_dataset: Optional[Union[Dataset, dict[str, Dataset]]] = None,
         processing_class: Optional[
             Union[PreTrainedTokenizerBase, BaseImageProcessor, FeatureExtractionMixin, ProcessorMixin]
@@ -434,7 +570,10 @@ class SFTTrainer(Trainer):
 
         if args.completion_only_loss is None:
             first_example = next(iter(train_dataset))
-            self.completion_only_loss = "prompt" in first_example
+            if isinstance(train_dataset, TokenShardDataset):  # the prompt-completion dataset was already tokenized
+                self.completion_only_loss = "completion_mask" in first_example
+            else:
+                self.completion_only_loss = "prompt" in first_example
         else:
             self.completion_only_loss = args.completion_only_loss
 
@@ -457,6 +596,11 @@ class SFTTrainer(Trainer):
                 return_position_ids=model.config._attn_implementation == "flash_attention_2",
                 pad_to_multiple_of=args.pad_to_multiple_of,
             )
+        elif args.arrow_collation and not isinstance(data_collator, DataCollatorForLanguageModeling):
+            raise ValueError(
+                "`arrow_collation=True` is only supported with `DataCollatorForLanguageModeling`, which can collate "
+                f"batches fetched as Arrow tables, but got a {data_collator.__class__.__name__}."
+            )
 
         if (
             args.packing
@@ -645,13 +789,23 @@ class SFTTrainer(Trainer):
         formatting_func: Optional[Callable[[dict], str]],
         dataset_name: str,
     ) -> Union[Dataset, IterableDataset]:
+        # Token shards are written from processed datasets
+        if isinstance(dataset, TokenShardDataset):
+            return dataset
+
+        cache_path = None
+        if args.dataset_cache_dir is not None and isinstance(dataset, Dataset):
+            cache_key = self._get_dataset_cache_key(dataset, processing_class, args, packing, formatting_func)
+            if cache_key is not None:
+                cache_path = os.path.join(args.dataset_cache_dir, cache_key)
+
         # Tabular backends like Arrow/Parquet insert `None` for mismatched keys in nested structures. Clean them from
         # sampled data.
         if isinstance(dataset, Dataset):  # IterableDataset does not support `with_transform`
             dataset = dataset.with_transform(remove_none_values)
 
         # If the dataset is already preprocessed (tokenized), skip the processing steps.
-        column_names = list(next(iter(dataset)).keys())
+        column_names = _get_column_names(dataset)
         is_processed = "input_ids" in column_names
 
         # Build the kwargs for the `map` function
@@ -660,6 +814,12 @@ class SFTTrainer(Trainer):
             map_kwargs["num_proc"] = args.dataset_num_proc
 
         with PartialState().main_process_first():
+            if cache_path is not None:
+                if os.path.isdir(cache_path):
+                    logger.info(f"Loading preprocessed {dataset_name} dataset from cache at {cache_path}.")
+                    return self._load_dataset_from_cache(cache_path, args, packing)
+                logger.info(f"No preprocessed {dataset_name} dataset found in cache, preprocessing it.")
+
             # Apply the formatting function if any
             if formatting_func is not None and is_processed:
                 warnings.warn(
@@ -695,12 +855,7 @@ class SFTTrainer(Trainer):
                 if is_conversational_from_value(first_example):
                     if isinstance(dataset, Dataset):  # `IterableDataset.map` does not support `desc`
                         map_kwargs["desc"] = f"Converting {dataset_name} dataset to ChatML"
-                    column_names = next(iter(dataset)).keys()
-                    dataset = dataset.map(
-                        maybe_convert_to_chatml,
-                        remove_columns="conversations" if "conversations" in column_names else None,
-                        **map_kwargs,
-                    )
+                    dataset = maybe_convert_to_chatml_dataset(dataset, map_kwargs=map_kwargs)
 
                 # Apply the chat template if needed
                 first_example = next(iter(dataset))
@@ -786,8 +941,111 @@ class SFTTrainer(Trainer):
                             output = {"input_ids": processing_class(text=example[dataset_text_field])["input_ids"]}
                     return output
 
+                def batched_tokenize(examples, processing_class, dataset_text_field, assistant_only_loss):
+                    num_examples = len(next(iter(examples.values())))
+                    # Tools and chat template kwargs can vary from one example to another, while a batched chat
+                    # template call takes a single value for them, so these datasets are tokenized example by example
+                    if "tools" in examples or "chat_template_kwargs" in examples:
+                        outputs = [
+                            tokenize(
+                                {key: value[i] for key, value in examples.items()},
+                                processing_class,
+                                dataset_text_field,
+                                assistant_only_loss,
+                            )
+                            for i in range(num_examples)
+                        ]
+                        return {key: [output[key] for output in outputs] for key in outputs[0]}
+
+                    first_example = {key: value[0] for key, value in examples.items()}
+                    if "prompt" in examples:  # prompt-completion case
+                        output = {}
+                        if is_conversational(first_example):
+                            # Rendered without tokenization, only to find where the completion starts
+                            prompt_texts = processing_class.apply_chat_template(examples["prompt"], tokenize=False)
+                            prompts_completions = [
+                                prompt + completion
+                                for prompt, completion in zip(examples["prompt"], examples["completion"])
+                            ]
+                            texts = processing_class.apply_chat_template(prompts_completions, tokenize=False)
+                            if assistant_only_loss:
+                                processed = processing_class.apply_chat_template(
+                                    prompts_completions,
+                                    return_dict=True,
+                                    return_assistant_tokens_mask=True,
+                                    tokenizer_kwargs={"return_offsets_mapping": True},
+                                )
+                                output["assistant_masks"] = processed["assistant_masks"]
+                            else:
+                                processed = processing_class(
+                                    text=texts, add_special_tokens=False, return_offsets_mapping=True
+                                )
+                            prompt_kwargs = {"add_special_tokens": False}
+                        else:
+                            prompt_texts = examples["prompt"]
+                            texts = [
+                                prompt + completion
+                                for prompt, completion in zip(examples["prompt"], examples["completion"])
+                            ]
+                            processed = processing_class(text=texts, return_offsets_mapping=True)
+                            prompt_kwargs = {}
+
+                        completion_masks = []
+                        for prompt_text, text, prompt_completion_ids, offsets in zip(
+                            prompt_texts, texts, processed["input_ids"], processed["offset_mapping"]
+                        ):
+                            num_prompt_tokens = None
+                            if text.startswith(prompt_text):
+                                num_prompt_tokens = _num_prompt_tokens(offsets, len(prompt_text))
+                            if num_prompt_tokens is None:  # fall back to tokenizing the prompt on its own
+                                prompt_ids = processing_class(text=prompt_text, **prompt_kwargs)["input_ids"]
+                                if not prompt_completion_ids[: len(prompt_ids)] == prompt_ids:
+                                    warnings.warn(
+                                        "Mismatch between tokenized prompt and the start of tokenized "
+                                        "prompt+completion. This may be due to unexpected tokenizer behavior, "
+                                        "whitespace issues, or special token handling. Verify that the tokenizer is "
+                                        "processing text consistently."
+                                    )
+                                num_prompt_tokens = len(prompt_ids)
+                            completion_masks.append(
+                                [0] * num_prompt_tokens + [1] * (len(prompt_completion_ids) - num_prompt_tokens)
+                            )
+                        output["input_ids"] = processed["input_ids"]
+                        output["completion_mask"] = completion_masks
+
+                    else:  # language modeling case
+                        if is_conversational(first_example):
+                            processed = processing_class.apply_chat_template(
+                                examples["messages"],
+                                return_dict=True,
+                                return_assistant_tokens_mask=assistant_only_loss,
+                            )
+                            if "assistant_masks" in processed and any(
+                                1 not in assistant_masks for assistant_masks in processed["assistant_masks"]
+                            ):
+                                raise RuntimeError(
+                                    "You're using `assistant_only_loss=True`, but at least one example has no "
+                                    "assistant tokens. This usually means the tokenizer's chat template doesn't "
+                                    "generate assistant masks — it may be missing the `{% generation %}` keyword. Please "
+                                    "check the template and ensure it's correctly configured to support assistant "
+                                    "masking."
+                                )
+                            output = {k: processed[k] for k in ("input_ids", "assistant_masks") if k in processed}
+                        else:
+                            output = {"input_ids": processing_class(text=examples[dataset_text_field])["input_ids"]}
+                    return output
+
+                batched = args.batched_tokenization
+                if batched and not getattr(processing_class, "is_fast", False):
+                    warnings.warn(
+                        "`batched_tokenization=True` requires a fast tokenizer, which is not the case of the provided "
+                        "processing class. The dataset will be tokenized example by example."
+                    )
+                    batched = False
+
                 dataset = dataset.map(
-                    tokenize,
+                    batched_tokenize if batched else tokenize,
+                    batched=batched,
                     fn_kwargs={
                         "processing_class": processing_class,
                         "dataset_text_field": args.dataset_text_field,
@@ -803,16 +1061,25 @@ class SFTTrainer(Trainer):
                 if isinstance(dataset, Dataset):  # `IterableDataset.map` does not support `desc`
                     map_kwargs["desc"] = f"Packing {dataset_name} dataset"
 
+                column_names = _get_column_names(dataset)
                 columns = ["input_ids"]
-                if "completion_mask" in dataset.column_names:
+                if "completion_mask" in column_names:
                     columns.append("completion_mask")
-                if "assistant_masks" in dataset.column_names:
+                if "assistant_masks" in column_names:
                     columns.append("assistant_masks")
 
                 dataset = dataset.select_columns(columns)
 
                 # Packing adds new column "seq_lengths" needed for document aware flash attention
-                dataset = pack_dataset(dataset, args.max_length, args.packing_strategy, map_kwargs)
+                dataset = pack_dataset(
+                    dataset,
+                    args.max_length,
+                    args.packing_strategy,
+                    map_kwargs,
+                    global_packing=args.global_packing,
+                    window_size=args.packing_window_size,
+                    buffer_size=args.packing_buffer_size,
+                )
             elif args.max_length is not None:
                 if isinstance(dataset, Dataset):  # `IterableDataset.map` does not support `desc`
                     map_kwargs["desc"] = f"Truncating {dataset_name} dataset"
@@ -823,6 +1090,76 @@ class SFTTrainer(Trainer):
                     {"input_ids", "seq_lengths", "completion_mask"}.intersection(dataset.column_names)
                 )
 
+            if cache_path is not None and PartialState().is_main_process:
+                dataset = self._save_dataset_to_cache(dataset, cache_path, args, packing)
+
+        return dataset
+
+    def _get_dataset_cache_key(
+        self,
+        dataset: Dataset,
+        processing_class: Union[PreTrainedTokenizerBase, BaseImageProcessor, FeatureExtractionMixin, ProcessorMixin],
+        args: SFTConfig,
+        packing: bool,
+        formatting_func: Optional[Callable[[dict], str]],
+    ) -> Optional[str]:
+        # The key only depends on the content of the inputs, not on the Python objects, so that it's stable across
+        # relaunches
+        try:
+            formatting_func_hash = Hasher.hash(formatting_func) if formatting_func is not None else None
+        except (pickle.PicklingError, TypeError) as e:
+            # E.g., the function references a generator or a connection, which can't be pickled
+            logger.warning(
+                f"Dataset caching is disabled for this dataset because the formatting function can't be hashed: {e}"
+            )
+            return None
+        key = {
+            "trl_version": trl_version,
+            "dataset_fingerprint": dataset._fingerprint,
+            "processing_class": hash_processing_class(processing_class),
+            "formatting_func": formatting_func_hash,
+            "packing": packing,
+            **{
+                field: getattr(args, field)
+                for field in (
+                    "dataset_text_field",
+                    "max_length",
+                    "packing_strategy",
+                    "global_packing",
+                    "packing_window_size",
+                    "assistant_only_loss",
+                    "use_liger_kernel",
+                )
+            },
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def _load_dataset_from_cache(self, cache_path: str, args: SFTConfig, packing: bool) -> Dataset:
+        os.utime(cache_path)  # mark the entry as recently used for the eviction
+        dataset = load_from_disk(cache_path)
+        # Packing and truncation reset the format, otherwise the `remove_none_values` transform is kept
+        if not packing and args.max_length is None:
+            dataset = dataset.with_transform(remove_none_values)
+        return dataset
+
+    def _save_dataset_to_cache(self, dataset: Dataset, cache_path: str, args: SFTConfig, packing: bool) -> Dataset:
+        # Write to a temporary directory first, so that an interrupted write never results in a corrupted cache entry
+        tmp_path = f"{cache_path}.tmp{os.getpid()}"
+        dataset.with_format(None).save_to_disk(tmp_path, num_proc=args.dataset_num_proc)
+        try:
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            if not os.path.isdir(cache_path):
+                raise
+            # Another job sharing the cache directory saved the same entry in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            logger.info(f"Preprocessed dataset was already saved to cache at {cache_path}, loading it.")
+            return self._load_dataset_from_cache(cache_path, args, packing)
+        logger.info(f"Saved preprocessed dataset to cache at {cache_path}.")
+        if args.dataset_cache_max_size_gb is not None:
+            max_size = int(args.dataset_cache_max_size_gb * 1024**3)
+            for path in evict_dataset_cache(args.dataset_cache_dir, max_size):
+                logger.info(f"Evicted {path} from the dataset cache.")
         return dataset
 
     def _set_signature_columns_if_needed(self):
@@ -839,6 +1176,42 @@ class SFTTrainer(Trainer):
                 "assistant_masks",
             ]
 
+    def _remove_unused_columns(self, dataset: Dataset, description: Optional[str] = None):
+        dataset = super()._remove_unused_columns(dataset, description=description)
+        # Called on the datasets right before building the dataloaders
+        if self.args.arrow_collation:
+            dataset = _ArrowBatchDataset(dataset)
+        return dataset
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.args.max_tokens_per_batch is None:
+            return super().get_train_dataloader()
+        if isinstance(self.train_dataset, IterableDataset):
+            raise ValueError("`max_tokens_per_batch` is not supported with an iterable dataset.")
+        if isinstance(self.train_dataset, TokenShardDataset):
+            lengths = self.train_dataset.lengths
+        elif self.args.length_column_name in (self.train_dataset.column_names or []):
+            lengths = np.asarray(self.train_dataset[self.args.length_column_name])
+        else:
+            lengths = get_list_lengths(self.train_dataset, ["input_ids"])
+        return get_token_budget_dataloader(self, lengths, padding_free=self.padding_free)
+
+    def get_batch_samples(self, epoch_iterator, num_batches, device):
+        if self.args.max_tokens_per_batch is None:
+            return super().get_batch_samples(epoch_iterator, num_batches, device)
+        batch_samples, num_items_in_batch = super().get_batch_samples(epoch_iterator, num_batches, device)
+        # Count the tokens of the optimization step, to compare the throughput of fixed and token-budget batching, and
+        # the label tokens, to weight the losses of batches of varying sizes
+        counts = torch.zeros(2, dtype=torch.long, device=device)
+        for batch in batch_samples:
+            counts[0] += batch["attention_mask"].sum() if "attention_mask" in batch else batch["input_ids"].numel()
+            if "labels" in batch:
+                counts[1] += (batch["labels"] != -100).sum()
+        counts = self.accelerator.gather(counts).view(-1, 2).sum(dim=0)
+        self._metrics["train"]["tokens_per_step"].append(counts[0].item())
+        self._num_items_per_device = counts[1].item() / self.accelerator.num_processes
+        return batch_samples, num_items_in_batch
+
     def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
         """
         Compute training loss and additionally compute token accuracies
@@ -847,6 +1220,11 @@ class SFTTrainer(Trainer):
         (loss, outputs) = super().compute_loss(
             model, inputs, return_outputs=True, num_items_in_batch=num_items_in_batch
         )
+        if mode == "train" and self.args.max_tokens_per_batch is not None and num_items_in_batch is None:
+            # Without `num_items_in_batch`, the loss is averaged over the batch, so batches of varying sizes would
+            # weigh the same in the gradient accumulation step. Weight them by their number of label tokens instead.
+            num_items = (inputs["labels"] != -100).sum()
+            loss = loss * num_items * self.args.gradient_accumulation_steps / max(self._num_items_per_device, 1)
         if mode == "train":
             # When using padding-free, the attention_mask is not present in the inputs, instead we have cu_seq_lens_q,
             # cu_seq_lens_k, and max_length_k, max_length_q and position_ids.
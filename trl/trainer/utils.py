@@ -13,33 +13,43 @@
 # limitations under the License.
 
 import dataclasses
+import hashlib
 import importlib.resources as pkg_resources
 import json
+import os
 import random
+import shutil
 import warnings
 from collections import deque
 from dataclasses import dataclass, field
+from functools import partial
 from importlib.metadata import version
 from typing import Any, Literal, Optional, Union
 
 import numpy as np
 import pandas as pd
+import pyarrow.compute as pc
 import torch
 import torch.nn.functional as F
 import torch.utils.data
 from accelerate import Accelerator, PartialState
 from accelerate.state import AcceleratorState
+from datasets import Dataset
 from huggingface_hub import ModelCard, ModelCardData
 from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import DataLoader
 from transformers import (
     BitsAndBytesConfig,
     EvalPrediction,
     GenerationConfig,
     PreTrainedTokenizerBase,
+    ProcessorMixin,
+    Trainer,
     TrainerState,
     TrainingArguments,
     is_comet_available,
 )
+from transformers.trainer_utils import seed_worker
 from transformers.utils import (
     ModelOutput,
     is_peft_available,
@@ -280,6 +290,21 @@ def pad(
             [0, 0]]])
     ```
     """
+    if padding_side not in ("left", "right"):
+        raise ValueError("padding_side must be 'left' or 'right'")
+
+    # 1D tensors are copied all at once into the positions of a mask of the output tensor
+    if tensors[0].dim() == 1:
+        lengths = [len(t) for t in tensors]
+        max_length = max(lengths)
+        if pad_to_multiple_of is not None and max_length % pad_to_multiple_of != 0:
+            max_length += pad_to_multiple_of - max_length % pad_to_multiple_of
+        lengths = torch.tensor(lengths, device=tensors[0].device).unsqueeze(1)
+        positions = torch.arange(max_length, device=tensors[0].device)
+        mask = positions >= max_length - lengths if padding_side == "left" else positions < lengths
+        output = torch.full(mask.shape, padding_value, dtype=tensors[0].dtype, device=tensors[0].device)
+        return output.masked_scatter_(mask, torch.cat(tensors).to(output.dtype))
+
     # Determine the maximum shape for each dimension
     output_shape = np.max([t.shape for t in tensors], 0).tolist()
 
@@ -295,10 +320,8 @@ def pad(
     for i, t in enumerate(tensors):
         if padding_side == "left":
             seq_start = output_shape[0] - t.shape[0]
-        elif padding_side == "right":
-            seq_start = 0
         else:
-            raise ValueError("padding_side must be 'left' or 'right'")
+            seq_start = 0
 
         # Define the slices
         seq_slice = slice(seq_start, seq_start + t.shape[0])
@@ -1426,6 +1449,40 @@ def flush_right(mask: torch.Tensor, *tensors: torch.Tensor) -> Union[torch.Tenso
     return flushed_mask, *flushed_tensors
 
 
+def masked_tolist(tensor: torch.Tensor, mask: torch.Tensor) -> list[list]:
+    """
+    Convert a padded 2D tensor to a list of Python lists, keeping only the elements where the mask is non-zero.
+
+    This is equivalent to `[[x.item() for x, m in zip(row, mask_row) if m] for row, mask_row in zip(tensor, mask)]`,
+    but the tensor and the mask are copied to the host in a single transfer, instead of one synchronization per
+    element.
+
+    Args:
+        tensor (`torch.Tensor`):
+            2D tensor with shape `(N, M)`.
+        mask (`torch.Tensor`):
+            2D tensor (binary mask) with the same shape as `tensor`.
+
+    Returns:
+        `list[list]`:
+            List of `N` lists, each containing the elements of the corresponding row of `tensor` where `mask` is
+            non-zero.
+
+    Example:
+    ```python
+    >>> tensor = torch.tensor([[1, 2, 3], [4, 5, 6]])
+    >>> mask = torch.tensor([[1, 1, 0], [1, 1, 1]])
+    >>> masked_tolist(tensor, mask)
+    [[1, 2], [4, 5, 6]]
+    ```
+    """
+    tensor, mask = torch.stack([tensor, mask.to(tensor.dtype)]).cpu()
+    mask = mask.bool()
+    values = tensor[mask].tolist()
+    ends = mask.sum(dim=1).cumsum(dim=0).tolist()
+    return [values[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+
 def selective_log_softmax(logits, index) -> torch.Tensor:
     """
     A memory-efficient implementation of the common `log_softmax -> gather` operation.
@@ -1572,3 +1629,399 @@ def print_prompt_completions_sample(
 
     panel = Panel(table, expand=False, title=f"Step {step}", border_style="bold white")
     console.print(panel)
+
+
+def hash_processing_class(processing_class: Union[PreTrainedTokenizerBase, ProcessorMixin]) -> str:
+    """
+    Compute a content hash of a tokenizer or processor, independent of the Python object and of the path it was loaded
+    from.
+
+    The hash covers everything that affects tokenization: the tokenizer class, its full serialized state (vocabulary,
+    merges, normalizer, pre-tokenizer and post-processor) for fast tokenizers or its vocabulary for slow ones, the
+    special tokens, and the chat template.
+
+    Args:
+        processing_class (`PreTrainedTokenizerBase` or `ProcessorMixin`):
+            Tokenizer or processor to hash. For processors, the underlying tokenizer is hashed.
+
+    Returns:
+        `str`:
+            Hexadecimal SHA-256 digest.
+    """
+    tokenizer = getattr(processing_class, "tokenizer", processing_class)
+    hasher = hashlib.sha256()
+    hasher.update(type(tokenizer).__name__.encode())
+    backend_tokenizer = getattr(tokenizer, "backend_tokenizer", None)
+    if backend_tokenizer is not None:
+        hasher.update(backend_tokenizer.to_str().encode())
+    else:
+        hasher.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    hasher.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode())
+    chat_template = getattr(processing_class, "chat_template", None) or getattr(tokenizer, "chat_template", None)
+    hasher.update(json.dumps(chat_template, sort_keys=True).encode())
+    return hasher.hexdigest()
+
+
+def evict_dataset_cache(cache_dir: str, max_size: int) -> list[str]:
+    """
+    Remove the least recently used entries of a dataset cache directory until its total size is at most `max_size`.
+
+    Each subdirectory of `cache_dir` is considered an entry. Entries are ordered by their modification time, so
+    touching an entry when it's used makes it recently used.
+
+    Args:
+        cache_dir (`str`):
+            Cache directory.
+        max_size (`int`):
+            Maximum total size of the cache, in bytes.
+
+    Returns:
+        `list[str]`:
+            Paths of the removed entries.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir():
+            size = sum(
+                os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(entry.path) for name in names
+            )
+            entries.append((entry.stat().st_mtime, size, entry.path))
+    entries.sort()  # least recently used first
+
+    total_size = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, path in entries:
+        if total_size <= max_size:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+        removed.append(path)
+    return removed
+
+
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler that groups a variable number of examples per batch, so that each batch holds at most `max_tokens`
+    tokens.
+
+    The number of tokens of a batch is the size of the padded batch, i.e. the number of examples times the length of
+    the longest one. When the lengths have several components (e.g. chosen and rejected sequences that are padded
+    separately), the padded lengths of the components are summed. With `padding_free=True`, it's the total length of
+    the examples instead. An example longer than `max_tokens` is yielded alone.
+
+    Args:
+        lengths (`Sequence[int]` or `np.ndarray`):
+            Lengths of the examples, of shape `(num_examples,)` or `(num_examples, num_components)`.
+        max_tokens (`int`):
+            Maximum number of tokens per batch.
+        bucket_size (`int` or `None`, *optional*, defaults to `None`):
+            If set, the shuffled examples are split into buckets of `bucket_size` examples and sorted by length within
+            each bucket, so that batches group examples of similar lengths, and the order of the batches is shuffled.
+            If `None`, the batches follow the shuffled order of the examples.
+        shuffle (`bool`, *optional*, defaults to `True`):
+            Whether to shuffle the examples.
+        padding_free (`bool`, *optional*, defaults to `False`):
+            Whether the batches are flattened without padding.
+        num_replicas (`int`, *optional*, defaults to `1`):
+            Number of processes the batches are distributed to. The number of batches is padded to a multiple of it
+            by repeating the first batches, so that all processes get the same number of batches.
+        seed (`int`, *optional*, defaults to `0`):
+            Random seed. The examples of each epoch are shuffled with `seed + epoch`.
+
+    Example:
+    ```python
+    >>> sampler = TokenBudgetBatchSampler([5, 1, 3, 8, 2, 2], max_tokens=8, shuffle=False)
+    >>> list(sampler)
+    [[0], [1, 2], [3], [4, 5]]
+    ```
+    """
+
+    def __init__(
+        self,
+        lengths: Union[list[int], np.ndarray],
+        max_tokens: int,
+        bucket_size: Optional[int] = None,
+        shuffle: bool = True,
+        padding_free: bool = False,
+        num_replicas: int = 1,
+        seed: int = 0,
+    ):
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if lengths.ndim == 1:
+            lengths = lengths[:, None]
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.padding_free = padding_free
+        self.num_replicas = num_replicas
+        self.seed = seed
+        self.epoch = 0
+        self._iterated_epoch = None  # epoch being iterated, if any
+        self._batches = None  # (epoch, batches) of the last computed epoch
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _get_batches(self, epoch: int) -> list[list[int]]:
+        if self._batches is not None and self._batches[0] == epoch:
+            return self._batches[1]
+
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        num_examples = len(self.lengths)
+        order = torch.randperm(num_examples, generator=generator).numpy() if self.shuffle else np.arange(num_examples)
+        if self.bucket_size is None:
+            batches = self._greedy_batches(order)
+        else:
+            total_lengths = self.lengths.sum(axis=1)
+            batches = []
+            for start in range(0, num_examples, self.bucket_size):
+                bucket = order[start : start + self.bucket_size]
+                bucket = bucket[np.argsort(-total_lengths[bucket], kind="stable")]
+                batches.extend(self._greedy_batches(bucket))
+            if self.shuffle:
+                batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+
+        # Every process must get the same number of batches
+        batches += batches[: -len(batches) % self.num_replicas]
+        self._batches = (epoch, batches)
+        return batches
+
+    def _greedy_batches(self, order: np.ndarray) -> list[list[int]]:
+        batches, batch, batch_lengths, batch_total = [], [], None, 0
+        for idx, lengths in zip(order.tolist(), self.lengths[order].tolist()):
+            if batch:
+                if self.padding_free:
+                    num_tokens = batch_total + sum(lengths)
+                else:
+                    num_tokens = (len(batch) + 1) * sum(map(max, batch_lengths, lengths))
+                if num_tokens > self.max_tokens:
+                    batches.append(batch)
+                    batch = []
+            if batch:
+                batch.append(idx)
+                batch_lengths = list(map(max, batch_lengths, lengths))
+                batch_total += sum(lengths)
+            else:
+                batch, batch_lengths, batch_total = [idx], lengths, sum(lengths)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        epoch = self.epoch
+        self.epoch += 1  # in case `set_epoch` isn't called
+        self._iterated_epoch = epoch
+        try:
+            yield from self._get_batches(epoch)
+        finally:
+            self._iterated_epoch = None
+
+    def __len__(self) -> int:
+        # The number of batches varies from epoch to epoch when shuffling. It's the one of the epoch being iterated, or
+        # of the next one between epochs.
+        epoch = self.epoch if self._iterated_epoch is None else self._iterated_epoch
+        return len(self._get_batches(epoch))
+
+
+def get_list_lengths(dataset: Dataset, columns: list[str]) -> np.ndarray:
+    """
+    Get the lengths of the list columns of a dataset, read from the Arrow table without decoding the rows.
+
+    Args:
+        dataset (`Dataset`):
+            Dataset to get the lengths from.
+        columns (`list[str]`):
+            Names of the list columns.
+
+    Returns:
+        `np.ndarray`:
+            Lengths of shape `(len(dataset), len(columns))`.
+    """
+    table = dataset.select_columns(columns).with_format("arrow")[:]
+    return np.stack([pc.list_value_length(table[column]).to_numpy() for column in columns], axis=1)
+
+
+def get_token_budget_dataloader(trainer: Trainer, lengths: np.ndarray, padding_free: bool = False) -> DataLoader:
+    """
+    Create the training dataloader of a trainer with a [`TokenBudgetBatchSampler`] built from
+    `args.max_tokens_per_batch` and `args.length_bucket_size`, instead of a fixed batch size.
+
+    Args:
+        trainer (`Trainer`):
+            Trainer whose `train_dataset` and `data_collator` are used.
+        lengths (`np.ndarray`):
+            Lengths of the training examples, see [`TokenBudgetBatchSampler`].
+        padding_free (`bool`, *optional*, defaults to `False`):
+            Whether the batches are flattened without padding.
+
+    Returns:
+        `DataLoader`:
+            The training dataloader, prepared by the accelerator.
+    """
+    args = trainer.args
+    train_dataset = trainer.train_dataset
+    if isinstance(train_dataset, torch.utils.data.IterableDataset):
+        raise ValueError("`max_tokens_per_batch` is not supported with an iterable dataset.")
+
+    data_collator = trainer.data_collator
+    if isinstance(train_dataset, Dataset):
+        train_dataset = trainer._remove_unused_columns(train_dataset, description="training")
+    else:
+        data_collator = trainer._get_collator_with_removed_columns(data_collator, description="training")
+
+    batch_sampler = TokenBudgetBatchSampler(
+        lengths,
+        max_tokens=args.max_tokens_per_batch,
+        bucket_size=args.length_bucket_size,
+        padding_free=padding_free,
+        num_replicas=trainer.accelerator.num_processes,
+        seed=args.data_seed if args.data_seed is not None else args.seed,
+    )
+    dataloader = DataLoader(
+        train_dataset,
+        batch_sampler=batch_sampler,
+        collate_fn=data_collator,
+        num_workers=args.dataloader_num_workers,
+        pin_memory=args.dataloader_pin_memory,
+        persistent_workers=args.dataloader_persistent_workers,
+        worker_init_fn=partial(seed_worker, num_workers=args.dataloader_num_workers, rank=args.process_index),
+        prefetch_factor=args.dataloader_prefetch_factor,
+    )
+
+    # Accelerate only shards batches of varying sizes with `even_batches=False`. The sampler already yields the same
+    # number of batches for all processes.
+    even_batches = trainer.accelerator.even_batches
+    trainer.accelerator.even_batches = False
+    try:
+        return trainer.accelerator.prepare(dataloader)
+    finally:
+        trainer.accelerator.even_batches = even_batches
+
+
+class MetricsAccumulator:
+    """
+    Accumulates the metrics logged at each step as device tensors, and reduces them across processes only when they
+    are logged.
+
+    Calling `.item()` and `accelerator.gather` on each metric at each step forces a device synchronization and a
+    collective operation per metric. Instead, this class keeps the local value of each metric at each step on the
+    device, and [`~MetricsAccumulator.compute`] packs all of them into a single buffer, which is gathered across
+    processes and copied to the host once. The value of each step is then reduced across processes with the
+    reduction of the metric, and the logged value is the average over the steps, as with a `defaultdict(list)` of
+    per-step values averaged with `sum(val) / len(val)`.
+
+    All processes must add the same metrics, in the same order, the same number of times.
+
+    Example:
+    ```python
+    >>> metrics = MetricsAccumulator()
+    >>> metrics.add("loss", torch.tensor(1.0))
+    >>> metrics.add("loss", torch.tensor(2.0))
+    >>> metrics.add("min_length", torch.tensor(3), reduction="min")
+    >>> metrics.set("num_tokens", 1024)
+    >>> metrics.compute()
+    {'loss': 1.5, 'min_length': 3.0, 'num_tokens': 1024}
+    ```
+    """
+
+    # Reductions of the values of a step across processes, applied along the first dimension
+    _REDUCTIONS = {
+        "mean": lambda x: x.mean(dim=0),
+        "nanmean": lambda x: x.nanmean(dim=0),
+        "min": lambda x: x.amin(dim=0),
+        "max": lambda x: x.amax(dim=0),
+        "nanmin": lambda x: torch.where(x.isnan().all(dim=0), torch.nan, x.nan_to_num(torch.inf).amin(dim=0)),
+        "nanmax": lambda x: torch.where(x.isnan().all(dim=0), torch.nan, x.nan_to_num(-torch.inf).amax(dim=0)),
+        "sum": lambda x: x.sum(dim=0),
+        "none": lambda x: x[0],
+    }
+
+    def __init__(self):
+        self._values = {}
+        self._reductions = {}
+
+    def add(self, name: str, value: Union[torch.Tensor, float], reduction: str = "mean") -> None:
+        """
+        Add the local value of a metric for the current step, without synchronizing the device.
+
+        Args:
+            name (`str`):
+                Name of the metric.
+            value (`torch.Tensor` or `float`):
+                Local value of the metric, as a scalar tensor or a Python number.
+            reduction (`str`, *optional*, defaults to `"mean"`):
+                Reduction of the values of a step across processes. One of `"mean"`, `"nanmean"`, `"min"`, `"max"`,
+                `"nanmin"`, `"nanmax"`, `"sum"`, or `"none"` for values that are already the same on all processes.
+        """
+        if reduction not in self._REDUCTIONS:
+            raise ValueError(f"Unknown reduction: {reduction}. Expected one of {list(self._REDUCTIONS)}.")
+        if self._reductions.setdefault(name, reduction) != reduction:
+            raise ValueError(f"Metric {name} was added with reduction {self._reductions[name]}, not {reduction}.")
+        if isinstance(value, torch.Tensor):
+            value = value.detach().reshape(())
+        self._values.setdefault(name, []).append(value)
+
+    def set(self, name: str, value: float) -> None:
+        """
+        Set a metric that is logged as is, such as a running total. It replaces the previous value of the metric and
+        isn't reduced across processes.
+
+        Args:
+            name (`str`):
+                Name of the metric.
+            value (`float`):
+                Value of the metric.
+        """
+        self._reductions[name] = None
+        self._values[name] = value
+
+    def compute(self, accelerator: Optional[Accelerator] = None) -> dict[str, float]:
+        """
+        Reduce the accumulated metrics across processes and average them over the steps.
+
+        Args:
+            accelerator (`~accelerate.Accelerator` or `None`, *optional*, defaults to `None`):
+                Accelerator used to gather the metrics across processes. If `None`, the metrics are only reduced over
+                the steps.
+
+        Returns:
+            `dict[str, float]`:
+                Dictionary mapping the name of each metric to its value.
+        """
+        names = [name for name, reduction in self._reductions.items() if reduction is not None]
+        results = {}
+        if names:
+            device = accelerator.device if accelerator is not None else None
+            values = [
+                value if isinstance(value, torch.Tensor) else torch.tensor(value)
+                for name in names
+                for value in self._values[name]
+            ]
+            if device is None:
+                device = values[0].device
+            buffer = torch.stack([value.to(device=device, dtype=torch.float32) for value in values])
+            if accelerator is not None and accelerator.num_processes > 1:
+                buffer = accelerator.gather(buffer)
+            # Single host copy, then reduce in double precision as Python floats would be
+            buffer = buffer.cpu().double().view(-1, len(values))
+            start = 0
+            for name in names:
+                end = start + len(self._values[name])
+                results[name] = self._REDUCTIONS[self._reductions[name]](buffer[:, start:end]).mean()
+                start = end
+        metrics = {}
+        for name, reduction in self._reductions.items():
+            metrics[name] = results[name].item() if reduction is not None else self._values[name]
+        return metrics
+
+    def clear(self) -> None:
+        """
+        Remove all the accumulated metrics.
+        """
+        self._values.clear()
+        self._reductions.clear()
+
+    def __len__(self) -> int:
+        return len(self._reductions)